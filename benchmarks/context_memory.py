@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Сравнение памяти, занимаемой историей чатов: прежние словари на каждое сообщение
+против настоящего ContextManager (записи ContextEntry, таблицы авторов и упакованный
+контекст) после сборки запроса к API в каждом чате.
+
+Запуск: python benchmarks/context_memory.py [--chats 1000] [--messages 100]
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+# Добавляем src в путь для импортов
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# config.settings требует токены при импорте — для замера хватает фиктивных
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "benchmark-telegram-token")
+os.environ.setdefault("POLLINATIONS_TOKEN", "benchmark-pollinations-token")
+
+from services.context_manager import ContextManager  # noqa: E402
+
+# Участников в чате и различных текстов сообщений (тексты общие для обоих вариантов,
+# чтобы сравнивались только записи, а не сами строки)
+AUTHORS_PER_CHAT = 5
+DISTINCT_TEXTS = 1000
+
+
+def make_texts():
+    return [f"Сообщение {i}: " + "текст " * (10 + i % 40) for i in range(DISTINCT_TEXTS)]
+
+
+def make_authors(chat_id):
+    return [
+        {"id": chat_id * 100 + i, "name": f"Пользователь {i}", "username": f"user{i}"}
+        for i in range(AUTHORS_PER_CHAT)
+    ]
+
+
+def build_dicts(chats, messages, texts):
+    """Прежний формат: словарь {role, content, timestamp, author} на сообщение с копией автора"""
+    contexts = {}
+    for chat_id in range(chats):
+        authors = make_authors(chat_id)
+        entries = []
+        for i in range(messages):
+            entry = {
+                "role": "user" if i % 2 == 0 else "assistant",
+                "content": texts[(chat_id + i) % len(texts)],
+                "timestamp": time.time(),
+            }
+            if i % 2 == 0:
+                entry["author"] = dict(authors[i % AUTHORS_PER_CHAT])
+            entries.append(entry)
+        contexts[chat_id] = entries
+    return contexts
+
+
+def build_manager(chats, messages, texts):
+    """Текущий формат: настоящий ContextManager после сборки запроса (build_api_messages) в каждом чате"""
+    manager = ContextManager()
+    manager.context_limit = messages
+    for chat_id in range(chats):
+        authors = make_authors(chat_id)
+        for i in range(messages):
+            content = texts[(chat_id + i) % len(texts)]
+            if i % 2 == 0:
+                manager.add_message(chat_id, "user", content, authors[i % AUTHORS_PER_CHAT])
+            else:
+                manager.add_message(chat_id, "assistant", content)
+        manager.build_api_messages(chat_id)
+    return manager
+
+
+def measure(build, *args):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = build(*args)
+    elapsed = time.perf_counter() - started
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=100)
+    args = parser.parse_args()
+
+    texts = make_texts()
+    total = args.chats * args.messages
+    print(f"Чатов: {args.chats}, сообщений в чате: {args.messages} (всего {total})")
+
+    results = {}
+    for name, build in (("dict", build_dicts), ("ContextManager", build_manager)):
+        size, elapsed = measure(build, args.chats, args.messages, texts)
+        results[name] = size
+        print(f"{name:>14}: {size / 1024 / 1024:8.1f} МБ, {size / total:6.0f} байт/сообщение, {elapsed:.1f} с")
+
+    print(f"Сокращение: в {results['dict'] / results['ContextManager']:.1f} раза")
+
+
+if __name__ == "__main__":
+    main()
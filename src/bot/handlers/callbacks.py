@@ -6,8 +6,10 @@ from telegram.constants import ParseMode
 from telegram.ext import CallbackContext
 
 from services.context_manager import context_manager
-from services.pollinations_service import generate_image_async, auto_analyze_generated_image
+from services.pollinations_service import generate_image_async, auto_analyze_generated_image, build_image_url
+from services.image_cache import image_cache
 from utils.decorators import handle_errors
+from utils.telegram_utils import send_photo_cached, send_photo_by_url
 from config.settings import settings
 
 logger = logging.getLogger(__name__)
@@ -80,6 +82,12 @@ async def settings_callback(update: Update, context: CallbackContext):
         cur = int(s.get("context_limit", context_manager.get_context_limit(chat_id)))
         nxt = order[(order.index(cur) + 1) % len(order)] if cur in order else context_manager.get_context_limit(chat_id)
         s = context_manager.update_settings(chat_id, context_limit=nxt)
+    elif action == "toggle_model":
+        # auto — автоматический выбор, иначе закреплённая модель из TEXT_MODELS
+        order = ["auto"] + settings.text_models.split(",")
+        cur = context_manager.get_chat_model(chat_id) or "auto"
+        nxt = order[(order.index(cur) + 1) % len(order)]
+        s = context_manager.update_settings(chat_id, model=nxt)
     elif action == "toggle_auto_analyze":
         # Переключаем автоанализ изображений
         context_manager.toggle_auto_analyze(chat_id)
@@ -90,6 +98,7 @@ async def settings_callback(update: Update, context: CallbackContext):
     lang = s.get("lang", "auto")
     group_mode = s.get("group_mode", "mention_or_reply")
     context_limit = s.get("context_limit", context_manager.get_context_limit(chat_id))
+    model = context_manager.get_chat_model(chat_id) or "auto"
     
     # Получаем актуальное состояние автоанализа
     auto_analyze_enabled = context_manager.is_auto_analyze_enabled(chat_id)
@@ -100,6 +109,7 @@ async def settings_callback(update: Update, context: CallbackContext):
         [InlineKeyboardButton(f"Язык: {lang}", callback_data="settings::toggle_lang")],
         [InlineKeyboardButton(f"Режим в группе: {group_mode}", callback_data="settings::toggle_group_mode")],
         [InlineKeyboardButton(f"Лимит контекста: {context_limit}", callback_data="settings::context_limit")],
+        [InlineKeyboardButton(f"Модель: {model}", callback_data="settings::toggle_model")],
         [InlineKeyboardButton(f"Автоанализ изображений: {auto_analyze_text}", callback_data="settings::toggle_auto_analyze")],
     ]
 
@@ -109,6 +119,7 @@ async def settings_callback(update: Update, context: CallbackContext):
         f"• Язык: {lang}\n"
         f"• Режим в группе: {group_mode}\n"
         f"• Лимит контекста: {context_limit}\n"
+        f"• Модель: {model}\n"
         f"• Автоанализ изображений: {auto_analyze_text}\n\n"
         "Нажмите на пункт, чтобы переключить."
     )
@@ -190,20 +201,47 @@ async def imagine_callback(update: Update, context: CallbackContext):
             context_manager.clear_force_stop(chat_id)
             return
 
-        content, _ = await generate_image_async(prompt, width, height, seed=seed_value)
+        callback_data = f"imagine::{width}x{height}"
+        # Лог для отладки длины callback_data
+        try:
+            logger.debug("regen callback_data=%r len=%d", callback_data, len(callback_data.encode('utf-8')))
+        except Exception:
+            pass
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("Перегенерировать", callback_data=callback_data)],
+        ])
+        generation_key = image_cache.make_key(prompt, width, height, seed_value)
+        image_url = build_image_url(prompt, width, height, seed=seed_value)
+
+        sent = None
+        if settings.image_delivery_mode == "url":
+            # Отдаём Telegram URL — он сам скачает изображение, байты не проходят через бота
+            sent = await send_photo_by_url(
+                context.bot,
+                chat_id,
+                image_url,
+                generation_key=generation_key,
+                caption=f"{prompt}",
+                reply_markup=keyboard
+            )
+
+        content = None
+        if sent is None:
+            # Байты нужны, только если отправка по URL не используется или не удалась
+            content, _ = await generate_image_async(prompt, width, height, seed=seed_value)
         
-        # Проверяем принудительную остановку после генерации
-        if context_manager.is_force_stop_requested(chat_id):
-            await query.edit_message_caption(caption="🛑 Генерация остановлена пользователем")
-            context_manager.add_cleanup_message(chat_id, query.message.message_id)
-            context_manager.clear_force_stop(chat_id)
-            return
+            # Проверяем принудительную остановку после генерации
+            if context_manager.is_force_stop_requested(chat_id):
+                await query.edit_message_caption(caption="🛑 Генерация остановлена пользователем")
+                context_manager.add_cleanup_message(chat_id, query.message.message_id)
+                context_manager.clear_force_stop(chat_id)
+                return
             
-        if not content:
-            await query.edit_message_caption(caption="❌ Не удалось сгенерировать изображение")
-            # Добавляем сообщение об ошибке в список для удаления при следующем успешном ответе
-            context_manager.add_cleanup_message(chat_id, query.message.message_id)
-            return
+            if not content:
+                await query.edit_message_caption(caption="❌ Не удалось сгенерировать изображение")
+                # Добавляем сообщение об ошибке в список для удаления при следующем успешном ответе
+                context_manager.add_cleanup_message(chat_id, query.message.message_id)
+                return
         
         # Автоматический анализ сгенерированного изображения для контекста
         if context_manager.is_auto_analyze_enabled(chat_id):
@@ -211,7 +249,8 @@ async def imagine_callback(update: Update, context: CallbackContext):
                 analysis = await auto_analyze_generated_image(
                     image_content=content, 
                     prompt=prompt, 
-                    token=settings.pollinations_token
+                    token=settings.pollinations_token,
+                    image_url=image_url
                 )
                 if analysis:
                     # Сохраняем анализ в контекст как системное сообщение об изображении
@@ -220,18 +259,16 @@ async def imagine_callback(update: Update, context: CallbackContext):
             except Exception as e:
                 logger.warning(f"Не удалось выполнить автоанализ перегенерированного изображения: {e}")
         
-        next_seed = random.randint(1, 2**31 - 1)
-        callback_data = f"imagine::{width}x{height}"
-        # Лог для отладки длины callback_data
-        try:
-            logger.debug("regen callback_data=%r len=%d", callback_data, len(callback_data.encode('utf-8')))
-        except Exception:
-            pass
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("Перегенерировать", callback_data=callback_data)],
-        ])
         # Отправим новое фото и удалим старое сообщение
-        sent = await context.bot.send_photo(chat_id=chat_id, photo=content, caption=f"{prompt}", reply_markup=keyboard)
+        if sent is None:
+            sent = await send_photo_cached(
+                context.bot,
+                chat_id,
+                content,
+                generation_key=generation_key,
+                caption=f"{prompt}",
+                reply_markup=keyboard
+            )
         try:
             await context.bot.delete_message(chat_id=chat_id, message_id=query.message.message_id)
         except Exception:
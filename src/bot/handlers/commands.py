@@ -4,10 +4,12 @@ import time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ChatType, ParseMode
 from telegram.ext import CallbackContext
+from telegram.helpers import escape_markdown
 
 from services.context_manager import context_manager
-from services.pollinations_service import generate_image_async, auto_analyze_generated_image
-from utils.telegram_utils import show_typing
+from services.pollinations_service import generate_image_async, auto_analyze_generated_image, build_image_url
+from services.image_cache import image_cache
+from utils.telegram_utils import show_typing, send_photo_cached, send_photo_by_url
 from utils.decorators import handle_errors, track_performance
 from utils.health_check import get_health_status
 from config.settings import settings
@@ -126,6 +128,7 @@ async def settings_command(update: Update, context: CallbackContext):
     lang = s.get("lang", "auto")
     group_mode = s.get("group_mode", "mention_or_reply")
     context_limit = s.get("context_limit", context_manager.get_context_limit(chat_id))
+    model = context_manager.get_chat_model(chat_id) or "auto"
     
     # Получаем состояние автоанализа
     auto_analyze_enabled = context_manager.is_auto_analyze_enabled(chat_id)
@@ -136,6 +139,7 @@ async def settings_command(update: Update, context: CallbackContext):
         [InlineKeyboardButton(f"Язык: {lang}", callback_data="settings::toggle_lang")],
         [InlineKeyboardButton(f"Режим в группе: {group_mode}", callback_data="settings::toggle_group_mode")],
         [InlineKeyboardButton(f"Лимит контекста: {context_limit}", callback_data="settings::context_limit")],
+        [InlineKeyboardButton(f"Модель: {model}", callback_data="settings::toggle_model")],
         [InlineKeyboardButton(f"Автоанализ изображений: {auto_analyze_text}", callback_data="settings::toggle_auto_analyze")],
     ]
 
@@ -145,6 +149,7 @@ async def settings_command(update: Update, context: CallbackContext):
         f"• Язык: {lang}\n"
         f"• Режим в группе: {group_mode}\n"
         f"• Лимит контекста: {context_limit}\n"
+        f"• Модель: {model}\n"
         f"• Автоанализ изображений: {auto_analyze_text}\n\n"
         "Нажмите на пункт, чтобы переключить."
     )
@@ -444,6 +449,28 @@ async def _imagine_quick_mode(update: Update, context: CallbackContext):
     await _generate_image(chat_id, context.bot, prompt, width, height, seed)
 
 
+async def _wait_unless_stopped(chat_id: int, task: asyncio.Task) -> bool:
+    """Ждёт задачу, периодически проверяя принудительную остановку. False — задача отменена"""
+    while not task.done():
+        # Проверяем остановку каждые 0.05 секунды для более быстрой реакции
+        if context_manager.is_force_stop_requested(chat_id):
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+async def _report_stopped(chat_id: int, status):
+    """Сообщает об остановке генерации пользователем"""
+    stop_msg = await status.edit_text("🛑 Генерация остановлена пользователем")
+    context_manager.add_cleanup_message(chat_id, stop_msg.message_id)
+    context_manager.clear_force_stop(chat_id)
+
+
 async def _generate_image(chat_id: int, bot, prompt: str, width: int, height: int, seed: int = None, style_key: str = None, description_message_id: int = None):
     """Основная функция генерации изображения"""
     
@@ -462,56 +489,66 @@ async def _generate_image(chat_id: int, bot, prompt: str, width: int, height: in
     try:
         # Проверяем принудительную остановку перед началом
         if context_manager.is_force_stop_requested(chat_id):
-            stop_msg = await status.edit_text("🛑 Генерация остановлена пользователем")
-            context_manager.add_cleanup_message(chat_id, stop_msg.message_id)
-            context_manager.clear_force_stop(chat_id)
+            await _report_stopped(chat_id, status)
             return
 
-        # Создаем задачу для возможности отмены
-        import asyncio
-        task = asyncio.create_task(generate_image_async(final_prompt, width, height, seed=seed))
+        # Создаем кнопки
+        keyboard = [
+            [InlineKeyboardButton("🔄 Перегенерировать", callback_data=f"imagine::{width}x{height}")],
+            [InlineKeyboardButton("🎨 Новое изображение", callback_data="imagine_new")]
+        ]
+        generation_key = image_cache.make_key(final_prompt, width, height, seed)
+        url = build_image_url(final_prompt, width, height, seed=seed)
+
+        sent = None
+        if settings.image_delivery_mode == "url":
+            # Отдаём Telegram URL — он сам скачает изображение, байты не проходят через бота
+            task = asyncio.create_task(send_photo_by_url(
+                bot,
+                chat_id,
+                url,
+                generation_key=generation_key,
+                caption=f"{prompt}",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            ))
+            if not await _wait_unless_stopped(chat_id, task):
+                await _report_stopped(chat_id, status)
+                return
+            sent = await task
+            if not sent:
+                logger.info("Отправка по URL не удалась, переходим к загрузке байтов")
+
+        content = None
+        if sent is None:
+            # Байты нужны, только если отправка по URL не используется или не удалась
+            task = asyncio.create_task(generate_image_async(final_prompt, width, height, seed=seed))
+            if not await _wait_unless_stopped(chat_id, task):
+                await _report_stopped(chat_id, status)
+                return
+            content, error_hint = await task
 
-        # Ждем с периодической проверкой остановки
-        while not task.done():
-            # Проверяем остановку каждые 0.05 секунды для более быстрой реакции
+            # Проверяем принудительную остановку после генерации
             if context_manager.is_force_stop_requested(chat_id):
-                task.cancel()
-                try:
-                    await task
-                except asyncio.CancelledError:
-                    pass
-                stop_msg = await status.edit_text("🛑 Генерация остановлена пользователем")
-                context_manager.add_cleanup_message(chat_id, stop_msg.message_id)
-                context_manager.clear_force_stop(chat_id)
+                await _report_stopped(chat_id, status)
                 return
 
-            await asyncio.sleep(0.05)
+            if not content:
+                if error_hint == "rate_limit":
+                    await status.edit_text("⚠️ Превышен лимит запросов к сервису генерации. Попробуйте через несколько минут.")
+                else:
+                    await status.edit_text("❌ Не удалось сгенерировать изображение")
+                context_manager.add_cleanup_message(chat_id, status.message_id)
+                context_manager.clear_user_state(chat_id, "imagine")
+                return
 
-        content, url = await task
-        
-        # Проверяем принудительную остановку после генерации
-        if context_manager.is_force_stop_requested(chat_id):
-            stop_msg = await status.edit_text("🛑 Генерация остановлена пользователем")
-            context_manager.add_cleanup_message(chat_id, stop_msg.message_id)
-            context_manager.clear_force_stop(chat_id)
-            return
-            
-        if not content:
-            if url == "rate_limit":
-                await status.edit_text("⚠️ Превышен лимит запросов к сервису генерации. Попробуйте через несколько минут.")
-            else:
-                await status.edit_text("❌ Не удалось сгенерировать изображение")
-            context_manager.add_cleanup_message(chat_id, status.message_id)
-            context_manager.clear_user_state(chat_id, "imagine")
-            return
-        
-        # Автоматический анализ сгенерированного изображения для контекста
+        # Автоматический анализ сгенерированного изображения для контекста (по URL, без загрузки байтов)
         if context_manager.is_auto_analyze_enabled(chat_id):
             try:
                 analysis = await auto_analyze_generated_image(
                     image_content=content, 
                     prompt=final_prompt, 
-                    token=settings.pollinations_token
+                    token=settings.pollinations_token,
+                    image_url=url
                 )
                 if analysis:
                     # Сохраняем анализ в контекст как системное сообщение об изображении
@@ -519,20 +556,17 @@ async def _generate_image(chat_id: int, bot, prompt: str, width: int, height: in
                     logger.debug(f"Автоанализ сгенерированного изображения сохранен в контекст для чата {chat_id}")
             except Exception as e:
                 logger.warning(f"Не удалось выполнить автоанализ изображения: {e}")
-        
-        # Создаем кнопки
-        keyboard = [
-            [InlineKeyboardButton("🔄 Перегенерировать", callback_data=f"imagine::{width}x{height}")],
-            [InlineKeyboardButton("🎨 Новое изображение", callback_data="imagine_new")]
-        ]
-        
-        # Отправляем изображение
-        await bot.send_photo(
-            chat_id=chat_id, 
-            photo=content, 
-            caption=f"{prompt}",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+
+        if sent is None:
+            # Отправляем изображение (повторно загруженные изображения уходят по file_id)
+            await send_photo_cached(
+                bot,
+                chat_id,
+                content,
+                generation_key=generation_key,
+                caption=f"{prompt}",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
         
         try:
             await bot.delete_message(chat_id=chat_id, message_id=status.message_id)
@@ -586,8 +620,12 @@ async def health_command(update: Update, context: CallbackContext):
         context_manager.add_cleanup_message(update.effective_chat.id, err_msg.message_id)
         return
     
+    # Имена моделей, токенов и эндпоинтов могут содержать _ и * — экранируем их для Markdown
+    def md(value) -> str:
+        return escape_markdown(str(value), version=1)
+
     message = (
-        f"🏥 **Статус бота:** {health['status']}\n"
+        f"🏥 **Статус бота:** {md(health['status'])}\n"
         f"⏱️ **Время работы:** {health['uptime_hours']:.1f} часов\n"
         f"💾 **Память:** {health['memory_usage_percent']:.1f}% использовано\n"
         f"💿 **Диск:** {health['disk_usage_percent']:.1f}% использовано\n"
@@ -596,6 +634,92 @@ async def health_command(update: Update, context: CallbackContext):
         f"📊 **Запросов:** {health['request_count']}\n"
         f"❌ **Ошибок:** {health['error_count']} ({health['error_rate_percent']:.1f}%)"
     )
+
+    image_cache_stats = health.get("image_cache")
+    if image_cache_stats:
+        message += (
+            f"\n🖼️ **Кэш изображений:** {image_cache_stats['hit_rate_percent']:.1f}% попаданий "
+            f"(память {image_cache_stats['memory_hits']}, диск {image_cache_stats['disk_hits']}, "
+            f"промахи {image_cache_stats['misses']})"
+        )
+
+    file_id_stats = health.get("file_id_cache")
+    if file_id_stats:
+        message += f"\n📎 **Повторные отправки по file_id:** {file_id_stats['hits']}"
+
+    transcription_stats = health.get("transcription_cache")
+    if transcription_stats:
+        message += (
+            f"\n🎤 **Кэш транскрипций:** {transcription_stats['hit_rate_percent']:.1f}% попаданий "
+            f"(память {transcription_stats['memory_hits']}, диск {transcription_stats['disk_hits']}, "
+            f"промахи {transcription_stats['misses']})"
+        )
+
+    analysis_stats = health.get("image_analysis_cache")
+    if analysis_stats:
+        message += (
+            f"\n🔍 **Кэш анализа изображений:** {analysis_stats['hit_rate_percent']:.1f}% попаданий "
+            f"(попадания {analysis_stats['memory_hits']}, промахи {analysis_stats['misses']})"
+        )
+
+    pool_stats = health.get("media_pool")
+    if pool_stats:
+        message += (
+            f"\n🎛️ **Пул ffmpeg:** {pool_stats['active']}/{pool_stats['workers']} занято, "
+            f"в очереди {pool_stats['queue_depth']} (макс. {pool_stats['max_queue_depth']}), "
+            f"среднее ожидание {pool_stats['avg_wait_ms']:.0f} мс, таймаутов {pool_stats['timeouts']}"
+        )
+
+    upstream_stats = health.get("upstream")
+    if upstream_stats:
+        states = ", ".join(
+            f"{md(name)}: {md(stats['state'])} (повторов {stats['retries']}, отклонено {stats['rejected']}, "
+            f"лимит {stats['concurrency']['limit']}, в работе {stats['concurrency']['in_flight']}, "
+            f"очередь {stats['concurrency']['queue']}, отказов по очереди {stats['concurrency']['rejected']})"
+            for name, stats in upstream_stats.items()
+        )
+        message += f"\n🔌 **Pollinations:** {states}"
+
+    model_stats = health.get("models")
+    if model_stats:
+        models = ", ".join(
+            f"{md(task)}/{md(model)}: {stats['latency_ms'] if stats['latency_ms'] is not None else '—'} мс, "
+            f"ошибок {stats['error_rate_percent']:.1f}%{'' if stats['healthy'] else ' (отключена)'}"
+            for task, task_stats in model_stats.items() if task != "fallbacks"
+            for model, stats in task_stats.items()
+        )
+        if models:
+            message += f"\n🧭 **Модели:** {models}; переключений на запасную {model_stats['fallbacks']}"
+
+    token_stats = health.get("tokens")
+    if token_stats:
+        tokens = ", ".join(
+            f"{md(stats['token'])}: запросов {stats['requests']}, в работе {stats['in_flight']}, "
+            f"ошибок {stats['errors']}, 429 {stats['rate_limited']}"
+            + (f", карантин {stats['quarantine_seconds']} сек" if stats['quarantine_seconds'] else "")
+            for stats in token_stats
+        )
+        message += f"\n🔑 **Токены:** {tokens}"
+
+    summarizer_stats = health.get("summarizer")
+    if summarizer_stats:
+        message += (
+            f"\n🧠 **Сжатие истории:** сводок {summarizer_stats['summaries']}, "
+            f"объединений {summarizer_stats['condensed']}, ошибок {summarizer_stats['failures']}"
+        )
+
+    hedging_stats = health.get("hedging")
+    if hedging_stats:
+        delays = hedging_stats["hedge_delay_ms"]
+        threshold = ", ".join(
+            f"{md(model)} {delay} мс" if delay is not None else f"{md(model)} набирается статистика"
+            for model, delay in delays.items()
+        ) or "набирается статистика"
+        message += (
+            f"\n🪁 **Хеджирование:** {hedging_stats['hedged']} из {hedging_stats['requests']} запросов, "
+            f"побед дубля {hedging_stats['hedge_wins']}, пропущено по бюджету {hedging_stats['budget_skipped']}, "
+            f"порог {threshold}"
+        )
     
     await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
 
@@ -1,12 +1,7 @@
-import os
 import logging
 import time
 import asyncio
 import re
-import shutil
-import subprocess
-import tempfile
-import uuid
 from typing import Dict, List, Any, Optional, Tuple
 from telegram import Update
 from telegram.constants import ChatType, ParseMode
@@ -15,14 +10,27 @@ from telegram.ext import CallbackContext
 from config.settings import settings
 
 from services.context_manager import context_manager
+from services.media_cache import transcription_cache, image_analysis_cache
+from services.summarizer import summarizer
 from services.pollinations_service import (
     send_to_pollinations_async,
-    transcribe_audio_async,
-    analyze_image_async,
+    stream_from_pollinations_async,
+    StreamInterruptedError,
+    transcribe_voice_async,
+    analyze_image_bytes_async,
+    DEFAULT_IMAGE_QUESTION,
     _is_fallback_message,
 )
-from utils.telegram_utils import show_typing, strip_advertisement, safe_format_for_telegram, send_long_message
+from utils.telegram_utils import (
+    show_typing,
+    strip_advertisement,
+    safe_format_for_telegram,
+    send_long_message,
+    StreamingMessage,
+)
 from utils.decorators import handle_errors, track_performance
+from utils.image_utils import select_photo_size
+from utils.audio_utils import AudioConversionError
 
 logger = logging.getLogger(__name__)
 
@@ -66,6 +74,49 @@ def _validate_user_message(message: str) -> bool:
     return True
 
 
+_INTERRUPTED_NOTE = "⚠️ Ответ прерван из-за ошибки соединения. Повторите запрос."
+
+
+def _remember_response(chat_id: int, response: str) -> None:
+    """Сохраняет ответ модели в контекст и при необходимости запускает сжатие старой истории"""
+    context_manager.add_message(chat_id, "assistant", response)
+    summarizer.maybe_summarize(chat_id)
+
+
+async def _stream_ai_response(context: CallbackContext, chat_id: int, messages: List[Dict[str, Any]],
+                              token: str, status_message, reply_to_message_id: Optional[int]) -> Tuple[Optional[str], bool]:
+    """Стримит ответ модели в чат, используя статусное сообщение как первое сообщение ответа.
+
+    Возвращает очищенный от рекламы текст ответа (None, если ответ пуст) и признак того,
+    что ответ получен полностью. Оборванный ответ помечается в чате и не должен попадать в контекст.
+    """
+    writer = StreamingMessage(
+        context.bot,
+        chat_id,
+        reply_to_message_id=reply_to_message_id,
+        placeholder=status_message,
+    )
+    complete = True
+    try:
+        async for chunk in stream_from_pollinations_async(messages=messages, token=token,
+                                                          model=context_manager.get_chat_model(chat_id)):
+            await writer.append(chunk)
+    except StreamInterruptedError as e:
+        logger.warning(f"Стриминг ответа в чате {chat_id} прерван: {e}")
+        complete = False
+
+    if not writer.text.strip():
+        await writer.finish("")
+        return None, complete
+
+    ai_response_clean = strip_advertisement(writer.text)
+    if complete:
+        await writer.finish(ai_response_clean)
+    else:
+        await writer.finish(f"{ai_response_clean}\n\n{_INTERRUPTED_NOTE}")
+    return ai_response_clean or None, complete
+
+
 async def process_queue(context: CallbackContext, chat_id: int):
     """Обрабатывает очередь сообщений для чата"""
     while True:
@@ -84,12 +135,29 @@ async def process_queue(context: CallbackContext, chat_id: int):
             q_reply_to = next_task.get("reply_to_message_id")
 
             context_manager.add_message(chat_id, "user", q_user_message, author=q_author)
-            messages = context_manager.build_api_messages(chat_id)
+            messages = context_manager.build_api_messages(chat_id, model=context_manager.get_chat_model(chat_id))
             status = await context.bot.send_message(chat_id=chat_id, text="💭 Думаю...", reply_to_message_id=q_reply_to)
 
+            if settings.stream_responses:
+                ai_response_clean, complete = await _stream_ai_response(
+                    context, chat_id, messages, settings.pollinations_token, status, q_reply_to
+                )
+                # Неполный ответ уже помечен в чате и в контекст не сохраняется
+                if ai_response_clean and complete:
+                    _remember_response(chat_id, ai_response_clean)
+                    for mid in context_manager.consume_cleanup_messages(chat_id):
+                        try:
+                            await context.bot.delete_message(chat_id=chat_id, message_id=mid)
+                        except Exception:
+                            pass
+                elif not ai_response_clean:
+                    await context.bot.send_message(chat_id=chat_id, text="❌ Не удалось получить ответ от API", reply_to_message_id=q_reply_to)
+                continue
+
             ai_response = await send_to_pollinations_async(
                 messages=messages,
-                token=settings.pollinations_token
+                token=settings.pollinations_token,
+                model=context_manager.get_chat_model(chat_id)
             )
             if ai_response:
                 ai_response_clean = strip_advertisement(ai_response)
@@ -116,7 +184,7 @@ async def process_queue(context: CallbackContext, chat_id: int):
                             text=ai_response_clean,
                             reply_to_message_id=q_reply_to
                         )
-                context_manager.add_message(chat_id, "assistant", ai_response_clean)
+                _remember_response(chat_id, ai_response_clean)
                 for mid in context_manager.consume_cleanup_messages(chat_id):
                     try:
                         await context.bot.delete_message(chat_id=chat_id, message_id=mid)
@@ -381,12 +449,31 @@ async def handle_message(update: Update, context: CallbackContext):
     typing_task = asyncio.create_task(show_typing(context, chat_id))
 
     try:
-        messages = context_manager.build_api_messages(chat_id)
+        messages = context_manager.build_api_messages(chat_id, model=context_manager.get_chat_model(chat_id))
         status_message = await message.reply_text("💭 Думаю...")
 
+        if settings.stream_responses:
+            ai_response_clean, complete = await _stream_ai_response(
+                context, chat_id, messages, pollinations_token, status_message, message.message_id
+            )
+            # Неполный ответ уже помечен в чате и в контекст не сохраняется
+            if ai_response_clean and complete:
+                _remember_response(chat_id, ai_response_clean)
+                # Удаляем накопленные предупреждения/ошибки после успешного ответа
+                for mid in context_manager.consume_cleanup_messages(chat_id):
+                    try:
+                        await context.bot.delete_message(chat_id=chat_id, message_id=mid)
+                    except Exception:
+                        pass
+            elif not ai_response_clean:
+                err_msg = await message.reply_text("❌ Не удалось получить ответ от API")
+                context_manager.add_cleanup_message(chat_id, err_msg.message_id)
+            return
+
         ai_response = await send_to_pollinations_async(
             messages=messages,
-            token=pollinations_token
+            token=pollinations_token,
+            model=context_manager.get_chat_model(chat_id)
         )
 
         try:
@@ -436,7 +523,7 @@ async def handle_message(update: Update, context: CallbackContext):
                         reply_to_message_id=message.message_id
                     )
 
-            context_manager.add_message(chat_id, "assistant", ai_response_clean)
+            _remember_response(chat_id, ai_response_clean)
             # Удаляем накопленные предупреждения/ошибки после успешного ответа
             for mid in context_manager.consume_cleanup_messages(chat_id):
                 try:
@@ -538,72 +625,85 @@ async def handle_voice(update: Update, context: CallbackContext):
     status_message = None
 
     try:
-        # Скачиваем файл
         status_message = await message.reply_text("🎵 Обрабатываю голосовое сообщение...")
-        
-        file = await context.bot.get_file(voice.file_id)
-        temp_dir = tempfile.mkdtemp()
-        ogg_path = os.path.join(temp_dir, f"voice_{uuid.uuid4()}.ogg")
-        
-        await file.download_to_drive(ogg_path)
-        
-        # Конвертируем в WAV
-        wav_path = os.path.join(temp_dir, f"voice_{uuid.uuid4()}.wav")
-        try:
-            # Используем асинхронный subprocess вместо блокирующего subprocess.run()
-            process = await asyncio.create_subprocess_exec(
-                'ffmpeg', '-i', ogg_path, '-acodec', 'pcm_s16le', 
-                '-ar', '16000', '-ac', '1', wav_path,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await process.communicate()
-            
-            if process.returncode != 0:
-                logger.error(f"Ошибка конвертации аудио: {stderr.decode()}")
-                err_msg = await message.reply_text("❌ Ошибка обработки аудио файла")
-                context_manager.add_cleanup_message(chat_id, err_msg.message_id)
-                return
-        except FileNotFoundError:
-            err_msg = await message.reply_text("❌ FFmpeg не установлен! Установите ffmpeg для обработки голосовых сообщений.")
-            context_manager.add_cleanup_message(chat_id, err_msg.message_id)
-            return
 
-        # Транскрибируем
-        pollinations_token = settings.pollinations_token
-        if not pollinations_token:
-            logger.error("POLLINATIONS_TOKEN не установлен!")
-            await message.reply_text("Ошибка конфигурации бота. Пожалуйста, сообщите администратору.")
-            return
+        # Пересланные копии имеют тот же file_unique_id — берём готовую транскрипцию
+        transcription = None
+        cache_key = None
+        if settings.transcription_cache_enabled and voice.file_unique_id:
+            cache_key = transcription_cache.make_key(voice.file_unique_id)
+            transcription = await transcription_cache.get(cache_key)
+            if transcription:
+                logger.info(f"Транскрипция голосового {voice.file_unique_id} взята из кэша")
 
-        await context.bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=status_message.message_id,
-            text="🎤 Транскрибирую голосовое сообщение..."
-        )
+        if not transcription:
+            # Скачиваем файл в память
+            file = await context.bot.get_file(voice.file_id)
+            ogg_data = await file.download_as_bytearray()
 
-        transcription = await transcribe_audio_async(
-            audio_path=wav_path,
-            token=pollinations_token
-        )
+            # Транскрибируем
+            pollinations_token = settings.pollinations_token
+            if not pollinations_token:
+                logger.error("POLLINATIONS_TOKEN не установлен!")
+                await message.reply_text("Ошибка конфигурации бота. Пожалуйста, сообщите администратору.")
+                return
 
-        if not transcription:
             await context.bot.edit_message_text(
                 chat_id=chat_id,
                 message_id=status_message.message_id,
-                text="❌ Не удалось распознать голосовое сообщение"
+                text="🎤 Транскрибирую голосовое сообщение..."
             )
-            # Добавляем сообщение об ошибке в список для удаления при следующем успешном ответе
-            context_manager.add_cleanup_message(chat_id, status_message.message_id)
-            return
 
-        # Очищаем временные файлы
-        try:
-            shutil.rmtree(temp_dir)
-        except Exception as e:
-            logger.warning(f"Не удалось удалить временные файлы: {e}")
+            # Формат загрузки (ogg/mp3/wav) выбирается автоматически; конвертация — через pipe ffmpeg
+            async def report_progress(done: int, total: int, partial_text: str):
+                text = f"🎤 Транскрибирую голосовое сообщение... ({done}/{total})"
+                if partial_text:
+                    # Показываем хвост, чтобы уложиться в лимит сообщения Telegram
+                    text += f"\n\n{partial_text[-3500:]}"
+                await context.bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=status_message.message_id,
+                    text=text
+                )
+
+            try:
+                transcription = await transcribe_voice_async(
+                    voice_data=ogg_data,
+                    token=pollinations_token,
+                    duration=voice.duration,
+                    on_progress=report_progress if settings.voice_chunk_progress else None
+                )
+            except AudioConversionError as e:
+                logger.error(f"Ошибка конвертации аудио: {e}")
+                err_msg = await message.reply_text("❌ Ошибка обработки аудио файла")
+                context_manager.add_cleanup_message(chat_id, err_msg.message_id)
+                return
+            except asyncio.TimeoutError:
+                logger.error("Превышено время конвертации аудио")
+                err_msg = await message.reply_text("❌ Ошибка обработки аудио файла")
+                context_manager.add_cleanup_message(chat_id, err_msg.message_id)
+                return
+            except FileNotFoundError:
+                err_msg = await message.reply_text("❌ FFmpeg не установлен! Установите ffmpeg для обработки голосовых сообщений.")
+                context_manager.add_cleanup_message(chat_id, err_msg.message_id)
+                return
+
+            if not transcription:
+                await context.bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=status_message.message_id,
+                    text="❌ Не удалось распознать голосовое сообщение"
+                )
+                # Добавляем сообщение об ошибке в список для удаления при следующем успешном ответе
+                context_manager.add_cleanup_message(chat_id, status_message.message_id)
+                return
+
+            # Fallback-сообщения об ошибках не кэшируем
+            if cache_key and not _is_fallback_message(transcription):
+                await transcription_cache.put(cache_key, transcription)
+
+        pollinations_token = settings.pollinations_token
 
-        
         # Добавляем транскрипцию в контекст
         full_name = user.first_name or (user.username if user.username else str(user.id))
         author = {"id": user.id, "name": full_name, "username": user.username}
@@ -638,11 +738,12 @@ async def handle_voice(update: Update, context: CallbackContext):
             text="💭 Думаю..."
         )
 
-        messages = context_manager.build_api_messages(chat_id)
+        messages = context_manager.build_api_messages(chat_id, model=context_manager.get_chat_model(chat_id))
         start_time = time.time()
         ai_response = await send_to_pollinations_async(
             messages=messages,
-            token=pollinations_token
+            token=pollinations_token,
+            model=context_manager.get_chat_model(chat_id)
         )
         logger.info(f"Ответ на голосовое получен за {time.time() - start_time:.2f} сек")
 
@@ -693,7 +794,7 @@ async def handle_voice(update: Update, context: CallbackContext):
                         reply_to_message_id=message.message_id
                     )
 
-            context_manager.add_message(chat_id, "assistant", ai_response_clean)
+            _remember_response(chat_id, ai_response_clean)
             # Удаляем накопленные предупреждения/ошибки после успешного ответа
             for mid in context_manager.consume_cleanup_messages(chat_id):
                 try:
@@ -729,6 +830,30 @@ async def handle_voice(update: Update, context: CallbackContext):
         context_manager.set_generating(chat_id, False, "voice")
 
 
+async def _analyze_photo(context: CallbackContext, photo, token: str, question: str = DEFAULT_IMAGE_QUESTION, system_prompt: Optional[str] = None) -> Optional[str]:
+    """Анализирует фото Telegram; повторные копии (тот же file_unique_id) берутся из кэша без скачивания"""
+    cache_key = None
+    if settings.image_analysis_cache_enabled and photo.file_unique_id:
+        cache_key = image_analysis_cache.make_key(photo.file_unique_id, question, system_prompt)
+        cached = await image_analysis_cache.get(cache_key)
+        if cached:
+            logger.info(f"Анализ изображения {photo.file_unique_id} взят из кэша")
+            return cached
+
+    # Скачиваем файл в память — без временных файлов на диске
+    file = await context.bot.get_file(photo.file_id)
+    image_data = await file.download_as_bytearray()
+    analysis = await analyze_image_bytes_async(
+        image_data=image_data,
+        token=token,
+        question=question,
+        system_prompt=system_prompt
+    )
+    if analysis and cache_key:
+        await image_analysis_cache.put(cache_key, analysis)
+    return analysis
+
+
 @handle_errors
 @track_performance
 async def handle_image(update: Update, context: CallbackContext):
@@ -753,8 +878,12 @@ async def handle_image(update: Update, context: CallbackContext):
         context_manager.add_cleanup_message(chat_id, warn.message_id)
         return
 
-    # Получаем изображение
-    photo = message.photo[-1] if message.photo else None
+    # Получаем изображение: наименьшую копию, которой достаточно для анализа
+    # (при выключенной подготовке — самую большую, как прислал Telegram)
+    if settings.vision_preprocess_enabled:
+        photo = select_photo_size(message.photo, settings.vision_image_max_edge)
+    else:
+        photo = message.photo[-1] if message.photo else None
     if not photo:
         err_msg = await message.reply_text("❌ Не удалось получить изображение")
         context_manager.add_cleanup_message(chat_id, err_msg.message_id)
@@ -807,13 +936,7 @@ async def handle_image(update: Update, context: CallbackContext):
                 logger.info(f"Группа {chat_id}: режим silent — игнор изображения")
                 return
 
-    # Скачиваем файл для анализа или добавления в контекст
-    file = await context.bot.get_file(photo.file_id)
-    temp_dir = tempfile.mkdtemp()
-    image_path = os.path.join(temp_dir, f"image_{uuid.uuid4()}.jpg")
-    
     try:
-        await file.download_to_drive(image_path)
         
         if should_analyze:
             # Анализируем изображение и показываем результат
@@ -830,8 +953,9 @@ async def handle_image(update: Update, context: CallbackContext):
                     await message.reply_text("Ошибка конфигурации бота. Пожалуйста, сообщите администратору.")
                     return
 
-                analysis = await analyze_image_async(
-                    image_path=image_path,
+                analysis = await _analyze_photo(
+                    context=context,
+                    photo=photo,
                     token=pollinations_token
                 )
 
@@ -890,8 +1014,9 @@ async def handle_image(update: Update, context: CallbackContext):
                 return
 
             # Анализируем изображение для добавления в контекст (без показа пользователю)
-            analysis = await analyze_image_async(
-                image_path=image_path,
+            analysis = await _analyze_photo(
+                context=context,
+                photo=photo,
                 token=pollinations_token
             )
 
@@ -906,12 +1031,6 @@ async def handle_image(update: Update, context: CallbackContext):
         logger.exception("Ошибка в handle_image при скачивании файла")
         err = await message.reply_text(f"❌ Произошла ошибка при обработке изображения: {str(e)[:1000]}")
         context_manager.add_cleanup_message(chat_id, err.message_id)
-    finally:
-        # Очищаем временные файлы
-        try:
-            shutil.rmtree(temp_dir)
-        except Exception as e:
-            logger.warning(f"Не удалось удалить временные файлы: {e}")
 
 
 async def _handle_imagine_description(update: Update, context: CallbackContext, imagine_state: dict, user_message: str):
@@ -151,6 +151,8 @@ async def run_bot():
     
     # Запускаем cleanup task для rate limiter
     rate_limiter.start_cleanup_task()
+    # Запускаем вытеснение неактивных чатов
+    context_manager.start_cleanup_task()
     
     logger.info("Запуск бота...")
     
@@ -11,18 +11,85 @@ class Settings(BaseSettings):
 
     # Pollinations API Token
     pollinations_token: str
+    # Дополнительные токены через запятую (запросы распределяются по всем токенам)
+    pollinations_tokens: str = ""
+    # Карантин токена после 429, если Retry-After не указан (в секундах)
+    token_quarantine_seconds: int = 60
 
     # Контекст и лимиты
     context_limit: int = 20
+    # Бюджет токенов контекста (без ответа модели) и переопределения по моделям: "openai:8000,mistral:6000"
+    context_token_budget: int = 6000
+    model_token_budgets: str = ""
+    # Не поместившаяся в бюджет старая запись сокращается, только если остаток бюджета не меньше этого
+    context_min_truncated_tokens: int = 200
+
+    # Сжатие старой истории в сводку («память» чата) фоновым запросом к модели
+    summarization_enabled: bool = True
+    # Сворачивать, когда история превышает summary_trigger_tokens; за раз — около summary_block_tokens
+    summary_trigger_tokens: int = 3000
+    summary_block_tokens: int = 1500
+    # Последние сообщения, которые всегда отправляются как есть
+    summary_keep_recent: int = 6
+    # Объём сводок, при превышении которого они объединяются в одну
+    summary_memory_max_tokens: int = 600
+    # Сколько вытесненных по CONTEXT_LIMIT сообщений ждут суммаризации
+    summary_overflow_limit: int = 50
+    # Пауза перед новой попыткой после неудачной суммаризации (секунды); удваивается с каждой ошибкой подряд, до часа
+    summary_retry_seconds: int = 60
+    # История и память чата удаляются после стольких часов неактивности (настройки сохраняются); 0 — не удалять
+    chat_idle_ttl_hours: int = 168
     # max_message_length убран - Telegram сам ограничивает длину сообщений
     max_voice_size_mb: int = 50
     max_image_size_mb: int = 10
 
-    # Таймауты (в секундах)
+    # Таймауты (в секундах); api_timeout — для текстовых ответов
     api_timeout: int = 60
+    vision_timeout: int = 90
+    audio_timeout: int = 120
+    image_timeout: int = 120
+    http_connect_timeout: int = 10
     voice_processing_timeout: int = 30
     typing_interval: int = 5
 
+    # Размеры пулов HTTP-соединений по видам трафика
+    text_pool_size: int = 50
+    vision_pool_size: int = 20
+    audio_pool_size: int = 10
+    image_pool_size: int = 20
+
+    # Стриминг ответов: прогрессивное редактирование сообщения по мере генерации
+    stream_responses: bool = True
+    # Минимальный интервал между правками сообщения (мс), чтобы не упираться в лимиты Telegram
+    stream_edit_interval_ms: int = 1000
+
+    # Устойчивость к сбоям Pollinations: повторы с джиттером и circuit breaker на каждый эндпоинт
+    upstream_max_retries: int = 2
+    upstream_retry_base_delay: float = 0.5
+    upstream_retry_max_delay: float = 10.0
+    circuit_failure_threshold: int = 5
+    circuit_recovery_seconds: int = 30
+
+    # Адаптивный (AIMD) лимит одновременных запросов к каждому эндпоинту Pollinations
+    adaptive_initial_limit: int = 10
+    adaptive_min_limit: int = 1
+    adaptive_max_limit: int = 100
+    adaptive_max_queue: int = 200
+
+    # Модели Pollinations по задачам (через запятую, в порядке предпочтения)
+    text_models: str = "openai,mistral"
+    vision_models: str = "openai"
+    audio_models: str = "openai-audio"
+    # Модель с долей ошибок выше порога уходит в конец списка на model_recovery_seconds
+    model_error_threshold: float = 0.5
+    model_recovery_seconds: int = 60
+
+    # Хеджирование текстовых запросов: дублирующий запрос, если ответа нет дольше перцентиля задержек
+    hedging_enabled: bool = False
+    hedging_percentile: int = 95
+    hedging_budget_percent: int = 10
+    hedging_min_samples: int = 20
+
     # Rate limiting
     min_request_interval: float = 2.0
     max_requests_per_minute: int = 30
@@ -30,6 +97,50 @@ class Settings(BaseSettings):
     # Автоматический анализ сгенерированных изображений
     auto_analyze_generated_images: bool = True
 
+    # Кэш сгенерированных изображений (память + диск)
+    image_cache_enabled: bool = True
+    image_cache_dir: str = "cache/images"
+    image_cache_memory_mb: int = 32
+    image_cache_disk_mb: int = 256
+
+    # Доставка изображений: bytes — бот скачивает и загружает сам, url — Telegram скачивает по URL
+    image_delivery_mode: str = "bytes"
+
+    # Максимум одновременно работающих процессов ffmpeg (остальные ждут в очереди, короткие записи — первыми)
+    media_workers: int = 2
+
+    # Форматы загрузки голосовых на транскрипцию в порядке предпочтения (ogg — без перекодирования)
+    voice_upload_formats: str = "ogg,mp3,wav"
+    voice_mp3_bitrate_kbps: int = 32
+
+    # Длинные голосовые: разбиение по паузам и параллельная транскрипция фрагментов
+    voice_chunking_enabled: bool = True
+    voice_chunk_threshold_seconds: int = 60
+    voice_chunk_max_seconds: int = 45
+    voice_chunk_concurrency: int = 3
+    # Показывать распознанный текст в статусном сообщении по мере готовности фрагментов
+    voice_chunk_progress: bool = True
+
+    # Кэш транскрипций голосовых по file_unique_id (память + диск; пустой каталог — только память)
+    transcription_cache_enabled: bool = True
+    transcription_cache_size: int = 2000
+    transcription_cache_dir: str = "cache/transcriptions"
+    transcription_cache_disk_items: int = 50000
+
+    # Кэш анализа изображений по file_unique_id и вопросу (только память)
+    image_analysis_cache_enabled: bool = True
+    image_analysis_cache_size: int = 2000
+    image_analysis_cache_ttl_hours: int = 24
+
+    # Подготовка изображений перед анализом: уменьшение по большей стороне и перекодирование
+    vision_preprocess_enabled: bool = True
+    vision_image_max_edge: int = 1024
+    vision_image_quality: int = 85
+    vision_image_format: str = "jpeg"
+
+    # Количество file_id Telegram, запоминаемых для повторной отправки изображений без загрузки
+    file_id_cache_size: int = 5000
+
     # Предустановленные размеры изображений
     image_size_presets: dict = {
         "square": {"width": 1024, "height": 1024, "name": "Квадрат", "emoji": "📐"},
@@ -61,6 +172,9 @@ class Settings(BaseSettings):
     model_config = SettingsConfigDict(
         env_file=".env",
         case_sensitive=False,
+        # Поля model_error_threshold, model_token_budgets и т.п. относятся к моделям Pollinations,
+        # а не к пространству имён pydantic — без этого каждый импорт настроек выдаёт UserWarning
+        protected_namespaces=(),
     )
 
     @field_validator('telegram_bot_token')
@@ -77,6 +191,80 @@ class Settings(BaseSettings):
             raise ValueError('POLLINATIONS_TOKEN должен быть валидным токеном')
         return v
 
+    @field_validator('pollinations_tokens')
+    @classmethod
+    def validate_pollinations_tokens(cls, v: str) -> str:
+        tokens = [t.strip() for t in v.split(",") if t.strip()]
+        if any(len(t) < 10 for t in tokens):
+            raise ValueError('POLLINATIONS_TOKENS должен содержать валидные токены через запятую')
+        return ",".join(tokens)
+
+    @field_validator('token_quarantine_seconds')
+    @classmethod
+    def validate_token_quarantine_seconds(cls, v: int) -> int:
+        if v < 1 or v > 3600:
+            raise ValueError('TOKEN_QUARANTINE_SECONDS должен быть между 1 и 3600 секунд')
+        return v
+
+    @field_validator('context_token_budget')
+    @classmethod
+    def validate_context_token_budget(cls, v: int) -> int:
+        if v < 500 or v > 200000:
+            raise ValueError('CONTEXT_TOKEN_BUDGET должен быть между 500 и 200000')
+        return v
+
+    @field_validator('model_token_budgets')
+    @classmethod
+    def validate_model_token_budgets(cls, v: str) -> str:
+        items = [item.strip() for item in v.split(",") if item.strip()]
+        for item in items:
+            model, _, budget = item.rpartition(":")
+            if not model.strip() or not budget.strip().isdigit() or not 500 <= int(budget) <= 200000:
+                raise ValueError('MODEL_TOKEN_BUDGETS должен иметь вид "модель:бюджет,..." с бюджетом от 500 до 200000')
+        return ",".join(items)
+
+    @field_validator('context_min_truncated_tokens')
+    @classmethod
+    def validate_context_min_truncated_tokens(cls, v: int) -> int:
+        if v < 10 or v > 10000:
+            raise ValueError('CONTEXT_MIN_TRUNCATED_TOKENS должен быть между 10 и 10000')
+        return v
+
+    @field_validator('summary_trigger_tokens', 'summary_block_tokens', 'summary_memory_max_tokens')
+    @classmethod
+    def validate_summary_tokens(cls, v: int) -> int:
+        if v < 100 or v > 100000:
+            raise ValueError('Пороги суммаризации (SUMMARY_*_TOKENS) должны быть между 100 и 100000')
+        return v
+
+    @field_validator('summary_keep_recent')
+    @classmethod
+    def validate_summary_keep_recent(cls, v: int) -> int:
+        if v < 1 or v > 100:
+            raise ValueError('SUMMARY_KEEP_RECENT должен быть между 1 и 100')
+        return v
+
+    @field_validator('summary_overflow_limit')
+    @classmethod
+    def validate_summary_overflow_limit(cls, v: int) -> int:
+        if v < 1 or v > 500:
+            raise ValueError('SUMMARY_OVERFLOW_LIMIT должен быть между 1 и 500')
+        return v
+
+    @field_validator('summary_retry_seconds')
+    @classmethod
+    def validate_summary_retry_seconds(cls, v: int) -> int:
+        if v < 1 or v > 3600:
+            raise ValueError('SUMMARY_RETRY_SECONDS должен быть между 1 и 3600')
+        return v
+
+    @field_validator('chat_idle_ttl_hours')
+    @classmethod
+    def validate_chat_idle_ttl_hours(cls, v: int) -> int:
+        if v < 0 or v > 8760:
+            raise ValueError('CHAT_IDLE_TTL_HOURS должен быть между 0 и 8760 часами')
+        return v
+
     @field_validator('context_limit')
     @classmethod
     def validate_context_limit(cls, v: int) -> int:
@@ -107,6 +295,213 @@ class Settings(BaseSettings):
             raise ValueError('API_TIMEOUT должен быть между 10 и 300 секунд')
         return v
 
+    @field_validator('vision_timeout', 'audio_timeout', 'image_timeout')
+    @classmethod
+    def validate_endpoint_timeout(cls, v: int) -> int:
+        if v < 10 or v > 600:
+            raise ValueError('Таймаут эндпоинта должен быть между 10 и 600 секунд')
+        return v
+
+    @field_validator('http_connect_timeout')
+    @classmethod
+    def validate_http_connect_timeout(cls, v: int) -> int:
+        if v < 1 or v > 60:
+            raise ValueError('HTTP_CONNECT_TIMEOUT должен быть между 1 и 60 секунд')
+        return v
+
+    @field_validator('text_pool_size', 'vision_pool_size', 'audio_pool_size', 'image_pool_size')
+    @classmethod
+    def validate_pool_size(cls, v: int) -> int:
+        if v < 1 or v > 500:
+            raise ValueError('Размер пула соединений должен быть между 1 и 500')
+        return v
+
+    @field_validator('text_models', 'vision_models', 'audio_models')
+    @classmethod
+    def validate_models(cls, v: str) -> str:
+        models = [m.strip() for m in v.split(",") if m.strip()]
+        if not models:
+            raise ValueError('Список моделей (TEXT_MODELS, VISION_MODELS, AUDIO_MODELS) не может быть пустым')
+        return ",".join(models)
+
+    @field_validator('model_error_threshold')
+    @classmethod
+    def validate_model_error_threshold(cls, v: float) -> float:
+        if v <= 0 or v > 1:
+            raise ValueError('MODEL_ERROR_THRESHOLD должен быть больше 0 и не больше 1')
+        return v
+
+    @field_validator('model_recovery_seconds')
+    @classmethod
+    def validate_model_recovery_seconds(cls, v: int) -> int:
+        if v < 5 or v > 3600:
+            raise ValueError('MODEL_RECOVERY_SECONDS должен быть между 5 и 3600 секунд')
+        return v
+
+    @field_validator('hedging_percentile')
+    @classmethod
+    def validate_hedging_percentile(cls, v: int) -> int:
+        if v < 50 or v > 99:
+            raise ValueError('HEDGING_PERCENTILE должен быть между 50 и 99')
+        return v
+
+    @field_validator('hedging_budget_percent')
+    @classmethod
+    def validate_hedging_budget_percent(cls, v: int) -> int:
+        if v < 1 or v > 50:
+            raise ValueError('HEDGING_BUDGET_PERCENT должен быть между 1 и 50')
+        return v
+
+    @field_validator('hedging_min_samples')
+    @classmethod
+    def validate_hedging_min_samples(cls, v: int) -> int:
+        if v < 5 or v > 200:
+            raise ValueError('HEDGING_MIN_SAMPLES должен быть между 5 и 200')
+        return v
+
+    @field_validator('image_delivery_mode')
+    @classmethod
+    def validate_image_delivery_mode(cls, v: str) -> str:
+        v = v.lower()
+        if v not in ("bytes", "url"):
+            raise ValueError('IMAGE_DELIVERY_MODE должен быть bytes или url')
+        return v
+
+    @field_validator('media_workers')
+    @classmethod
+    def validate_media_workers(cls, v: int) -> int:
+        if v < 1 or v > 16:
+            raise ValueError('MEDIA_WORKERS должен быть между 1 и 16')
+        return v
+
+    @field_validator('voice_upload_formats')
+    @classmethod
+    def validate_voice_upload_formats(cls, v: str) -> str:
+        formats = [f.strip().lower() for f in v.split(",") if f.strip()]
+        if not formats or any(f not in ("ogg", "mp3", "wav") for f in formats):
+            raise ValueError('VOICE_UPLOAD_FORMATS должен содержать ogg, mp3 и/или wav через запятую')
+        return ",".join(formats)
+
+    @field_validator('voice_mp3_bitrate_kbps')
+    @classmethod
+    def validate_voice_mp3_bitrate(cls, v: int) -> int:
+        if v < 8 or v > 192:
+            raise ValueError('VOICE_MP3_BITRATE_KBPS должен быть между 8 и 192')
+        return v
+
+    @field_validator('voice_chunk_threshold_seconds', 'voice_chunk_max_seconds')
+    @classmethod
+    def validate_voice_chunk_seconds(cls, v: int) -> int:
+        if v < 10 or v > 600:
+            raise ValueError('Длительность фрагмента голосового должна быть между 10 и 600 секунд')
+        return v
+
+    @field_validator('voice_chunk_concurrency')
+    @classmethod
+    def validate_voice_chunk_concurrency(cls, v: int) -> int:
+        if v < 1 or v > 10:
+            raise ValueError('VOICE_CHUNK_CONCURRENCY должен быть между 1 и 10')
+        return v
+
+    @field_validator('transcription_cache_size', 'transcription_cache_disk_items')
+    @classmethod
+    def validate_transcription_cache_size(cls, v: int) -> int:
+        if v < 1 or v > 1000000:
+            raise ValueError('Размер кэша транскрипций должен быть между 1 и 1000000 записей')
+        return v
+
+    @field_validator('image_analysis_cache_size')
+    @classmethod
+    def validate_image_analysis_cache_size(cls, v: int) -> int:
+        if v < 1 or v > 100000:
+            raise ValueError('IMAGE_ANALYSIS_CACHE_SIZE должен быть между 1 и 100000')
+        return v
+
+    @field_validator('image_analysis_cache_ttl_hours')
+    @classmethod
+    def validate_image_analysis_cache_ttl(cls, v: int) -> int:
+        if v < 1 or v > 720:
+            raise ValueError('IMAGE_ANALYSIS_CACHE_TTL_HOURS должен быть между 1 и 720 часами')
+        return v
+
+    @field_validator('vision_image_max_edge')
+    @classmethod
+    def validate_vision_image_max_edge(cls, v: int) -> int:
+        if v < 256 or v > 4096:
+            raise ValueError('VISION_IMAGE_MAX_EDGE должен быть между 256 и 4096 пикселей')
+        return v
+
+    @field_validator('vision_image_quality')
+    @classmethod
+    def validate_vision_image_quality(cls, v: int) -> int:
+        if v < 30 or v > 95:
+            raise ValueError('VISION_IMAGE_QUALITY должен быть между 30 и 95')
+        return v
+
+    @field_validator('vision_image_format')
+    @classmethod
+    def validate_vision_image_format(cls, v: str) -> str:
+        v = v.lower()
+        if v not in ("jpeg", "webp"):
+            raise ValueError('VISION_IMAGE_FORMAT должен быть jpeg или webp')
+        return v
+
+    @field_validator('image_cache_memory_mb', 'image_cache_disk_mb')
+    @classmethod
+    def validate_image_cache_size(cls, v: int) -> int:
+        if v < 1 or v > 10240:
+            raise ValueError('Размер кэша изображений должен быть между 1 и 10240 МБ')
+        return v
+
+    @field_validator('stream_edit_interval_ms')
+    @classmethod
+    def validate_stream_edit_interval(cls, v: int) -> int:
+        if v < 300 or v > 10000:
+            raise ValueError('STREAM_EDIT_INTERVAL_MS должен быть между 300 и 10000 мс')
+        return v
+
+    @field_validator('upstream_max_retries')
+    @classmethod
+    def validate_upstream_max_retries(cls, v: int) -> int:
+        if v < 0 or v > 5:
+            raise ValueError('UPSTREAM_MAX_RETRIES должен быть между 0 и 5')
+        return v
+
+    @field_validator('upstream_retry_base_delay', 'upstream_retry_max_delay')
+    @classmethod
+    def validate_upstream_retry_delay(cls, v: float) -> float:
+        if v < 0.05 or v > 120.0:
+            raise ValueError('Задержка повтора должна быть между 0.05 и 120 секунд')
+        return v
+
+    @field_validator('circuit_failure_threshold')
+    @classmethod
+    def validate_circuit_failure_threshold(cls, v: int) -> int:
+        if v < 1 or v > 100:
+            raise ValueError('CIRCUIT_FAILURE_THRESHOLD должен быть между 1 и 100')
+        return v
+
+    @field_validator('circuit_recovery_seconds')
+    @classmethod
+    def validate_circuit_recovery_seconds(cls, v: int) -> int:
+        if v < 1 or v > 600:
+            raise ValueError('CIRCUIT_RECOVERY_SECONDS должен быть между 1 и 600 секунд')
+        return v
+
+    @field_validator('adaptive_initial_limit', 'adaptive_min_limit', 'adaptive_max_limit')
+    @classmethod
+    def validate_adaptive_limit(cls, v: int) -> int:
+        if v < 1 or v > 500:
+            raise ValueError('Лимит конкурентности должен быть между 1 и 500')
+        return v
+
+    @field_validator('adaptive_max_queue')
+    @classmethod
+    def validate_adaptive_max_queue(cls, v: int) -> int:
+        if v < 0 or v > 10000:
+            raise ValueError('ADAPTIVE_MAX_QUEUE должен быть между 0 и 10000')
+        return v
+
     @field_validator('min_request_interval')
     @classmethod
     def validate_min_request_interval(cls, v: float) -> float:
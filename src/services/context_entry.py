@@ -0,0 +1,97 @@
+"""
+Компактные записи контекста чата: __slots__ вместо словаря на каждое сообщение
+"""
+from enum import IntEnum
+from typing import Any, Dict, Optional
+
+
+class Role(IntEnum):
+    """Роль записи контекста (хранится как малое целое, а не строка)"""
+    SYSTEM = 0
+    USER = 1
+    ASSISTANT = 2
+    # Анализ изображения — уходит в API как системное сообщение
+    IMAGE = 3
+
+    @property
+    def api_role(self) -> str:
+        return "system" if self in (Role.SYSTEM, Role.IMAGE) else self.name.lower()
+
+    @classmethod
+    def parse(cls, role: str, is_image_context: bool = False) -> "Role":
+        """Роль из строки API ("user", "assistant", "system")"""
+        if is_image_context:
+            return cls.IMAGE
+        return cls[role.upper()]
+
+
+class Author:
+    """Автор сообщения. Один объект на автора в чате — разделяется всеми его записями"""
+
+    __slots__ = ("id", "name", "username")
+
+    def __init__(self, id: Any = None, name: Optional[str] = None, username: Optional[str] = None):
+        self.id = id
+        self.name = name
+        self.username = username
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"id": self.id, "name": self.name, "username": self.username}
+
+
+class AuthorTable:
+    """Таблица авторов одного чата: одинаковые авторы хранятся один раз"""
+
+    __slots__ = ("_authors",)
+
+    def __init__(self):
+        self._authors: Dict[tuple, Author] = {}
+
+    def intern(self, author: Optional[Dict[str, Any]]) -> Optional[Author]:
+        if not author:
+            return None
+        key = (author.get("id"), author.get("name"), author.get("username"))
+        interned = self._authors.get(key)
+        if interned is None:
+            interned = Author(*key)
+            self._authors[key] = interned
+        return interned
+
+    def __len__(self) -> int:
+        return len(self._authors)
+
+
+class ContextEntry:
+    """Запись контекста чата.
+
+    seq — сквозной порядковый номер записи, tokens — оценка токенов текста, уходящего в API.
+    """
+
+    __slots__ = ("role", "content", "timestamp", "author", "seq", "tokens")
+
+    def __init__(self, role: Role, content: str, timestamp: float, author: Optional[Author] = None,
+                 seq: int = 0, tokens: int = 0):
+        self.role = role
+        self.content = content
+        self.timestamp = timestamp
+        self.author = author
+        self.seq = seq
+        self.tokens = tokens
+
+    @property
+    def is_sent(self) -> bool:
+        """Уходит ли запись в API (обычные системные сообщения добавляются отдельно)"""
+        return self.role is not Role.SYSTEM
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Запись в формате экспорта (как хранились словари до перехода на __slots__)"""
+        data: Dict[str, Any] = {
+            "role": self.role.api_role,
+            "content": self.content,
+            "timestamp": self.timestamp,
+        }
+        if self.author is not None:
+            data["author"] = self.author.to_dict()
+        if self.role is Role.IMAGE:
+            data["is_image_context"] = True
+        return data
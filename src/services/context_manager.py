@@ -1,27 +1,98 @@
+import asyncio
+import bisect
+import itertools
 import logging
 import time
 import os
 import json
 from typing import Dict, List, Optional, Any
 from config.settings import settings
+from services.context_entry import AuthorTable, ContextEntry, Role
+from utils.token_utils import estimate_tokens, parse_token_budgets, truncate_to_tokens
 
 
 logger = logging.getLogger(__name__)
 
-class ContextManager:
+
+class _PackedContext:
+    """Упакованный контекст одного чата: префикс и границы окна последних записей.
+
+    Префикс (системный промпт и память) пересобирается только при смене версии чата,
+    граница окна и сумма его токенов — сдвигаются при появлении новых и вытеснении старых записей.
+    Сообщения API окна не хранятся: они строятся из записей при отправке.
+    """
+
+    __slots__ = ("version", "model", "prefix", "budget", "start_seq", "tokens", "last_seq",
+                 "boundary_key", "boundary")
+
+    def __init__(self, version: int, model: Optional[str], prefix: List[Dict[str, str]], budget: int):
+        self.version = version
+        self.model = model
+        self.prefix = prefix
+        # Бюджет токенов, оставшийся после префикса
+        self.budget = budget
+        # Окно — записи с seq от start_seq до last_seq, целиком поместившиеся в бюджет; tokens — их сумма
+        self.start_seq = -1
+        self.tokens = 0
+        self.last_seq = -1
+        # Сокращённая запись на границе окна: ((seq, остаток бюджета), сообщение)
+        self.boundary_key = None
+        self.boundary: Optional[Dict[str, str]] = None
+
+
+class ChatState:
+    """Всё состояние одного чата.
+
+    Редко используемые части (None по умолчанию) создаются при первой записи;
+    удаление чата из ContextManager.chats освобождает его состояние целиком.
+    """
+
+    __slots__ = (
+        "context", "authors", "generating", "cleanup_message_ids", "auto_analyze", "user_states",
+        "force_stop", "system_prompt", "role", "context_limit", "settings", "usage", "memory",
+        "overflow", "packed", "version", "last_activity",
+    )
+
     def __init__(self):
-        self.contexts: Dict[int, List[Dict[str, Any]]] = {}
-        # Раздельные флаги для разных типов операций
-        self.generating_flags: Dict[int, Dict[str, bool]] = {}  # chat_id -> {operation_type: bool}
-        self.user_last_request: Dict[int, float] = {}  # Для rate limiting
+        self.context: List[ContextEntry] = []
+        # Авторы сообщений (одна запись на автора вместо копии в каждом сообщении)
+        self.authors: Optional[AuthorTable] = None
+        # Раздельные флаги для разных типов операций: {operation_type: bool}
+        self.generating: Optional[Dict[str, bool]] = None
         # Сообщения, которые нужно удалить после успешного ответа
-        self.cleanup_message_ids: Dict[int, List[int]] = {}
-        # Настройки автоанализа изображений для каждого чата
-        self.auto_analyze_settings: Dict[int, bool] = {}
+        self.cleanup_message_ids: Optional[List[int]] = None
+        # Автоанализ изображений (None — глобальная настройка)
+        self.auto_analyze: Optional[bool] = None
         # Состояния для многошаговых процессов (например, генерация изображений)
-        self.user_states: Dict[int, Dict[str, Any]] = {}
-        # Флаги принудительной остановки для каждого чата
-        self.force_stop_flags: Dict[int, bool] = {}
+        self.user_states: Optional[Dict[str, Dict[str, Any]]] = None
+        # Флаг принудительной остановки
+        self.force_stop = False
+        # Переопределение системного промпта
+        self.system_prompt: Optional[str] = None
+        # Текущая роль (ключ из predefined_roles или custom)
+        self.role: Optional[str] = None
+        # Переопределение лимита контекста
+        self.context_limit: Optional[int] = None
+        # Настройки чата (только отличающиеся от значений по умолчанию)
+        self.settings: Optional[Dict[str, Any]] = None
+        # Статистика использования
+        self.usage: Optional[Dict[str, Any]] = None
+        # Сжатая «память»: сводки старых частей диалога ({"content", "tokens"})
+        self.memory: Optional[List[Dict[str, Any]]] = None
+        # Вытесненные по лимиту сообщения, ещё не вошедшие в сводку
+        self.overflow: Optional[List[ContextEntry]] = None
+        # Упакованный контекст (префикс и границы окна) и версия чата (растёт при изменении промпта,
+        # настроек, памяти или при замене контекста целиком)
+        self.packed: Optional[_PackedContext] = None
+        self.version = 0
+        self.last_activity = time.monotonic()
+
+
+class ContextManager:
+    def __init__(self):
+        # Состояние чатов: единственное место хранения всех данных чата
+        self.chats: Dict[int, ChatState] = {}
+        self._cleanup_task: Optional[asyncio.Task] = None
         # Системный промпт по умолчанию
         self.default_system_prompt = (
             "Ты - полезный ассистент по имени СикСик. "
@@ -57,78 +128,152 @@ class ContextManager:
                 "Твои советы основаны на астрологии и нумерологии. "
             ),
         }
-        # Переопределения системного промпта по чатам
-        self.chat_system_prompts = {}
-        # Текущая роль по чатам (ключ из predefined_roles или custom)
-        self.chat_roles = {}
         # Лимит сообщений контекста
         self.context_limit = settings.context_limit
-        # Переопределения лимита контекста по чатам
-        self.chat_context_limits: Dict[int, int] = {}
-        # Статистика использования
-        self.usage_stats: Dict[int, Dict[str, Any]] = {}
-        # Настройки по чатам
-        self.chat_settings: Dict[int, Dict[str, Any]] = {}
+        self._entry_seq = itertools.count()
         self.default_settings: Dict[str, Any] = {
             "format": "md",           # md | html | plain
             "verbosity": "normal",   # short | normal | long
             "lang": "auto",          # auto | ru | en
             "group_mode": "mention_or_reply",  # mention_or_reply | always
             "context_limit": self.context_limit,
+            "model": "auto",          # auto | модель из settings.text_models
         }
 
-    def init_context(self, chat_id):
-        if chat_id not in self.contexts:
-            self.contexts[chat_id] = []
-            self.generating_flags[chat_id] = {}
+    def init_context(self, chat_id) -> ChatState:
+        """Возвращает состояние чата, создавая его при первом обращении"""
+        state = self.chats.get(chat_id)
+        if state is None:
+            state = self.chats[chat_id] = ChatState()
+        state.last_activity = time.monotonic()
+        return state
 
     def reset_context(self, chat_id):
-        if chat_id in self.contexts:
-            self.contexts[chat_id] = []
-        self.generating_flags[chat_id] = {}
+        state = self.init_context(chat_id)
+        state.context = []
+        state.generating = None
+        state.authors = None
+        state.memory = None
+        state.overflow = None
+        self._touch(state)
+
+    # ----- Вытеснение неактивных чатов -----
+    def evict_chat(self, chat_id) -> bool:
+        """Удаляет всё состояние чата (историю, память, роль, настройки)"""
+        return self.chats.pop(chat_id, None) is not None
+
+    def evict_idle_chats(self, max_idle_seconds: float) -> int:
+        """Освобождает историю чатов, неактивных дольше max_idle_seconds (кроме чатов с идущей генерацией).
+
+        Удаляются сообщения, сводки и упакованный контекст; роль, промпт, модель и другие
+        настройки чата (они малы) сохраняются. Чат без настроек удаляется целиком.
+        """
+        deadline = time.monotonic() - max_idle_seconds
+        evicted = 0
+        for chat_id, state in list(self.chats.items()):
+            if state.last_activity >= deadline or state.generating:
+                continue
+            if not self._has_configuration(state):
+                del self.chats[chat_id]
+            elif state.context or state.memory or state.overflow or state.packed:
+                state.context = []
+                state.authors = None
+                state.memory = None
+                state.overflow = None
+                state.packed = None
+                self._touch(state)
+            else:
+                continue
+            evicted += 1
+        if evicted:
+            logger.info(f"Освобождена история {evicted} неактивных чатов")
+        return evicted
+
+    @staticmethod
+    def _has_configuration(state: ChatState) -> bool:
+        """Есть ли у чата настройки, которые нужно сохранить при вытеснении истории"""
+        return any(value is not None for value in (
+            state.system_prompt, state.role, state.context_limit, state.settings, state.auto_analyze
+        ))
+
+    async def cleanup_idle_chats(self):
+        """Периодически освобождает историю неактивных чатов"""
+        while True:
+            try:
+                self.evict_idle_chats(settings.chat_idle_ttl_hours * 3600)
+                # Ждем 10 минут до следующей очистки
+                await asyncio.sleep(600)
+            except Exception as e:
+                logger.error(f"Ошибка в cleanup_idle_chats: {e}")
+                await asyncio.sleep(60)  # Ждем минуту при ошибке
+
+    def start_cleanup_task(self):
+        """Запускает задачу очистки (CHAT_IDLE_TTL_HOURS=0 — чаты не вытесняются)"""
+        if settings.chat_idle_ttl_hours <= 0:
+            return
+        if not self._cleanup_task or self._cleanup_task.done():
+            self._cleanup_task = asyncio.create_task(self.cleanup_idle_chats())
+
+    def stop_cleanup_task(self):
+        """Останавливает задачу очистки"""
+        if self._cleanup_task and not self._cleanup_task.done():
+            self._cleanup_task.cancel()
 
     def add_message(self, chat_id: int, role: str, content: str, author: Optional[Dict[str, Any]] = None):
         """Добавляет сообщение в контекст чата"""
-        self.init_context(chat_id)
-        
-        # Добавляем метаданные к сообщению
-        entry = {
-            "role": role, 
-            "content": content,
-            "timestamp": time.time()
-        }
+        state = self.init_context(chat_id)
         
-        if author is not None:
-            entry["author"] = author
-            
-        self.contexts[chat_id].append(entry)
+        entry = self._make_entry(state, Role.parse(role), content, time.time(), author)
+        state.context.append(entry)
 
         # Ограничиваем размер контекста (последние N сообщений)
         limit = self.get_context_limit(chat_id)
-        if limit > 0 and len(self.contexts[chat_id]) > limit:
+        if limit > 0 and len(state.context) > limit:
             # Удаляем старые сообщения, но сохраняем системный промпт
-            old_messages = self.contexts[chat_id][:-limit]
-            self.contexts[chat_id] = self.contexts[chat_id][-limit:]
+            old_messages = state.context[:-limit]
+            state.context = state.context[-limit:]
             
             # Логируем удаление старых сообщений
             if old_messages:
                 logger.debug(f"Удалено {len(old_messages)} старых сообщений из контекста чата {chat_id}")
+                if settings.summarization_enabled:
+                    # Вытесненные сообщения не теряются — их подберёт суммаризатор
+                    if state.overflow is None:
+                        state.overflow = []
+                    state.overflow.extend(old_messages)
+                    del state.overflow[:-settings.summary_overflow_limit]
         
         # Обновляем статистику
         self._update_usage_stats(chat_id, role)
 
     def get_context(self, chat_id):
-        self.init_context(chat_id)
-        return self.contexts[chat_id].copy()
+        return self.init_context(chat_id).context.copy()
 
-    def build_api_messages(self, chat_id):
+    def build_api_messages(self, chat_id, model: Optional[str] = None):
         """Подготавливает сообщения для API: добавляет системный промпт и имя автора к текстам пользователя.
 
+        Контекст укладывается в бюджет токенов модели (get_token_budget): системный промпт и
+        новые сообщения сохраняются, старые отбрасываются, не поместившееся целиком — сокращается.
+        Граница окна и сумма токенов поддерживаются инкрементально: при неизменной версии чата
+        учитываются только новые и вытесненные записи; сами сообщения окна строятся при каждом вызове.
         Возвращает список словарей вида {"role": str, "content": str}
         """
-        self.init_context(chat_id)
-        api_messages = []
-        
+        state = self.init_context(chat_id)
+        packed = state.packed
+        if packed is None or packed.version != state.version or packed.model != model:
+            packed = state.packed = self._build_prefix(chat_id, state.version, model)
+
+        entries = state.context
+        start = self._advance_window(packed, entries)
+
+        window = [self._api_message(entry) for entry in entries[start:] if entry.is_sent]
+        boundary = self._boundary_message(packed, entries, start if window else len(entries))
+        if boundary is not None:
+            return packed.prefix + [boundary] + window
+        return packed.prefix + window
+
+    def _build_prefix(self, chat_id, version: int, model: Optional[str]) -> _PackedContext:
+        """Собирает системный промпт с учётом настроек чата и память"""
         # Добавляем системный промпт в начало с учётом пользовательских настроек
         current_prompt = self.get_system_prompt(chat_id)
         # Интеграция настроек в поведение модели
@@ -154,30 +299,211 @@ class ContextManager:
         else:
             prompt = current_prompt or pref_text
 
+        prefix = []
+        budget = self.get_token_budget(model or self.get_chat_model(chat_id))
         if prompt:
-            api_messages.append({"role": "system", "content": prompt})
-        
-        for msg in self.contexts[chat_id]:
-            role = msg.get("role")
-            content = msg.get("content", "")
-            
-            # Пропускаем системные сообщения, которые уже добавлены выше
-            if role == "system" and not msg.get("is_image_context"):
+            prefix.append({"role": "system", "content": prompt})
+            budget -= estimate_tokens(prompt)
+
+        # Сводка ранней части диалога — сразу после системного промпта
+        memory = self.get_memory(chat_id)
+        if memory:
+            # Память сокращается первой: место под последнее сообщение (хотя бы сокращённое) остаётся всегда
+            memory_budget = budget - settings.context_min_truncated_tokens
+            if estimate_tokens(memory) > memory_budget:
+                memory = truncate_to_tokens(memory, memory_budget) if memory_budget >= settings.context_min_truncated_tokens else None
+                logger.debug(f"Память чата {chat_id} не помещается в бюджет токенов и сокращена")
+        if memory:
+            prefix.append({"role": "system", "content": memory})
+            budget -= estimate_tokens(memory)
+
+        return _PackedContext(version, model, prefix, budget)
+
+    def _advance_window(self, packed: _PackedContext, entries: List[ContextEntry]) -> int:
+        """Сдвигает границы окна: учитывает новые записи, убирает вытесненные и не помещающиеся в бюджет.
+
+        Возвращает индекс первой записи окна в entries.
+        """
+        if entries and entries[0].seq > packed.start_seq:
+            # Начало окна вытеснено лимитом сообщений — в окне остались все уже учтённые записи
+            packed.start_seq = entries[0].seq
+            packed.tokens = sum(e.tokens for e in entries if e.is_sent and e.seq <= packed.last_seq)
+
+        # Новые записи — хвост контекста после последней учтённой
+        new_start = len(entries)
+        while new_start > 0 and entries[new_start - 1].seq > packed.last_seq:
+            new_start -= 1
+        packed.tokens += sum(e.tokens for e in entries[new_start:] if e.is_sent)
+        if entries:
+            packed.last_seq = max(packed.last_seq, entries[-1].seq)
+
+        # Старые записи, не помещающиеся в бюджет вместе с новыми
+        start = bisect.bisect_left(entries, packed.start_seq, key=lambda e: e.seq)
+        while start < len(entries) and packed.tokens > packed.budget:
+            if entries[start].is_sent:
+                packed.tokens -= entries[start].tokens
+            start += 1
+        packed.start_seq = entries[start].seq if start < len(entries) else packed.last_seq + 1
+        return start
+
+    def _boundary_message(self, packed: _PackedContext, entries: List[ContextEntry],
+                          start: int) -> Optional[Dict[str, str]]:
+        """Сокращённая запись, предшествующая окну (start — индекс первой записи окна, len(entries) — окно пусто).
+
+        Добавляется, если остаток бюджета позволяет сохранить осмысленную часть
+        (или окно пусто — последнее сообщение сокращается всегда, без него отвечать не на что).
+        """
+        remaining = packed.budget - packed.tokens
+        if start < len(entries) and remaining < settings.context_min_truncated_tokens:
+            return None
+        index = start - 1
+        while index >= 0 and not entries[index].is_sent:
+            index -= 1
+        if index < 0:
+            return None
+
+        entry = entries[index]
+        key = (entry.seq, remaining)
+        if packed.boundary_key != key:
+            message = self._api_message(entry)
+            packed.boundary_key = key
+            packed.boundary = {
+                "role": message["role"],
+                "content": truncate_to_tokens(message["content"], max(remaining, 1)),
+            }
+            logger.debug(f"Записи старше {index + 1}-й не поместились в бюджет токенов, {index + 1}-я сокращена")
+        return packed.boundary
+
+    def get_token_budget(self, model: Optional[str] = None) -> int:
+        """Бюджет токенов контекста для модели.
+
+        Без модели (автоматический выбор) — наименьший из бюджетов TEXT_MODELS, чтобы контекст
+        поместился в любую модель, на которую может переключиться маршрутизатор.
+        """
+        budgets = parse_token_budgets(settings.model_token_budgets)
+        if model:
+            return budgets.get(model, settings.context_token_budget)
+        return min(budgets.get(m, settings.context_token_budget) for m in settings.text_models.split(","))
+
+    # ----- Сжатая память (сводки старых сообщений) -----
+    def get_memory(self, chat_id: int) -> Optional[str]:
+        """Текст памяти чата для API или None, если сводок нет"""
+        state = self.chats.get(chat_id)
+        segments = state.memory if state is not None else None
+        if not segments:
+            return None
+        summary = "\n\n".join(segment["content"] for segment in segments)
+        return f"Краткое содержание более ранней части диалога:\n{summary}"
+
+    def get_memory_segments(self, chat_id: int) -> List[Dict[str, Any]]:
+        state = self.chats.get(chat_id)
+        return list(state.memory or []) if state is not None else []
+
+    def get_summary_block(self, chat_id: int) -> List[ContextEntry]:
+        """Возвращает самые старые записи, которые пора свернуть в сводку.
+
+        Это вытесненные по лимиту сообщения и — если история превысила SUMMARY_TRIGGER_TOKENS —
+        старейшие записи контекста объёмом около SUMMARY_BLOCK_TOKENS (кроме SUMMARY_KEEP_RECENT последних).
+        Записи контекста не удаляются до применения сводки (apply_summary).
+        """
+        state = self.chats.get(chat_id)
+        if state is None:
+            return []
+        block = list(state.overflow or [])
+        entries = [e for e in state.context if e.is_sent]
+        history_tokens = sum(e.tokens for e in entries)
+        if history_tokens > settings.summary_trigger_tokens:
+            block_tokens = sum(e.tokens for e in block)
+            for entry in entries[:-settings.summary_keep_recent]:
+                if block_tokens >= settings.summary_block_tokens:
+                    break
+                block.append(entry)
+                block_tokens += entry.tokens
+        return block
+
+    def apply_summary(self, chat_id: int, block: List[ContextEntry], summary: str) -> bool:
+        """Заменяет записи block сводкой. False — если чат сброшен, пока сводка готовилась"""
+        state = self.chats.get(chat_id)
+        if state is None:
+            return False
+        block_ids = {id(entry) for entry in block}
+        overflow = state.overflow or []
+        if not any(id(entry) in block_ids for entry in state.context + overflow):
+            return False
+        state.context = [entry for entry in state.context if id(entry) not in block_ids]
+        state.overflow = [entry for entry in overflow if id(entry) not in block_ids] or None
+        if state.memory is None:
+            state.memory = []
+        state.memory.append({"content": summary, "tokens": estimate_tokens(summary)})
+        self._touch(state)
+        return True
+
+    def replace_memory(self, chat_id: int, segments: List[Dict[str, Any]], summary: str) -> bool:
+        """Заменяет сводки segments одной сводкой следующего уровня"""
+        state = self.chats.get(chat_id)
+        current = (state.memory or []) if state is not None else []
+        segment_ids = {id(segment) for segment in segments}
+        if not any(id(segment) in segment_ids for segment in current):
+            return False
+        remaining = [segment for segment in current if id(segment) not in segment_ids]
+        state.memory = [{"content": summary, "tokens": estimate_tokens(summary)}] + remaining
+        self._touch(state)
+        return True
+
+    def render_entries(self, entries: List[ContextEntry]) -> str:
+        """Текст записей для суммаризации: «автор: текст» построчно"""
+        lines = []
+        for entry in entries:
+            text = self._render_entry(entry)
+            if text is None:
                 continue
-                
-            if role == "user":
-                author = msg.get("author") or {}
-                author_name = author.get("name") or f"user-{author.get('id', '')}".strip("-")
-                username = author.get("username")
-                prefix = f"{author_name} (@{username})" if username else author_name
-                
-                # Дополнительная очистка контента от аудио-метаданных
-                clean_content = self._clean_user_content(content)
-                text = f"{prefix}: {clean_content}" if prefix else clean_content
+            if entry.role is Role.USER:
+                # Текст пользователя уже начинается с имени автора
+                lines.append(text)
             else:
-                text = content
-            api_messages.append({"role": role, "content": text})
-        return api_messages
+                role = "Ассистент" if entry.role is Role.ASSISTANT else "Контекст"
+                lines.append(f"{role}: {text}")
+        return "\n".join(lines)
+
+    def _make_entry(self, state: ChatState, role: Role, content: str, timestamp: float,
+                    author: Optional[Dict[str, Any]] = None) -> ContextEntry:
+        """Создаёт запись: автор берётся из таблицы авторов чата, токены оцениваются один раз"""
+        if author and state.authors is None:
+            state.authors = AuthorTable()
+        interned = state.authors.intern(author) if author else None
+        entry = ContextEntry(role, content, timestamp, interned, next(self._entry_seq))
+        entry.tokens = estimate_tokens(self._render_entry(entry))
+        return entry
+
+    def _api_message(self, entry: ContextEntry) -> Dict[str, str]:
+        """Сообщение API записи. Не хранится в записи — строится, когда запись попадает в окно"""
+        return {"role": entry.role.api_role, "content": self._render_entry(entry)}
+
+    @staticmethod
+    def _touch(state: ChatState) -> None:
+        """Инвалидирует упакованный контекст чата"""
+        state.version += 1
+
+    def _render_entry(self, msg: ContextEntry) -> Optional[str]:
+        """Текст записи контекста в том виде, в котором он уходит в API (None — запись не отправляется)"""
+        role = msg.role
+        content = msg.content or ""
+
+        # Пропускаем системные сообщения, которые уже добавлены в начало
+        if role is Role.SYSTEM:
+            return None
+
+        if role is Role.USER:
+            author = msg.author
+            author_id = author.id if author is not None and author.id is not None else ""
+            author_name = (author.name if author is not None else None) or f"user-{author_id}".strip("-")
+            username = author.username if author is not None else None
+            prefix = f"{author_name} (@{username})" if username else author_name
+
+            # Дополнительная очистка контента от аудио-метаданных
+            clean_content = self._clean_user_content(content)
+            return f"{prefix}: {clean_content}" if prefix else clean_content
+        return content
 
     def _clean_user_content(self, content: str) -> str:
         """Очищает контент пользователя от возможных аудио-метаданных"""
@@ -214,19 +540,23 @@ class ContextManager:
 
     def set_generating(self, chat_id, status, operation_type="text"):
         """Устанавливает флаг генерации для конкретного типа операции"""
-        self.init_context(chat_id)
+        state = self.init_context(chat_id)
         if status:
-            self.generating_flags[chat_id][operation_type] = True
-        else:
-            self.generating_flags[chat_id].pop(operation_type, None)
+            if state.generating is None:
+                state.generating = {}
+            state.generating[operation_type] = True
+        elif state.generating:
+            state.generating.pop(operation_type, None)
 
     def is_generating(self, chat_id, operation_type="text"):
         """Проверяет, выполняется ли операция указанного типа"""
-        return self.generating_flags.get(chat_id, {}).get(operation_type, False)
+        state = self.chats.get(chat_id)
+        return bool(state and state.generating and state.generating.get(operation_type, False))
     
     def is_any_generating(self, chat_id):
         """Проверяет, выполняется ли любая операция в чате"""
-        return bool(self.generating_flags.get(chat_id, {}))
+        state = self.chats.get(chat_id)
+        return bool(state and state.generating)
     
     def check_rate_limit(self, user_id: int, chat_id: int = None, min_interval: float = 1.0) -> bool:
         """Проверяет rate limiting для пользователя (делегирует в RateLimiter)"""
@@ -235,17 +565,15 @@ class ContextManager:
     
     def set_system_prompt(self, chat_id, prompt: str):
         """Устанавливает системный промпт для конкретного чата"""
-        if prompt is None:
-            # Если передан None — очищаем переопределение
-            self.chat_system_prompts.pop(chat_id, None)
-        else:
-            # Валидация промпта
-            if not self._validate_prompt(prompt):
-                raise ValueError("Недопустимый промпт")
-            self.chat_system_prompts[chat_id] = prompt
+        # Валидация промпта (None — очищаем переопределение)
+        if prompt is not None and not self._validate_prompt(prompt):
+            raise ValueError("Недопустимый промпт")
+        state = self.init_context(chat_id)
+        state.system_prompt = prompt
         logger.info(f"Системный промпт обновлен для чата {chat_id}")
         # При прямой установке промпта роль становится 'custom'
-        self.chat_roles[chat_id] = "custom"
+        state.role = "custom"
+        self._touch(state)
 
     def _validate_prompt(self, prompt: str) -> bool:
         """Валидирует системный промпт"""
@@ -276,11 +604,14 @@ class ContextManager:
     
     def get_system_prompt(self, chat_id) -> str:
         """Возвращает текущий системный промпт для чата (или значение по умолчанию)"""
+        state = self.chats.get(chat_id)
+        if state is None:
+            return self.default_system_prompt
         # Если есть явный промпт — вернуть его
-        if chat_id in self.chat_system_prompts:
-            return self.chat_system_prompts[chat_id]
+        if state.system_prompt is not None:
+            return state.system_prompt
         # Если выбрана предустановленная роль — вернуть её текст
-        role = self.chat_roles.get(chat_id)
+        role = state.role
         if role and role in self.predefined_roles:
             return self.predefined_roles[role]
         # Иначе — дефолт
@@ -288,12 +619,12 @@ class ContextManager:
     
     def reset_system_prompt(self, chat_id):
         """Сбрасывает системный промпт для чата к значению по умолчанию"""
-        if chat_id in self.chat_system_prompts:
-            self.chat_system_prompts.pop(chat_id, None)
+        state = self.init_context(chat_id)
+        state.system_prompt = None
         logger.info(f"Системный промпт для чата {chat_id} сброшен к значению по умолчанию")
         # Сбрасываем роль
-        if chat_id in self.chat_roles:
-            self.chat_roles.pop(chat_id, None)
+        state.role = None
+        self._touch(state)
 
     # ----- Роли (персоны) -----
     def get_available_roles(self):
@@ -302,43 +633,45 @@ class ContextManager:
     def set_role(self, chat_id, role_key: str):
         if role_key not in self.predefined_roles:
             raise ValueError("Неизвестная роль")
-        self.chat_roles[chat_id] = role_key
+        state = self.init_context(chat_id)
+        state.role = role_key
         # Удаляем кастомный промпт, если был, чтобы роль применялась
-        self.chat_system_prompts.pop(chat_id, None)
+        state.system_prompt = None
+        self._touch(state)
         logger.info(f"Для чата {chat_id} установлена роль: {role_key}")
 
     def get_role(self, chat_id) -> str:
-        return self.chat_roles.get(chat_id, "default")
+        state = self.chats.get(chat_id)
+        return (state.role if state is not None else None) or "default"
 
     def reset_role(self, chat_id):
-        self.chat_roles.pop(chat_id, None)
+        state = self.init_context(chat_id)
+        state.role = None
+        self._touch(state)
         logger.info(f"Для чата {chat_id} роль сброшена")
 
     def add_image_context(self, chat_id: int, image_analysis: str):
         """Добавляет информацию об изображении в контекст как системное сообщение"""
-        self.init_context(chat_id)
+        state = self.init_context(chat_id)
         
         # Создаем системное сообщение с информацией об изображении
         image_context = f"ВАЖНО: У пользователя есть изображение в контексте диалога. Анализ изображения: {image_analysis}\n\nТы МОЖЕШЬ видеть и анализировать это изображение. Отвечай на вопросы пользователя с учетом этой информации об изображении. НЕ говори, что не можешь видеть изображения - у тебя есть полная информация о нем."
         
         # Добавляем как системное сообщение
-        entry = {
-            "role": "system", 
-            "content": image_context,
-            "timestamp": time.time(),
-            "is_image_context": True  # Флаг для идентификации контекста изображения
-        }
-        
-        self.contexts[chat_id].append(entry)
+        entry = self._make_entry(state, Role.IMAGE, image_context, time.time())
+        state.context.append(entry)
         logger.info(f"Добавлен контекст изображения для чата {chat_id}")
 
     # ----- Управление лимитом контекста -----
     def get_context_limit(self, chat_id) -> int:
         # Приоритет значения в настройках чата, затем локальное переопределение, затем глобальное
-        s = self.chat_settings.get(chat_id)
+        state = self.chats.get(chat_id)
+        if state is None:
+            return self.context_limit
+        s = state.settings
         if s and isinstance(s.get("context_limit"), int):
             return s["context_limit"]
-        return self.chat_context_limits.get(chat_id, self.context_limit)
+        return state.context_limit if state.context_limit is not None else self.context_limit
 
     def set_context_limit(self, chat_id, limit: int):
         if not isinstance(limit, int):
@@ -348,60 +681,66 @@ class ContextManager:
         # Можно ограничить верхнюю границу во избежание переполнений
         if limit > 500:
             limit = 500
-        self.chat_context_limits[chat_id] = limit
+        self.init_context(chat_id).context_limit = limit
         logger.info(f"Для чата {chat_id} установлен лимит контекста: {limit}")
 
     def reset_context_limit(self, chat_id):
-        if chat_id in self.chat_context_limits:
-            self.chat_context_limits.pop(chat_id, None)
+        state = self.chats.get(chat_id)
+        if state is not None:
+            state.context_limit = None
         logger.info(f"Для чата {chat_id} сброшен лимит контекста к значению по умолчанию: {self.context_limit}")
 
     def trim_context(self, chat_id) -> int:
         """Приводит текущий контекст к текущему лимиту. Возвращает число удалённых сообщений."""
-        self.init_context(chat_id)
+        state = self.init_context(chat_id)
         limit = self.get_context_limit(chat_id)
-        before = len(self.contexts[chat_id])
+        before = len(state.context)
         if limit > 0 and before > limit:
-            self.contexts[chat_id] = self.contexts[chat_id][-limit:]
-        after = len(self.contexts[chat_id])
+            state.context = state.context[-limit:]
+        after = len(state.context)
         return max(0, before - after)
 
     # ----- Очистка служебных сообщений -----
     def add_cleanup_message(self, chat_id: int, message_id: int):
         """Добавляет сообщение в список для автоматического удаления после успешного ответа"""
-        messages = self.cleanup_message_ids.get(chat_id)
-        if messages is None:
-            messages = []
-            self.cleanup_message_ids[chat_id] = messages
-        messages.append(message_id)
+        state = self.init_context(chat_id)
+        if state.cleanup_message_ids is None:
+            state.cleanup_message_ids = []
+        state.cleanup_message_ids.append(message_id)
         logger.debug(f"Добавлено сообщение {message_id} в список очистки для чата {chat_id}")
 
     def consume_cleanup_messages(self, chat_id: int):
         """Возвращает и очищает список сообщений для удаления"""
-        messages = self.cleanup_message_ids.get(chat_id, [])
+        state = self.chats.get(chat_id)
+        if state is None or not state.cleanup_message_ids:
+            return []
+        messages = state.cleanup_message_ids
         # Сбросить список, чтобы не удалять повторно
-        self.cleanup_message_ids[chat_id] = []
+        state.cleanup_message_ids = None
         if messages:
             logger.debug(f"Очистка {len(messages)} сообщений для чата {chat_id}")
         return messages
 
     def clear_cleanup_messages(self, chat_id: int):
         """Очищает список сообщений для удаления без возврата (например, при ошибке)"""
-        if chat_id in self.cleanup_message_ids:
-            count = len(self.cleanup_message_ids[chat_id])
-            self.cleanup_message_ids[chat_id] = []
+        state = self.chats.get(chat_id)
+        if state is not None and state.cleanup_message_ids is not None:
+            count = len(state.cleanup_message_ids)
+            state.cleanup_message_ids = None
             if count > 0:
                 logger.debug(f"Очищен список из {count} сообщений для чата {chat_id}")
 
     def get_cleanup_count(self, chat_id: int) -> int:
         """Возвращает количество сообщений в очереди на удаление"""
-        return len(self.cleanup_message_ids.get(chat_id, []))
+        state = self.chats.get(chat_id)
+        return len(state.cleanup_message_ids or []) if state is not None else 0
 
     # ----- Статистика и мониторинг -----
     def _update_usage_stats(self, chat_id: int, role: str):
         """Обновляет статистику использования"""
-        if chat_id not in self.usage_stats:
-            self.usage_stats[chat_id] = {
+        state = self.init_context(chat_id)
+        if state.usage is None:
+            state.usage = {
                 "total_messages": 0,
                 "user_messages": 0,
                 "assistant_messages": 0,
@@ -409,7 +748,7 @@ class ContextManager:
                 "roles_used": {}
             }
         
-        stats = self.usage_stats[chat_id]
+        stats = state.usage
         stats["total_messages"] += 1
         stats["last_activity"] = time.time()
         
@@ -426,38 +765,41 @@ class ContextManager:
 
     def get_usage_stats(self, chat_id: int) -> Optional[Dict[str, Any]]:
         """Возвращает статистику использования для чата"""
-        return self.usage_stats.get(chat_id)
+        state = self.chats.get(chat_id)
+        return state.usage if state is not None else None
 
     def get_context_size(self, chat_id: int) -> int:
         """Возвращает текущий размер контекста"""
-        self.init_context(chat_id)
-        return len(self.contexts[chat_id])
+        return len(self.init_context(chat_id).context)
 
     def get_context_summary(self, chat_id: int) -> Dict[str, Any]:
         """Возвращает краткую сводку контекста"""
-        self.init_context(chat_id)
-        context = self.contexts[chat_id]
+        state = self.init_context(chat_id)
+        context = state.context
         
         return {
             "total_messages": len(context),
-            "user_messages": len([msg for msg in context if msg.get("role") == "user"]),
-            "assistant_messages": len([msg for msg in context if msg.get("role") == "assistant"]),
+            "user_messages": len([msg for msg in context if msg.role is Role.USER]),
+            "assistant_messages": len([msg for msg in context if msg.role is Role.ASSISTANT]),
             "current_role": self.get_role(chat_id),
             "context_limit": self.get_context_limit(chat_id),
             "is_generating": self.is_any_generating(chat_id),
-            "generating_operations": list(self.generating_flags.get(chat_id, {}).keys())
+            "generating_operations": list(state.generating or {})
         }
 
     def get_settings(self, chat_id: int) -> Dict[str, Any]:
         """Возвращает настройки чата с применением значений по умолчанию."""
         s = dict(self.default_settings)
-        s.update(self.chat_settings.get(chat_id, {}))
+        state = self.chats.get(chat_id)
+        if state is not None and state.settings:
+            s.update(state.settings)
         return s
 
     def update_settings(self, chat_id: int, **kwargs) -> Dict[str, Any]:
         """Обновляет настройки чата. Возвращает актуальные настройки."""
         allowed_keys = set(self.default_settings.keys())
-        current = self.chat_settings.get(chat_id, {}).copy()
+        state = self.init_context(chat_id)
+        current = dict(state.settings or {})
         for k, v in kwargs.items():
             if k in allowed_keys:
                 if k == "context_limit":
@@ -469,23 +811,33 @@ class ContextManager:
                             iv = 500
                         current[k] = iv
                         # Синхронизируем с отдельным переопределением
-                        self.chat_context_limits[chat_id] = iv
+                        state.context_limit = iv
                     except Exception:
                         continue
                 else:
                     current[k] = v
-        self.chat_settings[chat_id] = current
+        state.settings = current
+        self._touch(state)
         return self.get_settings(chat_id)
 
+    def get_chat_model(self, chat_id: int) -> Optional[str]:
+        """Модель текстовых ответов, закреплённая для чата; None — автоматический выбор"""
+        model = self.get_settings(chat_id).get("model", "auto")
+        # Модель могла быть убрана из TEXT_MODELS после того, как её выбрали
+        if model == "auto" or model not in settings.text_models.split(","):
+            return None
+        return model
+
     def export_context(self, chat_id: int) -> str:
         """Экспортирует контекст в JSON"""
-        self.init_context(chat_id)
+        state = self.init_context(chat_id)
         context_data = {
             "chat_id": chat_id,
-            "context": self.contexts[chat_id],
+            "context": [entry.to_dict() for entry in state.context],
             "system_prompt": self.get_system_prompt(chat_id),
             "role": self.get_role(chat_id),
             "context_limit": self.get_context_limit(chat_id),
+            "memory": [segment["content"] for segment in state.memory or []],
             "export_timestamp": time.time()
         }
         return json.dumps(context_data, ensure_ascii=False, indent=2)
@@ -494,7 +846,18 @@ class ContextManager:
         """Импортирует контекст из JSON"""
         try:
             data = json.loads(context_data)
-            self.contexts[chat_id] = data.get("context", [])
+            state = self.init_context(chat_id)
+            state.authors = None
+            state.context = [
+                self._make_entry(
+                    state,
+                    Role.parse(entry["role"], entry.get("is_image_context", False)),
+                    entry.get("content", ""),
+                    entry.get("timestamp", time.time()),
+                    entry.get("author"),
+                )
+                for entry in data.get("context", [])
+            ]
             
             if "system_prompt" in data:
                 self.set_system_prompt(chat_id, data["system_prompt"])
@@ -504,6 +867,11 @@ class ContextManager:
             
             if "context_limit" in data:
                 self.set_context_limit(chat_id, data["context_limit"])
+
+            state.memory = [
+                {"content": summary, "tokens": estimate_tokens(summary)} for summary in data.get("memory", [])
+            ] or None
+            self._touch(state)
             
             logger.info(f"Контекст импортирован для чата {chat_id}")
             return True
@@ -515,11 +883,14 @@ class ContextManager:
         """Проверяет, включен ли автоанализ изображений для чата"""
         from config.settings import settings
         # Если настройка не задана для чата, используем глобальную настройку
-        return self.auto_analyze_settings.get(chat_id, settings.auto_analyze_generated_images)
+        state = self.chats.get(chat_id)
+        if state is None or state.auto_analyze is None:
+            return settings.auto_analyze_generated_images
+        return state.auto_analyze
 
     def set_auto_analyze(self, chat_id: int, enabled: bool) -> None:
         """Устанавливает настройку автоанализа изображений для чата"""
-        self.auto_analyze_settings[chat_id] = enabled
+        self.init_context(chat_id).auto_analyze = enabled
         logger.info(f"Автоанализ изображений {'включен' if enabled else 'отключен'} для чата {chat_id}")
 
     def toggle_auto_analyze(self, chat_id: int) -> bool:
@@ -531,23 +902,28 @@ class ContextManager:
 
     def set_user_state(self, chat_id: int, state_type: str, state_data: Dict[str, Any]) -> None:
         """Устанавливает состояние пользователя для многошагового процесса"""
-        if chat_id not in self.user_states:
-            self.user_states[chat_id] = {}
-        self.user_states[chat_id][state_type] = state_data
+        state = self.init_context(chat_id)
+        if state.user_states is None:
+            state.user_states = {}
+        state.user_states[state_type] = state_data
         logger.debug(f"Установлено состояние {state_type} для чата {chat_id}: {state_data}")
 
     def get_user_state(self, chat_id: int, state_type: str) -> Optional[Dict[str, Any]]:
         """Получает состояние пользователя"""
-        return self.user_states.get(chat_id, {}).get(state_type)
+        state = self.chats.get(chat_id)
+        if state is None or not state.user_states:
+            return None
+        return state.user_states.get(state_type)
 
     def clear_user_state(self, chat_id: int, state_type: str = None) -> None:
         """Очищает состояние пользователя. Если state_type не указан, очищает все состояния"""
-        if chat_id in self.user_states:
+        state = self.chats.get(chat_id)
+        if state is not None and state.user_states is not None:
             if state_type:
-                self.user_states[chat_id].pop(state_type, None)
+                state.user_states.pop(state_type, None)
                 logger.debug(f"Очищено состояние {state_type} для чата {chat_id}")
             else:
-                self.user_states[chat_id].clear()
+                state.user_states = None
                 logger.debug(f"Очищены все состояния для чата {chat_id}")
 
     def has_user_state(self, chat_id: int, state_type: str) -> bool:
@@ -556,7 +932,7 @@ class ContextManager:
 
     def set_force_stop(self, chat_id: int, stop: bool = True) -> None:
         """Устанавливает флаг принудительной остановки для чата"""
-        self.force_stop_flags[chat_id] = stop
+        self.init_context(chat_id).force_stop = stop
         if stop:
             logger.info(f"Установлен флаг принудительной остановки для чата {chat_id}")
         else:
@@ -564,11 +940,14 @@ class ContextManager:
 
     def is_force_stop_requested(self, chat_id: int) -> bool:
         """Проверяет, запрошена ли принудительная остановка для чата"""
-        return self.force_stop_flags.get(chat_id, False)
+        state = self.chats.get(chat_id)
+        return state is not None and state.force_stop
 
     def clear_force_stop(self, chat_id: int) -> None:
         """Снимает флаг принудительной остановки для чата"""
-        self.force_stop_flags.pop(chat_id, None)
+        state = self.chats.get(chat_id)
+        if state is not None:
+            state.force_stop = False
         logger.debug(f"Снят флаг принудительной остановки для чата {chat_id}")
 
     def force_stop_all_operations(self, chat_id: int) -> None:
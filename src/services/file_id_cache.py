@@ -0,0 +1,79 @@
+"""
+Кэш file_id Telegram для повторной отправки уже загруженных изображений
+"""
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+from config.settings import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class FileIdCache:
+    """Сопоставляет хеш содержимого и ключ генерации с file_id, который вернул Telegram.
+
+    file_id можно отправлять в любой чат того же бота, поэтому повторная отправка
+    того же изображения не требует загрузки байтов.
+    """
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self._file_ids: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def content_key(content: bytes) -> str:
+        return f"sha:{hashlib.sha256(content).hexdigest()}"
+
+    @staticmethod
+    def generation_key(key: str) -> str:
+        return f"gen:{key}"
+
+    def build_keys(self, content: Optional[bytes] = None, generation_key: Optional[str] = None) -> List[str]:
+        keys = []
+        if generation_key:
+            keys.append(self.generation_key(generation_key))
+        if content:
+            keys.append(self.content_key(content))
+        return keys
+
+    def get(self, keys: Iterable[str]) -> Optional[str]:
+        """Возвращает file_id по первому найденному ключу"""
+        for key in keys:
+            file_id = self._file_ids.get(key)
+            if file_id is not None:
+                self._file_ids.move_to_end(key)
+                self.hits += 1
+                return file_id
+        self.misses += 1
+        return None
+
+    def put(self, file_id: str, keys: Iterable[str]) -> None:
+        for key in keys:
+            self._file_ids[key] = file_id
+            self._file_ids.move_to_end(key)
+        while len(self._file_ids) > self.max_items:
+            self._file_ids.popitem(last=False)
+
+    def invalidate(self, file_id: str) -> None:
+        """Удаляет все ключи, указывающие на file_id (например, если Telegram его отклонил)"""
+        stale = [key for key, value in self._file_ids.items() if value == file_id]
+        for key in stale:
+            self._file_ids.pop(key, None)
+        if stale:
+            logger.info(f"file_id удалён из кэша ({len(stale)} ключей)")
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "items": len(self._file_ids),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# Глобальный экземпляр кэша file_id
+file_id_cache = FileIdCache(max_items=settings.file_id_cache_size)
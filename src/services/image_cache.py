@@ -0,0 +1,49 @@
+"""
+Двухуровневый кэш сгенерированных изображений: LRU в памяти + контентно-адресуемое хранилище на диске
+"""
+import hashlib
+import json
+from typing import Optional
+
+from config.settings import settings
+from services.tiered_cache import TieredCache
+
+
+class ImageCache(TieredCache):
+    """Кэш изображений по нормализованным параметрам генерации.
+
+    Память ограничена суммарным размером изображений, диск — disk_limit_bytes.
+    Одинаковые изображения под разными ключами хранятся на диске один раз.
+    """
+
+    def __init__(self, cache_dir: str, memory_limit_bytes: int, disk_limit_bytes: int):
+        super().__init__(
+            "images",
+            memory_limit_bytes=memory_limit_bytes,
+            cache_dir=cache_dir,
+            disk_limit_bytes=disk_limit_bytes,
+        )
+
+    @staticmethod
+    def make_key(prompt: str, width: int, height: int, seed: Optional[int], model: Optional[str] = None) -> str:
+        """Строит ключ по нормализованным параметрам генерации"""
+        normalized = {
+            "prompt": " ".join((prompt or "").split()),
+            "width": int(width),
+            "height": int(height),
+            "seed": int(seed) if seed is not None else None,
+            "model": model or "",
+        }
+        canonical = json.dumps(normalized, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _encode(self, value: bytes) -> bytes:
+        return bytes(value)
+
+
+# Глобальный экземпляр кэша изображений
+image_cache = ImageCache(
+    cache_dir=settings.image_cache_dir,
+    memory_limit_bytes=settings.image_cache_memory_mb * 1024 * 1024,
+    disk_limit_bytes=settings.image_cache_disk_mb * 1024 * 1024,
+)
@@ -0,0 +1,55 @@
+"""
+Кэш результатов обработки медиа (транскрипции, анализ изображений) по file_unique_id Telegram
+"""
+import hashlib
+import json
+from typing import Any, Optional
+
+from config.settings import settings
+from services.tiered_cache import TieredCache
+
+
+class ResultCache(TieredCache):
+    """Ограниченный кэш текстовых результатов: LRU в памяти + необязательное хранилище на диске.
+
+    file_unique_id одинаков у всех копий файла (в том числе пересланных и в разных чатах),
+    поэтому повторная обработка того же файла не требует скачивания и запросов к API.
+    """
+
+    def __init__(self, name: str, max_items: int, ttl_seconds: Optional[float] = None,
+                 cache_dir: Optional[str] = None, disk_max_items: int = 0):
+        super().__init__(
+            name,
+            max_items=max_items,
+            ttl_seconds=ttl_seconds,
+            cache_dir=cache_dir,
+            disk_max_items=disk_max_items or None,
+        )
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        """Строит ключ из частей (file_unique_id, вопрос, системный промпт...)"""
+        canonical = json.dumps(parts, ensure_ascii=False, separators=(",", ":"), default=str)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _encode(self, value: str) -> bytes:
+        return value.encode("utf-8")
+
+    def _decode(self, data: bytes) -> str:
+        return data.decode("utf-8")
+
+
+# Кэш транскрипций голосовых сообщений по voice.file_unique_id
+transcription_cache = ResultCache(
+    name="transcriptions",
+    max_items=settings.transcription_cache_size,
+    cache_dir=settings.transcription_cache_dir,
+    disk_max_items=settings.transcription_cache_disk_items,
+)
+
+# Кэш анализа изображений по photo.file_unique_id и вопросу/системному промпту
+image_analysis_cache = ResultCache(
+    name="image_analysis",
+    max_items=settings.image_analysis_cache_size,
+    ttl_seconds=settings.image_analysis_cache_ttl_hours * 3600,
+)
@@ -0,0 +1,162 @@
+"""
+Маршрутизация запросов между моделями Pollinations с учётом задержки и доли ошибок
+"""
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from config.settings import settings
+from services.resilience import CircuitOpenError, OverloadedError, classify_error
+
+
+logger = logging.getLogger(__name__)
+
+
+def guard_name(task: str, model: str) -> str:
+    """Имя EndpointGuard для модели: у каждой модели свой circuit breaker и лимит"""
+    return f"{task}/{model}"
+
+
+def parse_models(value: str) -> List[str]:
+    """Разбирает список моделей из настройки (через запятую)"""
+    return [m.strip() for m in value.split(",") if m.strip()]
+
+
+class ModelStats:
+    """Скользящие (EWMA) задержка и доля ошибок модели"""
+
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.last_failure = 0.0
+
+    def observe_success(self, latency: float) -> None:
+        self.requests += 1
+        self.latency = latency if self.latency is None else (1 - self.alpha) * self.latency + self.alpha * latency
+        self.error_rate = (1 - self.alpha) * self.error_rate
+
+    def observe_failure(self) -> None:
+        self.requests += 1
+        self.failures += 1
+        self.last_failure = time.monotonic()
+        self.error_rate = (1 - self.alpha) * self.error_rate + self.alpha
+
+
+class ModelRouter:
+    """Выбирает модель для задачи (text, vision, audio) из списка кандидатов.
+
+    Здоровые модели упорядочиваются по средней задержке (ещё не измеренные — в порядке
+    из настроек), модели с долей ошибок выше error_threshold — в конец списка, пока
+    с последнего отказа не прошло recovery_seconds. При отказе запрос повторяется
+    на следующей модели.
+    """
+
+    def __init__(self, candidates: Dict[str, List[str]], error_threshold: float, recovery_seconds: float,
+                 alpha: float = 0.2):
+        self._candidates = candidates
+        self.error_threshold = error_threshold
+        self.recovery_seconds = recovery_seconds
+        self.alpha = alpha
+        self._stats: Dict[str, Dict[str, ModelStats]] = {}
+        self.fallbacks = 0
+
+    def models(self, task: str) -> List[str]:
+        """Настроенные модели задачи"""
+        return list(self._candidates.get(task, []))
+
+    def candidates(self, task: str, preferred: Optional[str] = None) -> List[str]:
+        """Модели в порядке попыток; preferred (переопределение чата) — первой"""
+        configured = self.models(task)
+        order = {model: index for index, model in enumerate(configured)}
+        ranked = sorted(configured, key=lambda model: (
+            not self.is_healthy(task, model),
+            self._latency(task, model),
+            order[model],
+        ))
+        if preferred:
+            ranked = [preferred] + [model for model in ranked if model != preferred]
+        return ranked
+
+    def is_healthy(self, task: str, model: str) -> bool:
+        stats = self._stats.get(task, {}).get(model)
+        if stats is None or stats.error_rate < self.error_threshold:
+            return True
+        return time.monotonic() - stats.last_failure >= self.recovery_seconds
+
+    def record_success(self, task: str, model: str, latency: float) -> None:
+        self._model_stats(task, model).observe_success(latency)
+
+    def record_failure(self, task: str, model: str) -> None:
+        self._model_stats(task, model).observe_failure()
+
+    async def call(self, task: str, factory: Callable[[str], Awaitable[Any]], preferred: Optional[str] = None) -> Any:
+        """Выполняет factory(model) на лучшей модели, при отказе — на следующей.
+
+        Ошибки запроса (4xx, кроме 408/429) не зависят от модели и пробрасываются сразу.
+        """
+        candidates = self.candidates(task, preferred)
+        for index, model in enumerate(candidates):
+            is_last = index == len(candidates) - 1
+            started = time.monotonic()
+            try:
+                result = await factory(model)
+            except (CircuitOpenError, OverloadedError):
+                # Модель уже признана недоступной — отказ без обращения к сети
+                if is_last:
+                    raise
+            except Exception as e:
+                retryable, _ = classify_error(e)
+                if not retryable:
+                    raise
+                self.record_failure(task, model)
+                if is_last:
+                    raise
+                logger.warning(f"{task}: модель {model} не ответила ({e!r}), пробуем {candidates[index + 1]}")
+            else:
+                self.record_success(task, model, time.monotonic() - started)
+                return result
+            self.fallbacks += 1
+        raise CircuitOpenError(f"{task}: нет доступных моделей")
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = {"fallbacks": self.fallbacks}
+        for task in self._candidates:
+            stats[task] = {
+                model: {
+                    "latency_ms": round(s.latency * 1000) if s.latency is not None else None,
+                    "error_rate_percent": round(s.error_rate * 100, 1),
+                    "requests": s.requests,
+                    "healthy": self.is_healthy(task, model),
+                }
+                for model, s in self._stats.get(task, {}).items()
+            }
+        return stats
+
+    def _model_stats(self, task: str, model: str) -> ModelStats:
+        task_stats = self._stats.setdefault(task, {})
+        stats = task_stats.get(model)
+        if stats is None:
+            stats = ModelStats(self.alpha)
+            task_stats[model] = stats
+        return stats
+
+    def _latency(self, task: str, model: str) -> float:
+        stats = self._stats.get(task, {}).get(model)
+        if stats is None or stats.latency is None:
+            return float("inf")
+        return stats.latency
+
+
+# Глобальный экземпляр
+model_router = ModelRouter(
+    candidates={
+        "text": parse_models(settings.text_models),
+        "vision": parse_models(settings.vision_models),
+        "audio": parse_models(settings.audio_models),
+    },
+    error_threshold=settings.model_error_threshold,
+    recovery_seconds=settings.model_recovery_seconds,
+)
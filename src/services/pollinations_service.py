@@ -4,46 +4,149 @@ import requests
 import aiohttp
 import asyncio
 import base64
+import hashlib
 import json
+import time
 import urllib.parse
-from typing import Optional, Tuple
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from config.settings import settings
+from services.image_cache import image_cache
+from services.model_router import model_router, guard_name
+from services.token_pool import token_pool
+from services.resilience import resilience, text_hedger, UpstreamError, CircuitOpenError, OverloadedError, parse_retry_after
+from utils.audio_utils import AudioConversionError, detect_silences, encode_for_transcription, plan_chunks
+from utils.image_utils import prepare_image_for_vision
+from utils.single_flight import SingleFlight
 
 
 logger = logging.getLogger(__name__)
 
-# Глобальная сессия aiohttp для переиспользования
-_http_session = None
-_connector = None
+# Объединение одинаковых одновременных запросов к Pollinations
+_single_flight = SingleFlight()
+
+# Эндпоинт транскрипции (модели — settings.audio_models)
+_TRANSCRIPTION_URL = "https://text.pollinations.ai/openai"
+
+# Формат загрузки аудио, который приняла каждая модель транскрипции (модель -> формат)
+_audio_format_by_model = {}
+
+
+class UnsupportedAudioFormatError(Exception):
+    """Эндпоинт транскрипции отклонил формат аудио"""
+
+
+class _MediaProcessingError(Exception):
+    """Локальная ошибка подготовки аудио (ffmpeg) внутри запроса к модели.
+
+    Для model_router это ошибка запроса: она не засчитывается модели и не повторяется на других.
+    """
+
+    def __init__(self, error: BaseException):
+        super().__init__(repr(error))
+        self.error = error
 
-async def get_http_session():
-    """Получает или создает глобальную HTTP сессию с пулом соединений"""
-    global _http_session, _connector
-    if _http_session is None or _http_session.closed:
+
+# Отдельные сессии aiohttp (пул соединений + таймауты) для каждого вида трафика:
+# всплеск /imagine или загрузок аудио не должен занимать соединения текстовых ответов
+_http_sessions: Dict[str, aiohttp.ClientSession] = {}
+_connectors: Dict[str, aiohttp.TCPConnector] = {}
+
+
+def _endpoint_http_config(endpoint: str) -> Tuple[int, aiohttp.ClientTimeout]:
+    """Размер пула и таймауты для эндпоинта (text, vision, audio, image)"""
+    pool_sizes = {
+        "text": settings.text_pool_size,
+        "vision": settings.vision_pool_size,
+        "audio": settings.audio_pool_size,
+        "image": settings.image_pool_size,
+    }
+    totals = {
+        "text": settings.api_timeout,
+        "vision": settings.vision_timeout,
+        "audio": settings.audio_timeout,
+        "image": settings.image_timeout,
+    }
+    total = totals.get(endpoint, settings.api_timeout)
+    timeout = aiohttp.ClientTimeout(
+        total=total,
+        connect=settings.http_connect_timeout,
+        # Для стриминга — максимальная пауза между частями ответа
+        sock_read=total,
+    )
+    return pool_sizes.get(endpoint, settings.text_pool_size), timeout
+
+
+async def get_http_session(endpoint: str = "text"):
+    """Получает или создает HTTP сессию эндпоинта с собственным пулом соединений"""
+    session = _http_sessions.get(endpoint)
+    if session is None or session.closed:
+        pool_size, timeout = _endpoint_http_config(endpoint)
         # Создаем коннектор с пулом соединений для параллельных запросов
-        _connector = aiohttp.TCPConnector(
-            limit=500,  # УВЕЛИЧИЛИ: Общий лимит соединений
-            limit_per_host=100,  # УВЕЛИЧИЛИ: Лимит соединений на хост (было 30)
+        connector = aiohttp.TCPConnector(
+            limit=pool_size,
+            limit_per_host=pool_size,
             ttl_dns_cache=300,  # Кэш DNS на 5 минут
             use_dns_cache=True,
             force_close=False,  # НЕ закрывать соединения принудительно
             enable_cleanup_closed=True,  # Очищать закрытые соединения
         )
-        timeout = aiohttp.ClientTimeout(total=60)
-        _http_session = aiohttp.ClientSession(
-            connector=_connector,
+        session = aiohttp.ClientSession(
+            connector=connector,
             timeout=timeout
         )
-    return _http_session
+        _connectors[endpoint] = connector
+        _http_sessions[endpoint] = session
+    return session
 
 async def close_http_session():
-    """Закрывает глобальную HTTP сессию и коннектор"""
-    global _http_session, _connector
-    if _http_session and not _http_session.closed:
-        await _http_session.close()
-        _http_session = None
-    if _connector and not _connector.closed:
-        await _connector.close()
-        _connector = None
+    """Закрывает HTTP сессии и коннекторы всех эндпоинтов"""
+    for endpoint, session in list(_http_sessions.items()):
+        if not session.closed:
+            await session.close()
+        _http_sessions.pop(endpoint, None)
+    for endpoint, connector in list(_connectors.items()):
+        if not connector.closed:
+            await connector.close()
+        _connectors.pop(endpoint, None)
+
+
+def _bearer_token(headers: dict) -> str:
+    return headers.get("Authorization", "").removeprefix("Bearer ")
+
+
+def _with_token(headers: dict, token: str) -> dict:
+    return {**headers, "Authorization": f"Bearer {token}"}
+
+
+async def _post_json(endpoint: str, url: str, headers: dict, payload: dict) -> dict:
+    """POST-запрос с JSON; ответ не 200 превращается в UpstreamError с текстом ответа и Retry-After.
+
+    Токен берётся из пула token_pool (каждый повтор может получить другой токен).
+    """
+    session = await get_http_session(endpoint)
+    with token_pool.lease(_bearer_token(headers)) as lease:
+        async with session.post(url, headers=_with_token(headers, lease.token), json=payload) as response:
+            lease.observe(response.status, response.headers.get("Retry-After"))
+            if response.status != 200:
+                error_text = await response.text()
+                raise UpstreamError(
+                    error_text,
+                    status=response.status,
+                    retry_after=parse_retry_after(response.headers.get("Retry-After"))
+                )
+            return await response.json()
+
+
+def _post_sync(url: str, headers: dict, payload: dict, timeout: float):
+    """Синхронный POST-запрос с токеном из пула token_pool"""
+    with token_pool.lease(_bearer_token(headers)) as lease:
+        response = requests.post(url, headers=_with_token(headers, lease.token), json=payload, timeout=timeout)
+        lease.observe(response.status_code, response.headers.get("Retry-After"))
+        return response
+
+# Вопрос по умолчанию для анализа изображений
+DEFAULT_IMAGE_QUESTION = "Что на этом изображении?"
 
 
 def encode_media_base64(file_path: str) -> str:
@@ -64,6 +167,22 @@ def encode_media_base64(file_path: str) -> str:
         return None
 
 
+def encode_bytes_base64(data) -> Optional[str]:
+    """Кодирует буфер (bytes/bytearray/memoryview) в base64 с проверкой размера"""
+    try:
+        max_size = 50 * 1024 * 1024  # 50MB
+        size = memoryview(data).nbytes
+        if size > max_size:
+            logger.error(f"Файл слишком большой: {size} байт")
+            return None
+        if not size:
+            return None
+        return base64.b64encode(data).decode('ascii')
+    except Exception as e:
+        logger.error(f"Ошибка кодирования данных: {e}")
+        return None
+
+
 def transcribe_audio(audio_path: str, token: str) -> str:
     """Транскрибирует аудио через Pollinations.AI с улучшенной обработкой отказов"""
     base64_audio = encode_media_base64(audio_path)
@@ -93,13 +212,182 @@ async def transcribe_audio_async(audio_path: str, token: str) -> str:
         return None
 
     audio_format = audio_path.split('.')[-1].lower()
+    return await _transcribe_base64_async(base64_audio, audio_format, token)
+
+
+async def transcribe_audio_bytes_async(audio_data, audio_format: str, token: str) -> str:
+    """Асинхронно транскрибирует аудио, переданное в памяти (без временных файлов)"""
+    base64_audio = await asyncio.to_thread(encode_bytes_base64, audio_data)
+    if not base64_audio:
+        return None
+
+    return await _transcribe_base64_async(base64_audio, audio_format.lower(), token)
+
+
+async def transcribe_voice_async(voice_data, token: str, duration: Optional[float] = None,
+                                 on_progress: Optional[Callable[[int, int, str], Awaitable[None]]] = None) -> str:
+    """Транскрибирует голосовое сообщение Telegram (OGG/Opus), загружая его в самом компактном формате.
+
+    Форматы перебираются в порядке VOICE_UPLOAD_FORMATS (по умолчанию ogg -> mp3 -> wav),
+    пока модель не примет один из них; принятый формат запоминается для каждой модели
+    (_audio_format_by_model), и следующие сообщения сразу загружаются в нём.
+    Записи длиннее VOICE_CHUNK_THRESHOLD_SECONDS режутся по паузам и распознаются параллельно;
+    on_progress(готово, всего, текст) вызывается по мере готовности фрагментов.
+    Ошибки конвертации (AudioConversionError, FileNotFoundError, TimeoutError) пробрасываются.
+    """
+    if settings.voice_chunking_enabled and duration and duration > settings.voice_chunk_threshold_seconds:
+        chunks = await _plan_voice_chunks(voice_data, duration)
+        if len(chunks) > 1:
+            logger.info(f"Длинное голосовое ({duration:.0f} сек) разбито на {len(chunks)} фрагментов")
+            result = await _transcribe_chunks_async(voice_data, chunks, token, on_progress, priority=duration)
+            if result:
+                return result
+            logger.warning("Транскрипция не удалась или дала отказ")
+            return _get_transcription_fallback_message()
+
+    result = await _transcribe_segment_async(voice_data, token, priority=duration or 0.0)
+    if result and not _is_refusal_response(result):
+        return result
+
+    # Если транскрипция не удалась или дала отказ, возвращаем fallback
+    logger.warning("Транскрипция не удалась или дала отказ")
+    return _get_transcription_fallback_message()
+
+
+async def _transcribe_segment_async(voice_data, token: str, start: Optional[float] = None,
+                                    duration: Optional[float] = None, priority: float = 0.0) -> Optional[str]:
+    """Транскрибирует запись или её фрагмент, подбирая формат загрузки.
+
+    priority — длительность всей записи для очереди пула ffmpeg (короткие раньше).
+    Модель выбирает model_router; при сбое модели запрос повторяется на следующей.
+    Ошибки конвертации пробрасываются и не засчитываются модели как отказ.
+    """
+    # Кодирование в каждый формат выполняется один раз, даже если запрос уходит на несколько моделей
+    encoded: Dict[str, Optional[str]] = {}
+
+    async def encode(audio_format: str) -> Optional[str]:
+        if audio_format not in encoded:
+            try:
+                audio_data = await encode_for_transcription(
+                    voice_data,
+                    audio_format,
+                    bitrate_kbps=settings.voice_mp3_bitrate_kbps,
+                    timeout=settings.voice_processing_timeout,
+                    start=start,
+                    duration=duration,
+                    priority=priority
+                )
+            except (AudioConversionError, FileNotFoundError, asyncio.TimeoutError) as e:
+                raise _MediaProcessingError(e) from e
+            logger.info(f"Аудио для транскрипции: {audio_format}, {len(audio_data) // 1024}KB")
+            encoded[audio_format] = await asyncio.to_thread(encode_bytes_base64, audio_data)
+        return encoded[audio_format]
+
+    try:
+        return await model_router.call("audio", lambda model: _transcribe_segment_with_model_async(
+            encode, token, model
+        ))
+    except _MediaProcessingError as e:
+        raise e.error
+    except Exception as e:
+        logger.error(f"Ошибка транскрипции: {e!r}")
+        return None
+
+
+async def _transcribe_segment_with_model_async(encode: Callable[[str], Awaitable[Optional[str]]], token: str,
+                                               model: str) -> Optional[str]:
+    """Транскрибирует запись одной моделью, начиная с формата, который она приняла в прошлый раз"""
+    formats = [f.strip() for f in settings.voice_upload_formats.split(",")]
+    remembered = _audio_format_by_model.get(model)
+    if remembered in formats:
+        formats = formats[formats.index(remembered):]
+
+    for audio_format in formats:
+        base64_audio = await encode(audio_format)
+        if not base64_audio:
+            return None
+
+        try:
+            result = await _request_transcription_async(base64_audio, audio_format, token, model)
+        except UnsupportedAudioFormatError as e:
+            logger.warning(f"Модель {model} не приняла формат {audio_format}: {e}")
+            continue
+
+        # Запоминаем формат только по успешному ответу: пустой ответ не подтверждает, что формат принят
+        if result and _audio_format_by_model.get(model) != audio_format:
+            logger.info(f"Формат загрузки аудио для модели {model}: {audio_format}")
+            _audio_format_by_model[model] = audio_format
+        return result
+
+    return None
+
+
+async def _plan_voice_chunks(voice_data, duration: float) -> List[Tuple[float, float]]:
+    """Определяет границы фрагментов длинной записи по паузам (silencedetect)"""
+    try:
+        silences = await detect_silences(voice_data, timeout=settings.voice_processing_timeout, priority=duration)
+    except AudioConversionError as e:
+        # Без пауз режем по фиксированной длине
+        logger.warning(f"Не удалось найти паузы в аудио: {e}")
+        silences = []
+    return plan_chunks(duration, silences, settings.voice_chunk_max_seconds)
+
+
+async def _transcribe_chunks_async(voice_data, chunks: List[Tuple[float, float]], token: str,
+                                   on_progress: Optional[Callable[[int, int, str], Awaitable[None]]] = None,
+                                   priority: float = 0.0) -> str:
+    """Параллельно транскрибирует фрагменты (не более VOICE_CHUNK_CONCURRENCY одновременно) и склеивает текст по порядку"""
+    semaphore = asyncio.Semaphore(settings.voice_chunk_concurrency)
+    results: List[Optional[str]] = [None] * len(chunks)
+    completed = 0
+
+    async def transcribe_chunk(index: int, start: float, length: float):
+        nonlocal completed
+        async with semaphore:
+            text = await _transcribe_segment_async(voice_data, token, start=start, duration=length, priority=priority)
+        # Отказы и пустые ответы (например, на тишине) пропускаем
+        results[index] = text.strip() if text and not _is_refusal_response(text) else ""
+        completed += 1
+        if on_progress:
+            # Показываем только непрерывное начало текста, чтобы не было пропусков
+            ready = []
+            for part in results:
+                if part is None:
+                    break
+                ready.append(part)
+            try:
+                await on_progress(completed, len(chunks), _join_transcription(ready))
+            except Exception as e:
+                logger.warning(f"Ошибка обновления прогресса транскрипции: {e}")
+
+    tasks = [asyncio.create_task(transcribe_chunk(i, start, length)) for i, (start, length) in enumerate(chunks)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    return _join_transcription(results)
+
+
+def _join_transcription(parts: List[Optional[str]]) -> str:
+    return " ".join(part for part in parts if part)
+
+
+async def _transcribe_base64_async(base64_audio: str, audio_format: str, token: str) -> str:
+    """Транскрибирует аудио, закодированное в base64"""
     supported_formats = ['mp3', 'wav', 'ogg', 'm4a', 'flac']
     if audio_format not in supported_formats:
         logger.warning(f"Неподдерживаемый формат аудио: {audio_format}")
         return None
 
     # Попытка асинхронной транскрипции
-    result = await _attempt_transcription_async(base64_audio, audio_format, token)
+    try:
+        result = await _attempt_transcription_async(base64_audio, audio_format, token)
+    except UnsupportedAudioFormatError as e:
+        logger.error(f"Эндпоинт транскрипции не принял формат {audio_format}: {e}")
+        result = None
     if result and not _is_refusal_response(result):
         return result
     
@@ -149,7 +437,7 @@ def _attempt_transcription(base64_audio: str, audio_format: str, token: str) ->
     }
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
+        response = _post_sync(url, headers, payload, timeout=60)
         response.raise_for_status()
         result = response.json()
         content = result.get('choices', [{}])[0].get('message', {}).get('content')
@@ -207,8 +495,28 @@ def _attempt_transcription(base64_audio: str, audio_format: str, token: str) ->
 
 
 async def _attempt_transcription_async(base64_audio: str, audio_format: str, token: str) -> str:
-    """Асинхронная попытка транскрипции аудио"""
-    url = "https://text.pollinations.ai/openai"
+    """Асинхронная попытка транскрипции аудио на модели, выбранной model_router.
+
+    UnsupportedAudioFormatError — если эндпоинт отклонил запрос как некорректный (4xx), чтобы
+    вызывающий код мог попробовать другой формат.
+    """
+    try:
+        return await model_router.call("audio", lambda model: _request_transcription_async(
+            base64_audio, audio_format, token, model
+        ))
+    except UnsupportedAudioFormatError:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка транскрипции: {e!r}")
+        return None
+
+
+async def _request_transcription_async(base64_audio: str, audio_format: str, token: str, model: str) -> Optional[str]:
+    """Запрос транскрипции к одной модели. Ошибки запроса пробрасываются (для model_router).
+
+    UnsupportedAudioFormatError — если эндпоинт отклонил запрос как некорректный (4xx).
+    """
+    url = _TRANSCRIPTION_URL
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {token}"
@@ -223,7 +531,7 @@ async def _attempt_transcription_async(base64_audio: str, audio_format: str, tok
     )
 
     payload = {
-        "model": "openai-audio",
+        "model": model,
         "messages": [
             {
                 "role": "system",
@@ -247,64 +555,65 @@ async def _attempt_transcription_async(base64_audio: str, audio_format: str, tok
     }
 
     try:
-        session = await get_http_session()
-        async with session.post(url, headers=headers, json=payload) as response:
-            response.raise_for_status()
-            result = await response.json()
-            content = result.get('choices', [{}])[0].get('message', {}).get('content')
-            
-            if not content or not content.strip():
-                return None
-            
-            # Очищаем транскрипцию от возможных артефактов
-            content = content.strip()
-            
-            # Удаляем возможные префиксы, которые модель может добавить
-            unwanted_prefixes = [
-                "Транскрипция:",
-                "Текст:",
-                "Содержание:",
-                "Аудио содержит:",
-                "В аудио говорится:",
-                "Transcription:",
-                "Text:",
-                "Content:",
-                "Audio contains:",
-                "The audio says:",
-                "Извините, я не могу",
-                "Я не могу",
-                "Sorry, I cannot",
-                "I cannot"
-            ]
-            
-            for prefix in unwanted_prefixes:
-                if content.startswith(prefix):
-                    content = content[len(prefix):].strip()
-                    break
-            
-            # Удаляем возможные суффиксы
-            unwanted_suffixes = [
-                "Это транскрипция аудио.",
-                "Это текст из аудио.",
-                "This is audio transcription.",
-                "This is text from audio."
-            ]
-            
-            for suffix in unwanted_suffixes:
-                if content.endswith(suffix):
-                    content = content[:-len(suffix)].strip()
-                    break
-            
-            # Проверяем, не является ли результат отказом
-            if _is_refusal_response(content):
-                logger.warning(f"Транскрипция дала отказ: {content[:50]}...")
-                return None
-            
-            return content if content else None
-            
-    except Exception as e:
-        logger.error(f"Ошибка транскрипции: {e}")
+        result = await resilience.call(
+            guard_name("audio", model),
+            lambda: _post_json("audio", url, headers, payload)
+        )
+    except UpstreamError as e:
+        if e.status in (400, 415, 422):
+            raise UnsupportedAudioFormatError(f"HTTP {e.status}: {str(e)[:200]}") from e
+        raise
+
+    content = result.get('choices', [{}])[0].get('message', {}).get('content')
+    
+    if not content or not content.strip():
         return None
+    
+    # Очищаем транскрипцию от возможных артефактов
+    content = content.strip()
+    
+    # Удаляем возможные префиксы, которые модель может добавить
+    unwanted_prefixes = [
+        "Транскрипция:",
+        "Текст:",
+        "Содержание:",
+        "Аудио содержит:",
+        "В аудио говорится:",
+        "Transcription:",
+        "Text:",
+        "Content:",
+        "Audio contains:",
+        "The audio says:",
+        "Извините, я не могу",
+        "Я не могу",
+        "Sorry, I cannot",
+        "I cannot"
+    ]
+    
+    for prefix in unwanted_prefixes:
+        if content.startswith(prefix):
+            content = content[len(prefix):].strip()
+            break
+    
+    # Удаляем возможные суффиксы
+    unwanted_suffixes = [
+        "Это транскрипция аудио.",
+        "Это текст из аудио.",
+        "This is audio transcription.",
+        "This is text from audio."
+    ]
+    
+    for suffix in unwanted_suffixes:
+        if content.endswith(suffix):
+            content = content[:-len(suffix)].strip()
+            break
+    
+    # Проверяем, не является ли результат отказом
+    if _is_refusal_response(content):
+        logger.warning(f"Транскрипция дала отказ: {content[:50]}...")
+        return None
+    
+    return content if content else None
 
 
 def _get_transcription_fallback_message() -> str:
@@ -352,7 +661,7 @@ def _is_fallback_message(text: str) -> bool:
     return any(indicator in text_lower for indicator in fallback_indicators)
 
 
-def analyze_image(image_path: str, token: str, question: str = "Что на этом изображении?", system_prompt: Optional[str] = None) -> str:
+def analyze_image(image_path: str, token: str, question: str = DEFAULT_IMAGE_QUESTION, system_prompt: Optional[str] = None) -> str:
     """Анализирует изображение через Pollinations.AI.
     Если ответ пуст с system-role, пробуем fallback: передаём инструкции в тексте пользователя.
     """
@@ -378,7 +687,7 @@ def analyze_image(image_path: str, token: str, question: str = "Что на эт
             "messages": messages,
             "max_tokens": 2000
         }
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
+        response = _post_sync(url, headers, payload, timeout=60)
         response.raise_for_status()
         return response.json()
 
@@ -438,20 +747,107 @@ def analyze_image(image_path: str, token: str, question: str = "Что на эт
     return None
 
 
-async def analyze_image_async(image_path: str, token: str, question: str = "Что на этом изображении?", system_prompt: Optional[str] = None) -> str:
+async def analyze_image_async(image_path: str, token: str, question: str = DEFAULT_IMAGE_QUESTION, system_prompt: Optional[str] = None) -> str:
     """Асинхронно анализирует изображение через Pollinations.AI.
     Если ответ пуст с system-role, пробуем fallback: передаём инструкции в тексте пользователя.
     """
-    base64_image = encode_media_base64(image_path)
+    image_format = image_path.split('.')[-1].lower()
+    supported_formats = ['jpg', 'jpeg', 'png', 'gif', 'webp']
+    if image_format not in supported_formats:
+        logger.warning(f"Неподдерживаемый формат изображения: {image_format}")
+        return None
+
+    # Чтение файла, подготовку и кодирование выполняем вне event loop
+    base64_image, image_format = await asyncio.to_thread(_prepare_vision_payload, image_path, image_format)
     if not base64_image:
         return None
 
-    image_format = image_path.split('.')[-1].lower()
+    return await _analyze_base64_image_async(base64_image, image_format, token, question, system_prompt)
+
+
+async def analyze_image_bytes_async(image_data, token: str, question: str = DEFAULT_IMAGE_QUESTION, system_prompt: Optional[str] = None, image_format: str = "jpeg") -> Optional[str]:
+    """Асинхронно анализирует изображение, переданное в памяти (bytes/bytearray/memoryview).
+
+    Не использует временные файлы: подготовка и base64 выполняются прямо из буфера в отдельном потоке.
+    """
+    image_format = (image_format or "jpeg").lower()
     supported_formats = ['jpg', 'jpeg', 'png', 'gif', 'webp']
     if image_format not in supported_formats:
         logger.warning(f"Неподдерживаемый формат изображения: {image_format}")
         return None
 
+    base64_image, image_format = await asyncio.to_thread(_prepare_vision_payload, image_data, image_format)
+    if not base64_image:
+        return None
+
+    return await _analyze_base64_image_async(base64_image, image_format, token, question, system_prompt)
+
+
+def _prepare_vision_payload(source, image_format: str) -> Tuple[Optional[str], str]:
+    """Готовит изображение для vision-модели: уменьшает, перекодирует и кодирует в base64.
+
+    source — путь к файлу или буфер с байтами. Выполняется в отдельном потоке.
+    """
+    if isinstance(source, str):
+        try:
+            file_size = os.path.getsize(source)
+            if file_size > 50 * 1024 * 1024:
+                logger.error(f"Файл слишком большой: {file_size} байт")
+                return None, image_format
+            with open(source, "rb") as f:
+                source = f.read()
+        except Exception as e:
+            logger.error(f"Ошибка чтения файла: {e}")
+            return None, image_format
+
+    if settings.vision_preprocess_enabled:
+        source, image_format = prepare_image_for_vision(
+            source,
+            image_format=image_format,
+            max_edge=settings.vision_image_max_edge,
+            quality=settings.vision_image_quality,
+            output_format=settings.vision_image_format,
+        )
+    return encode_bytes_base64(source), image_format
+
+
+async def _analyze_base64_image_async(base64_image: str, image_format: str, token: str, question: str, system_prompt: Optional[str]) -> Optional[str]:
+    """Анализирует изображение, закодированное в base64"""
+    # Одинаковые одновременные запросы (например, одно и то же пересланное фото) объединяем.
+    # Вместо самого изображения в ключ попадает его хеш.
+    key = SingleFlight.make_key("vision", {
+        "question": question,
+        "system_prompt": system_prompt,
+        "image": hashlib.sha256(base64_image.encode("ascii")).hexdigest(),
+        "format": image_format,
+    })
+    image_ref = f"data:image/{image_format};base64,{base64_image}"
+    return await _single_flight.do(
+        key,
+        lambda: _analyze_image_request_async(image_ref, token, question, system_prompt)
+    )
+
+
+async def analyze_image_url_async(image_url: str, token: str, question: str = DEFAULT_IMAGE_QUESTION, system_prompt: Optional[str] = None) -> Optional[str]:
+    """Асинхронно анализирует изображение по публичному URL (без base64-загрузки)"""
+    if not image_url:
+        return None
+    key = SingleFlight.make_key("vision", {
+        "question": question,
+        "system_prompt": system_prompt,
+        "image_url": image_url,
+    })
+    return await _single_flight.do(
+        key,
+        lambda: _analyze_image_request_async(image_url, token, question, system_prompt)
+    )
+
+
+async def _analyze_image_request_async(image_ref: str, token: str, question: str, system_prompt: Optional[str]) -> Optional[str]:
+    """Выполняет запрос анализа изображения (с fallback без system-role).
+
+    image_ref — значение image_url.url: data URL с base64 или обычный http(s) URL.
+    """
     url = "https://text.pollinations.ai/openai"
     headers = {
         "Content-Type": "application/json",
@@ -459,15 +855,15 @@ async def analyze_image_async(image_path: str, token: str, question: str = "Чт
     }
 
     async def _post_messages_async(messages):
-        payload = {
-            "model": "openai",
-            "messages": messages,
-            "max_tokens": 2000
-        }
-        session = await get_http_session()
-        async with session.post(url, headers=headers, json=payload) as response:
-            response.raise_for_status()
-            return await response.json()
+        def request(model):
+            payload = {
+                "model": model,
+                "messages": messages,
+                "max_tokens": 2000
+            }
+            return resilience.call(guard_name("vision", model), lambda: _post_json("vision", url, headers, payload))
+
+        return await model_router.call("vision", request)
 
     # Первая попытка: system-role (если задан)
     messages_primary = []
@@ -483,7 +879,7 @@ async def analyze_image_async(image_path: str, token: str, question: str = "Чт
             {
                 "type": "image_url",
                 "image_url": {
-                    "url": f"data:image/{image_format};base64,{base64_image}"
+                    "url": image_ref
                 }
             }
         ]
@@ -509,7 +905,7 @@ async def analyze_image_async(image_path: str, token: str, question: str = "Чт
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": f"data:image/{image_format};base64,{base64_image}"
+                        "url": image_ref
                     }
                 }
             ]
@@ -648,12 +1044,7 @@ def send_to_pollinations(messages: list, token: str, model: str = "openai") -> s
         logger.info(f"Payload keys: {list(payload.keys())}")
         logger.info(f"Messages count: {len(payload.get('messages', []))}")
         
-        response = requests.post(
-            url,
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
+        response = _post_sync(url, headers, payload, timeout=30)
 
         # Проверяем статус ответа
         if response.status_code != 200:
@@ -701,8 +1092,11 @@ def send_to_pollinations(messages: list, token: str, model: str = "openai") -> s
         return f"❌ Ошибка: {str(e)}"
 
 
-async def send_to_pollinations_async(messages: list, token: str, model: str = "openai") -> str:
-    """Асинхронно отправляет POST-запрос к Pollinations.AI API и возвращает ответ"""
+async def send_to_pollinations_async(messages: list, token: str, model: Optional[str] = None) -> str:
+    """Асинхронно отправляет POST-запрос к Pollinations.AI API и возвращает ответ.
+
+    model — предпочитаемая модель (переопределение чата); None — выбор model_router.
+    """
     # Валидация входных даннpых
     is_valid, error_message = _validate_messages_and_token(messages, token)
     if not is_valid:
@@ -721,54 +1115,56 @@ async def send_to_pollinations_async(messages: list, token: str, model: str = "o
         "max_tokens": 2000
     }
 
+    def request(candidate):
+        candidate_payload = {**payload, "model": candidate}
+        factory = lambda: resilience.call(
+            guard_name("text", candidate),
+            lambda: _post_json("text", url, headers, candidate_payload)
+        )
+        if settings.hedging_enabled:
+            # С фиксированным seed запрос идемпотентен — медленный можно продублировать
+            return text_hedger.call(candidate, factory)
+        return factory()
+
     try:
-        session = await get_http_session()
-        async with session.post(url, headers=headers, json=payload) as response:
-            # Логируем детали запроса для диагностики
-            logger.info(f"Отправляем запрос к Pollinations API: {url}")
-            logger.info(f"Headers: {headers}")
-            logger.info(f"Payload keys: {list(payload.keys())}")
-            logger.info(f"Messages count: {len(payload.get('messages', []))}")
-            
-            # Проверяем статус ответа
-            if response.status != 200:
-                error_text = await response.text()
-                logger.error(f"Pollinations API вернул статус {response.status}: {error_text}")
-                logger.error(f"Request headers: {headers}")
-                logger.error(f"Request payload: {payload}")
-                return f"❌ Ошибка API (статус {response.status}): {error_text}"
-            
-            result = await response.json()
+        # Логируем детали запроса для диагностики
+        logger.info(f"Отправляем запрос к Pollinations API: {url}")
+        logger.info(f"Headers: {headers}")
+        logger.info(f"Payload keys: {list(payload.keys())}")
+        logger.info(f"Messages count: {len(payload.get('messages', []))}")
 
-            if "choices" in result and len(result["choices"]) > 0:
-                content = result["choices"][0]["message"]["content"]
-                if not content or not content.strip():
-                    logger.warning("Получен пустой ответ от API")
-                    return "❌ Получен пустой ответ от API"
-                return content
-            elif "response" in result:
-                content = result["response"]
-                if not content or not content.strip():
-                    logger.warning("Получен пустой ответ от API")
-                    return "❌ Получен пустой ответ от API"
-                return content
-            else:
-                logger.error(f"Неожиданный формат ответа: {result}")
-                return "❌ Получен неожиданный формат ответа от API"
+        result = await model_router.call("text", request, preferred=model)
 
+        if "choices" in result and len(result["choices"]) > 0:
+            content = result["choices"][0]["message"]["content"]
+            if not content or not content.strip():
+                logger.warning("Получен пустой ответ от API")
+                return "❌ Получен пустой ответ от API"
+            return content
+        elif "response" in result:
+            content = result["response"]
+            if not content or not content.strip():
+                logger.warning("Получен пустой ответ от API")
+                return "❌ Получен пустой ответ от API"
+            return content
+        else:
+            logger.error(f"Неожиданный формат ответа: {result}")
+            return "❌ Получен неожиданный формат ответа от API"
+
+    except CircuitOpenError as e:
+        logger.warning(f"Запрос к Pollinations отклонён: {e}")
+        return "❌ Сервис временно недоступен. Попробуйте позже."
+    except OverloadedError as e:
+        logger.warning(f"Запрос к Pollinations отклонён: {e}")
+        return "❌ Сервис перегружен. Попробуйте позже."
+    except UpstreamError as e:
+        logger.error(f"Pollinations API вернул статус {e.status}: {e}")
+        logger.error(f"Request headers: {headers}")
+        logger.error(f"Request payload: {payload}")
+        return f"❌ Ошибка API (статус {e.status}): {e}"
     except asyncio.TimeoutError:
         logger.error("Таймаут запроса к Pollinations API")
         return "❌ Таймаут запроса к API. Попробуйте снова."
-    except aiohttp.ClientResponseError as e:
-        error_text = ""
-        try:
-            error_text = await e.response.text()
-        except:
-            pass
-        logger.error(f"HTTP ошибка {e.status} от Pollinations API: {error_text}")
-        logger.error(f"Request headers: {headers}")
-        logger.error(f"Request payload: {payload}")
-        return f"❌ Ошибка API (статус {e.status}): {error_text}"
     except aiohttp.ClientError as e:
         logger.error(f"Ошибка запроса к Pollinations: {str(e)}")
         return f"❌ Ошибка сети: {str(e)}"
@@ -780,27 +1176,225 @@ async def send_to_pollinations_async(messages: list, token: str, model: str = "o
         return f"❌ Ошибка: {str(e)}"
 
 
+async def _iter_sse_chunks(response) -> AsyncIterator[str]:
+    """Разбирает поток Server-Sent Events и отдаёт текстовые дельты ответа"""
+    async for raw_line in response.content:
+        line = raw_line.decode("utf-8", errors="replace").strip()
+        # Пустые строки разделяют события, строки с ':' — комментарии/keep-alive
+        if not line or line.startswith(":") or not line.startswith("data:"):
+            continue
+
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+
+        try:
+            event = json.loads(data)
+        except json.JSONDecodeError:
+            logger.debug(f"Пропускаем некорректное SSE событие: {data[:100]}")
+            continue
+
+        choices = event.get("choices") or []
+        if not choices:
+            continue
+        delta = choices[0].get("delta") or {}
+        content = delta.get("content")
+        if content:
+            yield content
+
+
+class _StreamFallback(Exception):
+    """Модель не начала ответ — стрим можно повторить на другой модели"""
+
+
+class StreamInterruptedError(Exception):
+    """Стрим оборвался после того, как часть ответа уже была отдана"""
+
+
+async def stream_from_pollinations_async(messages: list, token: str, model: Optional[str] = None) -> AsyncIterator[str]:
+    """Асинхронно запрашивает ответ в режиме стриминга (stream: true) и отдаёт его по частям.
+
+    model — предпочитаемая модель (переопределение чата); None — выбор model_router.
+    Если модель отказала до первой части ответа, запрос повторяется на следующей.
+    Ошибки возвращаются так же, как в send_to_pollinations_async — текстом, одной частью;
+    обрыв после первой части ответа — StreamInterruptedError (ответ неполный).
+    """
+    is_valid, error_message = _validate_messages_and_token(messages, token)
+    if not is_valid:
+        yield error_message
+        return
+
+    candidates = model_router.candidates("text", preferred=model)
+    for index, candidate in enumerate(candidates):
+        can_fallback = index < len(candidates) - 1
+        try:
+            async for chunk in _stream_model_async(messages, token, candidate, can_fallback):
+                yield chunk
+            return
+        except _StreamFallback as e:
+            model_router.fallbacks += 1
+            logger.warning(f"Стриминг: модель {candidate} не ответила ({e}), пробуем {candidates[index + 1]}")
+
+
+async def _stream_model_async(messages: list, token: str, model: str, can_fallback: bool) -> AsyncIterator[str]:
+    """Стриминговый запрос к одной модели.
+
+    Если модель недоступна до первой части ответа и can_fallback, бросает _StreamFallback
+    вместо текста ошибки; при ошибке после первой части — StreamInterruptedError.
+    """
+    url = "https://text.pollinations.ai/openai"
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "text/event-stream",
+        "Authorization": f"Bearer {token}"
+    }
+
+    payload = {
+        "model": model,
+        "messages": messages,
+        "seed": 42,
+        "max_tokens": 2000,
+        "stream": True
+    }
+
+    # Стриминг не повторяем (часть ответа уже могла быть показана), но учитываем в circuit breaker
+    guard = resilience.guard(guard_name("text", model))
+    try:
+        guard.check()
+    except CircuitOpenError as e:
+        if can_fallback:
+            raise _StreamFallback(str(e)) from e
+        logger.warning(f"Стриминговый запрос к Pollinations отклонён: {e}")
+        yield "❌ Сервис временно недоступен. Попробуйте позже."
+        return
+
+    produced = False
+    acquired = False
+    lease = None
+    latency = None
+    error = None
+    try:
+        await guard.limiter.acquire()
+        acquired = True
+        started = time.monotonic()
+        session = await get_http_session("text")
+        lease = token_pool.lease(token)
+        async with session.post(url, headers=_with_token(headers, lease.token), json=payload) as response:
+            lease.observe(response.status, response.headers.get("Retry-After"))
+            # Для адаптивного лимита учитываем время до начала ответа
+            latency = time.monotonic() - started
+            logger.info(f"Отправляем стриминговый запрос к Pollinations API: {url} (модель {model})")
+            logger.info(f"Messages count: {len(payload.get('messages', []))}")
+
+            if response.status != 200:
+                error_text = await response.text()
+                logger.error(f"Pollinations API вернул статус {response.status}: {error_text}")
+                error = UpstreamError(error_text, status=response.status)
+                retryable, _ = guard.record(error)
+                if retryable:
+                    model_router.record_failure("text", model)
+                    if can_fallback:
+                        raise _StreamFallback(f"HTTP {response.status}")
+                yield f"❌ Ошибка API (статус {response.status}): {error_text}"
+                return
+
+            # Если сервер проигнорировал stream и вернул обычный JSON — отдаём ответ целиком
+            if response.content_type != "text/event-stream":
+                result = await response.json(content_type=None)
+                guard.record()
+                model_router.record_success("text", model, time.monotonic() - started)
+                content = None
+                if "choices" in result and len(result["choices"]) > 0:
+                    content = result["choices"][0].get("message", {}).get("content")
+                elif "response" in result:
+                    content = result["response"]
+                if content and content.strip():
+                    produced = True
+                    yield content
+                else:
+                    logger.warning("Получен пустой ответ от API")
+                    yield "❌ Получен пустой ответ от API"
+                return
+
+            async for chunk in _iter_sse_chunks(response):
+                produced = True
+                yield chunk
+            guard.record()
+            model_router.record_success("text", model, time.monotonic() - started)
+
+    except _StreamFallback:
+        raise
+    except OverloadedError as e:
+        if can_fallback:
+            raise _StreamFallback(str(e)) from e
+        logger.warning(f"Стриминговый запрос к Pollinations отклонён: {e}")
+        yield "❌ Сервис перегружен. Попробуйте позже."
+    except asyncio.TimeoutError as e:
+        error = e
+        guard.record(e)
+        model_router.record_failure("text", model)
+        logger.error("Таймаут стримингового запроса к Pollinations API")
+        if produced:
+            raise StreamInterruptedError("таймаут") from e
+        if can_fallback:
+            raise _StreamFallback("таймаут") from e
+        yield "❌ Таймаут запроса к API. Попробуйте снова."
+    except aiohttp.ClientError as e:
+        error = e
+        retryable, _ = guard.record(e)
+        if retryable:
+            model_router.record_failure("text", model)
+        logger.error(f"Ошибка стримингового запроса к Pollinations: {str(e)}")
+        if produced:
+            raise StreamInterruptedError(str(e)) from e
+        if retryable and can_fallback:
+            raise _StreamFallback(str(e)) from e
+        yield f"❌ Ошибка сети: {str(e)}"
+    except json.JSONDecodeError as e:
+        logger.error(f"Ошибка декодирования JSON ответа: {e}")
+        if produced:
+            raise StreamInterruptedError(str(e)) from e
+        yield "❌ Ошибка обработки ответа от сервера"
+    except Exception as e:
+        logger.exception("Неожиданная ошибка при стриминге")
+        if produced:
+            raise StreamInterruptedError(str(e)) from e
+        yield f"❌ Ошибка: {str(e)}"
+    finally:
+        if lease is not None:
+            lease.release(failed=error is not None)
+        if acquired:
+            guard.limiter.release(latency, error)
+        # Если стрим прерван (остановка пользователем), пробный слот breaker'а не должен зависнуть
+        guard.breaker.release_probe()
+
+
 # -------- Генерация изображений по описанию --------
+def build_image_url(prompt: str, width: int = 1024, height: int = 1024, seed: Optional[int] = None, model: Optional[str] = None) -> str:
+    """Строит URL Pollinations Image API для заданных параметров генерации"""
+    # Базовый эндпоинт. Параметры width/height/seed поддерживаются Pollinations
+    encoded_prompt = urllib.parse.quote(prompt)
+    params = {
+        "width": str(width),
+        "height": str(height),
+        "nologo": "true",
+    }
+    if seed is not None:
+        params["seed"] = str(seed)
+    if model:
+        params["model"] = model
+
+    query = urllib.parse.urlencode(params)
+    return f"https://image.pollinations.ai/prompt/{encoded_prompt}?{query}"
+
+
 def generate_image(prompt: str, width: int = 1024, height: int = 1024, seed: Optional[int] = None, model: Optional[str] = None) -> Tuple[Optional[bytes], Optional[str]]:
     """Генерирует изображение через Pollinations Image API и возвращает (bytes, url).
 
     Возвращает bytes изображения (или None при ошибке) и итоговый URL.
     """
     try:
-        # Базовый эндпоинт. Параметры width/height/seed поддерживаются Pollinations
-        encoded_prompt = urllib.parse.quote(prompt)
-        params = {
-            "width": str(width),
-            "height": str(height),
-            "nologo": "true",
-        }
-        if seed is not None:
-            params["seed"] = str(seed)
-        if model:
-            params["model"] = model
-
-        query = urllib.parse.urlencode(params)
-        url = f"https://image.pollinations.ai/prompt/{encoded_prompt}?{query}"
+        url = build_image_url(prompt, width, height, seed=seed, model=model)
         resp = requests.get(url, timeout=120)
         resp.raise_for_status()
         return resp.content, url
@@ -815,27 +1409,21 @@ async def generate_image_async(prompt: str, width: int = 1024, height: int = 102
     Возвращает bytes изображения (или None при ошибке) и итоговый URL.
     """
     try:
-        # Базовый эндпоинт. Параметры width/height/seed поддерживаются Pollinations
-        encoded_prompt = urllib.parse.quote(prompt)
-        params = {
-            "width": str(width),
-            "height": str(height),
-            "nologo": "true",
-        }
-        if seed is not None:
-            params["seed"] = str(seed)
-        if model:
-            params["model"] = model
-
-        query = urllib.parse.urlencode(params)
-        url = f"https://image.pollinations.ai/prompt/{encoded_prompt}?{query}"
-        
-        # Используем глобальную сессию aiohttp для переиспользования
-        session = await get_http_session()
-        async with session.get(url) as response:
-            response.raise_for_status()
-            content = await response.read()
-            return content, url
+        url = build_image_url(prompt, width, height, seed=seed, model=model)
+
+        # Без seed результат недетерминирован — такие изображения не кэшируем
+        cache_key = None
+        if settings.image_cache_enabled and seed is not None:
+            cache_key = image_cache.make_key(prompt, width, height, seed, model)
+            cached = await image_cache.get(cache_key)
+            if cached is not None:
+                logger.info("Изображение взято из кэша")
+                return cached, url
+
+        # Одинаковые одновременные генерации (тот же промпт/размер/seed) выполняем один раз
+        key = SingleFlight.make_key("image", {"url": url})
+        content = await _single_flight.do(key, lambda: _download_image_async(url, cache_key))
+        return content, url
     except asyncio.CancelledError:
         logger.warning("Генерация изображения была отменена пользователем")
         raise  # Передаем отмену выше
@@ -847,53 +1435,64 @@ async def generate_image_async(prompt: str, width: int = 1024, height: int = 102
         return None, None
 
 
-async def auto_analyze_generated_image(image_content: bytes, prompt: str, token: str) -> Optional[str]:
+async def _download_image_async(url: str, cache_key: Optional[str] = None) -> bytes:
+    """Скачивает сгенерированное изображение и при наличии ключа сохраняет его в кэш"""
+    async def fetch() -> bytes:
+        # Используем глобальную сессию aiohttp для переиспользования
+        session = await get_http_session("image")
+        async with session.get(url) as response:
+            response.raise_for_status()
+            return await response.read()
+
+    content = await resilience.call("image", fetch)
+    if cache_key and content:
+        await image_cache.put(cache_key, content)
+    return content
+
+
+async def auto_analyze_generated_image(image_content: Optional[bytes], prompt: str, token: str, image_url: Optional[str] = None) -> Optional[str]:
     """Автоматически анализирует сгенерированное изображение и возвращает описание.
     
     Эта функция используется для сохранения контекста о сгенерированных изображениях.
+    Если известен URL изображения Pollinations, анализ выполняется по ссылке без загрузки
+    байтов; base64 используется как запасной вариант.
     """
-    if not image_content or not token:
+    if not token or not (image_content or image_url):
         return None
+
+    # Анализируем изображение с специальным промптом для контекста
+    analysis_question = f"Опиши это изображение, созданное по запросу '{prompt}'. Что получилось?"
+    system_prompt = (
+        "Ты анализируешь изображение, созданное ИИ по запросу пользователя. "
+        "Дай описание того, что получилось в 3-4 предложениях: основные объекты, их расположение, стиль, настроение. "
+        "Твой анализ будет сохранен в контекст диалога для дальнейшего использования. "
+        "Будь информативен, но не слишком многословен."
+    )
         
     try:
-        # Создаем временный файл для анализа
-        import tempfile
-        import uuid
-        
-        temp_dir = tempfile.mkdtemp()
-        image_path = os.path.join(temp_dir, f"generated_{uuid.uuid4()}.jpg")
-        
-        try:
-            # Сохраняем изображение во временный файл
-            with open(image_path, 'wb') as f:
-                f.write(image_content)
-            
-            # Анализируем изображение с специальным промптом для контекста
-            analysis_question = f"Опиши это изображение, созданное по запросу '{prompt}'. Что получилось?"
-            system_prompt = (
-                "Ты анализируешь изображение, созданное ИИ по запросу пользователя. "
-                "Дай описание того, что получилось в 3-4 предложениях: основные объекты, их расположение, стиль, настроение. "
-                "Твой анализ будет сохранен в контекст диалога для дальнейшего использования. "
-                "Будь информативен, но не слишком многословен."
-            )
-            
-            analysis_result = await analyze_image_async(
-                image_path=image_path,
+        if image_url:
+            analysis_result = await analyze_image_url_async(
+                image_url=image_url,
                 token=token,
                 question=analysis_question,
                 system_prompt=system_prompt
             )
-            
-            return analysis_result
-            
-        finally:
-            # Очищаем временные файлы
-            try:
-                import shutil
-                shutil.rmtree(temp_dir)
-            except Exception as e:
-                logger.warning(f"Не удалось удалить временные файлы анализа: {e}")
-                
+            if analysis_result:
+                return analysis_result
+            logger.info("Анализ по URL не удался, переходим к base64")
+            if not image_content:
+                image_content = await _download_image_async(image_url)
+            if not image_content:
+                return None
+
+        return await analyze_image_bytes_async(
+            image_data=image_content,
+            token=token,
+            question=analysis_question,
+            system_prompt=system_prompt,
+            image_format="jpeg"
+        )
+
     except Exception as e:
         logger.error(f"Ошибка автоматического анализа изображения: {e}")
         return None
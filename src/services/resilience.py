@@ -0,0 +1,490 @@
+"""
+Устойчивость к сбоям Pollinations: circuit breaker, адаптивный лимит конкурентности,
+повторы с экспоненциальной задержкой для каждого эндпоинта и хеджирование медленных запросов
+"""
+import asyncio
+import email.utils
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+import aiohttp
+
+from config.settings import settings
+from utils.error_handler import APIError
+
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamError(APIError):
+    """Ошибка ответа Pollinations (HTTP-статус и, если есть, Retry-After)"""
+
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message, user_friendly="Сервис временно недоступен. Попробуйте позже.")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(UpstreamError):
+    """Эндпоинт признан недоступным — запрос отклонён без обращения к сети"""
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Разбирает заголовок Retry-After (секунды или HTTP-дата)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(exc: BaseException):
+    """Возвращает (повторяемая ли ошибка, Retry-After).
+
+    Повторяемые ошибки — таймауты, сетевые сбои, 408/429/5xx; они же считаются отказами эндпоинта.
+    Остальные 4xx — ошибки запроса: не повторяются и не влияют на circuit breaker.
+    """
+    if isinstance(exc, CircuitOpenError):
+        return False, None
+    status = None
+    retry_after = None
+    if isinstance(exc, UpstreamError):
+        status, retry_after = exc.status, exc.retry_after
+    elif isinstance(exc, aiohttp.ClientResponseError):
+        status = exc.status
+        retry_after = parse_retry_after((exc.headers or {}).get("Retry-After"))
+
+    if status is not None:
+        return status in (408, 429) or status >= 500, retry_after
+    if isinstance(exc, (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)):
+        return True, None
+    return False, None
+
+
+class CircuitBreaker:
+    """Circuit breaker: closed -> open (после серии отказов) -> half-open (пробный запрос) -> closed"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name: str, failure_threshold: int, recovery_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        # Метрики
+        self.times_opened = 0
+        self.rejected = 0
+
+    def before_call(self) -> None:
+        """Разрешает запрос или бросает CircuitOpenError"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.recovery_timeout:
+                self.rejected += 1
+                raise CircuitOpenError(f"{self.name}: circuit breaker открыт")
+            self.state = self.HALF_OPEN
+            logger.info(f"Circuit breaker {self.name}: half-open, пробный запрос")
+
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                self.rejected += 1
+                raise CircuitOpenError(f"{self.name}: идёт пробный запрос")
+            self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info(f"Circuit breaker {self.name}: закрыт, эндпоинт восстановился")
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self._consecutive_failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.times_opened += 1
+                logger.warning(
+                    f"Circuit breaker {self.name}: открыт на {self.recovery_timeout:.0f} сек "
+                    f"после {self._consecutive_failures} отказов подряд"
+                )
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+    def release_probe(self) -> None:
+        """Освобождает пробный слот, если запрос завершился без результата (отмена, ошибка запроса)"""
+        self._probe_in_flight = False
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self._consecutive_failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+        }
+
+
+class OverloadedError(UpstreamError):
+    """Очередь к эндпоинту переполнена — запрос отклонён без обращения к сети"""
+
+
+def is_overload_signal(exc: BaseException) -> bool:
+    """Признак перегрузки эндпоинта: таймаут или 429/503"""
+    if isinstance(exc, asyncio.TimeoutError):
+        return True
+    if isinstance(exc, UpstreamError):
+        return exc.status in (429, 503)
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status in (429, 503)
+    return False
+
+
+class AdaptiveLimiter:
+    """Адаптивный (AIMD) лимит одновременных запросов к эндпоинту.
+
+    Успешный запрос увеличивает лимит на 1/limit (примерно +1 за «окно» запросов),
+    перегрузка (таймаут, 429/503, рост задержки в latency_tolerance раз относительно
+    долгосрочной средней) уменьшает его в backoff_ratio раз — не чаще раза за текущую задержку.
+    Запросы сверх лимита ждут в очереди FIFO; при переполнении очереди отклоняются.
+    """
+
+    def __init__(self, name: str, initial_limit: int, min_limit: int, max_limit: int, max_queue: int,
+                 backoff_ratio: float = 0.7, latency_tolerance: float = 2.0):
+        self.name = name
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        # Краткосрочная и долгосрочная средние задержки
+        self._short_latency: Optional[float] = None
+        self._long_latency: Optional[float] = None
+        self._last_decrease = 0.0
+        # Метрики
+        self.rejected = 0
+        self.decreases = 0
+
+    async def acquire(self) -> None:
+        """Занимает слот; ждёт в очереди, если лимит исчерпан"""
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise OverloadedError(f"{self.name}: очередь запросов переполнена ({len(self._waiters)})")
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан — возвращаем его
+                self._release_slot()
+            else:
+                try:
+                    self._waiters.remove(future)
+                except ValueError:
+                    pass
+            raise
+
+    def release(self, latency: Optional[float] = None, exc: Optional[BaseException] = None) -> None:
+        """Освобождает слот и корректирует лимит по результату запроса.
+
+        latency=None и exc=None — нейтральный исход (например, отмена).
+        """
+        if exc is not None:
+            if is_overload_signal(exc):
+                self._decrease(f"{type(exc).__name__}")
+        elif latency is not None:
+            self._observe_latency(latency)
+        self._release_slot()
+
+    def queue_length(self) -> int:
+        return len(self._waiters)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queue": len(self._waiters),
+            "rejected": self.rejected,
+            "decreases": self.decreases,
+        }
+
+    def _observe_latency(self, latency: float) -> None:
+        if self._short_latency is None:
+            self._short_latency = self._long_latency = latency
+        else:
+            self._short_latency = 0.7 * self._short_latency + 0.3 * latency
+            self._long_latency = 0.95 * self._long_latency + 0.05 * latency
+
+        if self._short_latency > self._long_latency * self.latency_tolerance:
+            self._decrease(f"задержка {self._short_latency:.1f} сек при средней {self._long_latency:.1f} сек")
+        elif self.limit < self.max_limit and self.in_flight * 2 >= self.limit:
+            # Растём, только если лимит действительно используется
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._wake_waiters()
+
+    def _decrease(self, reason: str) -> None:
+        now = time.monotonic()
+        # Одна перегрузка обычно приходит пачкой ответов — уменьшаем не чаще раза за текущую задержку
+        if now - self._last_decrease < (self._short_latency or 1.0):
+            return
+        self._last_decrease = now
+        new_limit = max(self.min_limit, self.limit * self.backoff_ratio)
+        if int(new_limit) != int(self.limit):
+            logger.warning(f"Лимит {self.name}: {int(self.limit)} -> {int(new_limit)} ({reason})")
+        self.limit = new_limit
+        self.decreases += 1
+
+    def _release_slot(self) -> None:
+        self.in_flight -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self) -> None:
+        while self._waiters and self.in_flight < int(self.limit):
+            future = self._waiters.popleft()
+            if future.done():
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+
+class EndpointGuard:
+    """Circuit breaker, адаптивный лимит конкурентности и политика повторов одного эндпоинта"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.limiter = AdaptiveLimiter(
+            name,
+            initial_limit=settings.adaptive_initial_limit,
+            min_limit=settings.adaptive_min_limit,
+            max_limit=settings.adaptive_max_limit,
+            max_queue=settings.adaptive_max_queue,
+        )
+        self.breaker = CircuitBreaker(
+            name,
+            failure_threshold=settings.circuit_failure_threshold,
+            recovery_timeout=settings.circuit_recovery_seconds,
+        )
+        self.max_retries = settings.upstream_max_retries
+        self.base_delay = settings.upstream_retry_base_delay
+        self.max_delay = settings.upstream_retry_max_delay
+        self.retries = 0
+
+    async def call(self, factory: Callable[[], Awaitable[Any]], idempotent: bool = True) -> Any:
+        """Выполняет запрос factory() через circuit breaker; повторяет идемпотентные запросы"""
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            acquired = False
+            try:
+                await self.limiter.acquire()
+                acquired = True
+                started = time.monotonic()
+                result = await factory()
+            except Exception as e:
+                if acquired:
+                    self.limiter.release(time.monotonic() - started, e)
+                retryable, retry_after = self.record(e)
+                if not (idempotent and retryable) or attempt >= self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt, retry_after)
+                if delay is None:
+                    raise
+                attempt += 1
+                self.retries += 1
+                logger.warning(f"{self.name}: {e!r}, повтор {attempt}/{self.max_retries} через {delay:.1f} сек")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                if acquired:
+                    self.limiter.release()
+                self.breaker.release_probe()
+                raise
+            self.limiter.release(time.monotonic() - started)
+            self.breaker.record_success()
+            return result
+
+    def check(self) -> None:
+        """Проверка перед запросом, который выполняется без call() (например, стриминг)"""
+        self.breaker.before_call()
+
+    def record(self, exc: Optional[BaseException] = None):
+        """Учитывает результат запроса; возвращает классификацию ошибки (повторяемая, Retry-After)"""
+        if exc is None:
+            self.breaker.record_success()
+            return False, None
+        retryable, retry_after = classify_error(exc)
+        if retryable:
+            self.breaker.record_failure()
+        else:
+            self.breaker.release_probe()
+        return retryable, retry_after
+
+    def _retry_delay(self, attempt: int, retry_after: Optional[float]) -> Optional[float]:
+        """Задержка перед повтором: Retry-After, иначе экспонента с полным джиттером"""
+        if retry_after is not None:
+            # Ждать дольше max_delay нет смысла — быстрее вернуть ошибку пользователю
+            return retry_after if retry_after <= self.max_delay else None
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = self.breaker.get_stats()
+        stats["retries"] = self.retries
+        stats["concurrency"] = self.limiter.get_stats()
+        return stats
+
+
+class Resilience:
+    """Набор EndpointGuard по именам эндпоинтов (text, vision, audio, image)"""
+
+    def __init__(self):
+        self._guards: Dict[str, EndpointGuard] = {}
+
+    def guard(self, name: str) -> EndpointGuard:
+        guard = self._guards.get(name)
+        if guard is None:
+            guard = EndpointGuard(name)
+            self._guards[name] = guard
+        return guard
+
+    async def call(self, name: str, factory: Callable[[], Awaitable[Any]], idempotent: bool = True) -> Any:
+        return await self.guard(name).call(factory, idempotent=idempotent)
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: guard.get_stats() for name, guard in self._guards.items()}
+
+
+class Hedger:
+    """Хеджирование идемпотентных запросов для сокращения «хвоста» задержек.
+
+    Если запрос не завершился за percentile-й перцентиль наблюдаемых задержек, запускается
+    второй такой же запрос; используется первый успешный ответ, второй отменяется.
+    Задержки учитываются отдельно для каждого ключа (модели) и считаются от начала
+    первого запроса — время ответа, каким его видит пользователь.
+    Доля хеджированных запросов среди последних window ограничена budget_ratio.
+    """
+
+    def __init__(self, name: str, percentile: float, budget_ratio: float, min_samples: int,
+                 window: int = 200):
+        self.name = name
+        self.percentile = percentile
+        self.budget_ratio = budget_ratio
+        self.min_samples = min_samples
+        self.window = window
+        self._latencies: Dict[str, Deque[float]] = {}
+        # Для каждого из последних запросов — был ли он хеджирован
+        self._recent: Deque[bool] = deque(maxlen=window)
+        # Метрики
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.budget_skipped = 0
+
+    def hedge_delay(self, key: str) -> Optional[float]:
+        """Задержка до запуска второго запроса; None — данных для оценки пока мало"""
+        latencies = self._latencies.get(key)
+        if latencies is None or len(latencies) < self.min_samples:
+            return None
+        ordered = sorted(latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return ordered[index]
+
+    async def call(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Выполняет factory(), при необходимости дублируя запрос. key — модель запроса"""
+        self.requests += 1
+        delay = self.hedge_delay(key)
+        started = time.monotonic()
+        primary = asyncio.ensure_future(factory())
+        if delay is None:
+            self._recent.append(False)
+            return self._observe(key, started, await primary)
+
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+        except BaseException:
+            primary.cancel()
+            raise
+        if done or not self._within_budget():
+            if not done:
+                self.budget_skipped += 1
+            self._recent.append(False)
+            return self._observe(key, started, await primary)
+
+        self._recent.append(True)
+        self.hedged += 1
+        hedge = asyncio.ensure_future(factory())
+        logger.info(f"{self.name}: запрос дольше {delay:.1f} сек, отправлен дублирующий")
+        pending = {primary, hedge}
+        first_error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.cancelled():
+                        continue
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        # Время победителя — от начала первого запроса: иначе быстрый дубль
+                        # занижал бы перцентиль, а медленный отменённый запрос не учитывался бы
+                        return self._observe(key, started, task.result())
+                    first_error = first_error or task.exception()
+            raise first_error or asyncio.CancelledError()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def get_stats(self) -> Dict[str, Any]:
+        delays = {}
+        for key in self._latencies:
+            delay = self.hedge_delay(key)
+            delays[key] = round(delay * 1000) if delay is not None else None
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "budget_skipped": self.budget_skipped,
+            "hedge_delay_ms": delays,
+        }
+
+    def _observe(self, key: str, started: float, result: Any) -> Any:
+        latencies = self._latencies.get(key)
+        if latencies is None:
+            latencies = self._latencies[key] = deque(maxlen=self.window)
+        latencies.append(time.monotonic() - started)
+        return result
+
+    def _within_budget(self) -> bool:
+        hedged_recently = sum(self._recent)
+        return hedged_recently + 1 <= self.budget_ratio * (len(self._recent) + 1)
+
+
+# Глобальные экземпляры
+resilience = Resilience()
+
+# Хеджирование текстовых ответов (send_to_pollinations_async с фиксированным seed), статистика по моделям
+text_hedger = Hedger(
+    "text",
+    percentile=settings.hedging_percentile,
+    budget_ratio=settings.hedging_budget_percent / 100,
+    min_samples=settings.hedging_min_samples,
+)
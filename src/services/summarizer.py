@@ -0,0 +1,134 @@
+"""
+Фоновое сжатие старой части диалога в краткую сводку («память» чата)
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Optional, Set, Tuple
+
+from config.settings import settings
+from services.context_manager import context_manager
+from services.pollinations_service import send_to_pollinations_async
+from utils.telegram_utils import strip_advertisement
+from utils.token_utils import truncate_to_tokens
+
+
+logger = logging.getLogger(__name__)
+
+_SUMMARY_PROMPT = (
+    "Ты сжимаешь историю чата в краткую память для ассистента. "
+    "Сохрани факты, имена участников, договорённости, предпочтения и открытые вопросы. "
+    "Пиши сжато, в третьем лице, без вступлений и комментариев, на языке диалога."
+)
+
+_CONDENSE_PROMPT = (
+    "Объедини несколько сводок одного чата в одну более краткую сводку. "
+    "Сохрани важные факты, имена, договорённости и открытые вопросы, убери повторы. "
+    "Пиши сжато, без вступлений и комментариев."
+)
+
+# Предел паузы между попытками после ошибок подряд (секунды)
+_MAX_RETRY_SECONDS = 3600
+
+
+class ConversationSummarizer:
+    """Сворачивает старые записи контекста в сводки в фоне (не более одной задачи на чат).
+
+    Когда объём сводок превышает summary_memory_max_tokens, они сами сворачиваются
+    в одну сводку следующего уровня. После ошибки чат ждёт перед новой попыткой
+    (экспоненциально растущая пауза), чтобы каждое сообщение не порождало запрос к модели.
+    """
+
+    def __init__(self):
+        self._running: Set[int] = set()
+        # chat_id -> (ошибок подряд, время следующей попытки по time.monotonic)
+        self._backoff: Dict[int, Tuple[int, float]] = {}
+        # Метрики
+        self.summaries = 0
+        self.condensed = 0
+        self.failures = 0
+
+    def maybe_summarize(self, chat_id: int) -> None:
+        """Запускает фоновую суммаризацию, если история чата выросла"""
+        if not settings.summarization_enabled or chat_id in self._running:
+            return
+        backoff = self._backoff.get(chat_id)
+        if backoff is not None and time.monotonic() < backoff[1]:
+            return
+        block = context_manager.get_summary_block(chat_id)
+        if not block:
+            return
+        self._running.add(chat_id)
+        task = asyncio.create_task(self._summarize(chat_id, block))
+        task.add_done_callback(lambda _: self._running.discard(chat_id))
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "summaries": self.summaries,
+            "condensed": self.condensed,
+            "failures": self.failures,
+            "running": len(self._running),
+        }
+
+    def _record_failure(self, chat_id: int) -> None:
+        """Откладывает следующую попытку: пауза удваивается с каждой ошибкой подряд"""
+        self.failures += 1
+        now = time.monotonic()
+        errors = self._backoff.get(chat_id, (0, now))[0] + 1
+        delay = min(settings.summary_retry_seconds * 2 ** (errors - 1), _MAX_RETRY_SECONDS)
+        # Давно истёкшие паузы (например, удалённых чатов) больше не нужны
+        self._backoff = {
+            other: value for other, value in self._backoff.items()
+            if value[1] + _MAX_RETRY_SECONDS > now
+        }
+        self._backoff[chat_id] = (errors, now + delay)
+        logger.info(f"Чат {chat_id}: следующая попытка суммаризации через {delay} сек")
+
+    async def _summarize(self, chat_id: int, block) -> None:
+        try:
+            summary = await self._request(_SUMMARY_PROMPT, context_manager.render_entries(block))
+            if summary is None:
+                self._record_failure(chat_id)
+                return
+            self._backoff.pop(chat_id, None)
+            # Чат мог быть сброшен или вытеснен, пока сводка готовилась: состояние не создаётся заново
+            if not context_manager.apply_summary(chat_id, block, summary):
+                return
+            self.summaries += 1
+            logger.info(f"Чат {chat_id}: {len(block)} старых записей свёрнуто в сводку")
+
+            segments = context_manager.get_memory_segments(chat_id)
+            if len(segments) > 1 and sum(s["tokens"] for s in segments) > settings.summary_memory_max_tokens:
+                condensed = await self._request(
+                    _CONDENSE_PROMPT,
+                    "\n\n".join(segment["content"] for segment in segments)
+                )
+                if condensed is None:
+                    self._record_failure(chat_id)
+                elif context_manager.replace_memory(chat_id, segments, condensed):
+                    self.condensed += 1
+                    logger.info(f"Чат {chat_id}: {len(segments)} сводок объединены в одну")
+        except Exception:
+            self._record_failure(chat_id)
+            logger.exception(f"Ошибка суммаризации контекста чата {chat_id}")
+
+    async def _request(self, instruction: str, text: str) -> Optional[str]:
+        """Текст сводки без рекламы или None, если модель не ответила"""
+        result = await send_to_pollinations_async(
+            messages=[
+                {"role": "system", "content": instruction},
+                {"role": "user", "content": truncate_to_tokens(text, settings.context_token_budget)},
+            ],
+            token=settings.pollinations_token,
+        )
+        # send_to_pollinations_async возвращает ошибки текстом
+        if not result or result.startswith("❌"):
+            logger.warning(f"Не удалось получить сводку: {(result or '')[:100]}")
+            return None
+        # Сводка хранится в памяти чата и уходит в каждый запрос — реклама в ней не нужна
+        summary = strip_advertisement(result).strip()
+        return summary or None
+
+
+# Глобальный экземпляр
+summarizer = ConversationSummarizer()
@@ -0,0 +1,249 @@
+"""
+Двухуровневый кэш: LRU в памяти + контентно-адресуемое хранилище на диске.
+Общая основа кэша изображений и кэшей результатов обработки медиа.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+class TieredCache:
+    """Кэш значений по ключу.
+
+    Память: LRU, ограниченный суммарным размером (memory_limit_bytes) и/или числом записей (max_items).
+    Диск (если задан cache_dir): objects/<xx>/<sha256> — содержимое, keys/<key> — ссылка ключа на sha256
+    и время сохранения. Одинаковые значения под разными ключами хранятся на диске один раз; при
+    превышении disk_limit_bytes или disk_max_items удаляются давно не использованные объекты.
+    ttl_seconds ограничивает время жизни записи в обоих уровнях.
+
+    Подклассы задают преобразование значения в байты (_encode/_decode).
+    """
+
+    def __init__(self, name: str, memory_limit_bytes: Optional[int] = None, max_items: Optional[int] = None,
+                 ttl_seconds: Optional[float] = None, cache_dir: Optional[str] = None,
+                 disk_limit_bytes: Optional[int] = None, disk_max_items: Optional[int] = None):
+        self.name = name
+        self.memory_limit_bytes = memory_limit_bytes
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self.cache_dir = cache_dir or None
+        self.disk_limit_bytes = disk_limit_bytes
+        self.disk_max_items = disk_max_items
+        # key -> (время сохранения, значение, размер в байтах)
+        self._memory: "OrderedDict[str, Tuple[float, Any, int]]" = OrderedDict()
+        self._memory_size = 0
+        # Размер и число объектов на диске считаем лениво при первой записи
+        self._disk_size: Optional[int] = None
+        self._disk_items: Optional[int] = None
+        self._disk_lock = asyncio.Lock()
+        # Счётчики для /health
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    # ----- Преобразование значений (переопределяется в подклассах) -----
+    def _encode(self, value: Any) -> bytes:
+        return value
+
+    def _decode(self, data: bytes) -> Any:
+        return data
+
+    # ----- Публичный интерфейс -----
+    async def get(self, key: str) -> Optional[Any]:
+        """Возвращает значение из кэша или None"""
+        entry = self._memory.get(key)
+        if entry is not None:
+            if not self._expired(entry[0]):
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+            self._forget(key)
+
+        if self.cache_dir:
+            try:
+                stored = await asyncio.to_thread(self._read_disk, key)
+            except Exception as e:
+                logger.warning(f"Ошибка чтения кэша {self.name}: {e}")
+                stored = None
+            if stored is not None:
+                stored_at, data = stored
+                value = self._decode(data)
+                self.disk_hits += 1
+                self._remember(key, stored_at, value, len(data))
+                return value
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, value: Any) -> None:
+        """Сохраняет значение в память и (если настроено) на диск"""
+        if not value:
+            return
+        data = self._encode(value)
+        stored_at = time.time()
+        self._remember(key, stored_at, value, len(data))
+        if not self.cache_dir:
+            return
+        try:
+            async with self._disk_lock:
+                await asyncio.to_thread(self._write_disk, key, stored_at, data)
+        except Exception as e:
+            logger.warning(f"Ошибка записи в кэш {self.name}: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate_percent": round(hits / total * 100, 2) if total else 0.0,
+            "memory_items": len(self._memory),
+            "memory_mb": round(self._memory_size / 1024 / 1024, 2),
+            "disk_items": self._disk_items or 0,
+            "disk_mb": round((self._disk_size or 0) / 1024 / 1024, 2),
+        }
+
+    # ----- Память -----
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - stored_at > self.ttl_seconds
+
+    def _remember(self, key: str, stored_at: float, value: Any, size: int) -> None:
+        if self.memory_limit_bytes is not None and size > self.memory_limit_bytes:
+            return
+        self._forget(key)
+        self._memory[key] = (stored_at, value, size)
+        self._memory_size += size
+        while self._memory and (
+            (self.memory_limit_bytes is not None and self._memory_size > self.memory_limit_bytes)
+            or (self.max_items is not None and len(self._memory) > self.max_items)
+        ):
+            _, (_, _, evicted_size) = self._memory.popitem(last=False)
+            self._memory_size -= evicted_size
+
+    def _forget(self, key: str) -> None:
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_size -= previous[2]
+
+    # ----- Диск (выполняется в отдельном потоке) -----
+    def _key_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, "keys", key)
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, "objects", digest[:2], digest)
+
+    def _read_key(self, key_path: str) -> Tuple[str, float]:
+        """Ссылка ключа: "<sha256> <время сохранения>" (время может отсутствовать)"""
+        with open(key_path, "r", encoding="ascii") as f:
+            parts = f.read().split()
+        return parts[0], float(parts[1]) if len(parts) > 1 else 0.0
+
+    def _read_disk(self, key: str) -> Optional[Tuple[float, bytes]]:
+        key_path = self._key_path(key)
+        if not os.path.exists(key_path):
+            return None
+        digest, stored_at = self._read_key(key_path)
+        object_path = self._object_path(digest)
+        if self._expired(stored_at) or not os.path.exists(object_path):
+            # Запись устарела или объект вытеснен — убираем ссылку
+            try:
+                os.remove(key_path)
+            except OSError:
+                pass
+            return None
+        with open(object_path, "rb") as f:
+            data = f.read()
+        # Обновляем время доступа для вытеснения по давности использования
+        try:
+            os.utime(object_path, None)
+        except OSError:
+            pass
+        return stored_at, data
+
+    def _write_disk(self, key: str, stored_at: float, data: bytes) -> None:
+        if self._disk_size is None:
+            objects = self._list_objects()
+            self._disk_size = sum(size for _, size, _ in objects)
+            self._disk_items = len(objects)
+
+        digest = hashlib.sha256(data).hexdigest()
+        object_path = self._object_path(digest)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            tmp_path = f"{object_path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, object_path)
+            self._disk_size += len(data)
+            self._disk_items += 1
+
+        key_path = self._key_path(key)
+        os.makedirs(os.path.dirname(key_path), exist_ok=True)
+        with open(key_path, "w", encoding="ascii") as f:
+            f.write(f"{digest} {stored_at}")
+
+        if self._disk_over_limit(self._disk_size, self._disk_items, 1.0):
+            self._evict_disk()
+
+    def _disk_over_limit(self, size: int, items: int, fraction: float) -> bool:
+        return (
+            (self.disk_limit_bytes is not None and size > self.disk_limit_bytes * fraction)
+            or (self.disk_max_items is not None and items > self.disk_max_items * fraction)
+        )
+
+    def _list_objects(self):
+        objects_dir = os.path.join(self.cache_dir, "objects")
+        if not os.path.isdir(objects_dir):
+            return []
+        entries = []
+        for root, _, files in os.walk(objects_dir):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict_disk(self) -> None:
+        """Удаляет давно не использованные объекты, пока размер и число не станут ниже 90% лимитов"""
+        entries = sorted(self._list_objects())
+        size = sum(s for _, s, _ in entries)
+        items = len(entries)
+        removed = 0
+        for _, entry_size, path in entries:
+            if not self._disk_over_limit(size, items, 0.9):
+                break
+            try:
+                os.remove(path)
+                size -= entry_size
+                items -= 1
+                removed += 1
+            except OSError:
+                continue
+        self._disk_size = size
+        self._disk_items = items
+
+        # Чистим ссылки на удалённые объекты
+        keys_dir = os.path.join(self.cache_dir, "keys")
+        if removed and os.path.isdir(keys_dir):
+            for name in os.listdir(keys_dir):
+                key_path = os.path.join(keys_dir, name)
+                try:
+                    digest, _ = self._read_key(key_path)
+                    if not os.path.exists(self._object_path(digest)):
+                        os.remove(key_path)
+                except (OSError, ValueError, IndexError):
+                    continue
+        logger.info(f"Кэш {self.name}: вытеснено {removed} объектов, осталось {items} ({size / 1024 / 1024:.1f}MB)")
@@ -0,0 +1,122 @@
+"""
+Пул токенов Pollinations: распределение запросов по наименее загруженному токену
+и временный карантин токенов, получивших 429
+"""
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from config.settings import settings
+from services.resilience import parse_retry_after
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenStats:
+    """Счётчики использования одного токена"""
+
+    def __init__(self, token: str):
+        self.token = token
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.quarantined_until = 0.0
+
+
+class TokenLease:
+    """Токен, выданный на один запрос. Контекстный менеджер: по выходу освобождает токен"""
+
+    def __init__(self, pool: "TokenPool", stats: Optional[TokenStats], token: str):
+        self._pool = pool
+        self._stats = stats
+        self.token = token
+        self._status_failed = False
+
+    def observe(self, status: int, retry_after: Optional[str] = None) -> None:
+        """Учитывает HTTP-статус ответа; 429 отправляет токен в карантин"""
+        if self._stats is None or status == 200:
+            return
+        self._status_failed = True
+        if status == 429:
+            self._pool.quarantine(self._stats, parse_retry_after(retry_after))
+
+    def release(self, failed: bool = False) -> None:
+        """Возвращает токен в пул (для использования без with)"""
+        if self._stats is None:
+            return
+        self._stats.in_flight -= 1
+        if failed or self._status_failed:
+            self._stats.errors += 1
+        self._stats = None
+
+    def __enter__(self) -> "TokenLease":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.release(failed=exc_type is not None)
+
+
+class TokenPool:
+    """Набор токенов с выбором наименее загруженного.
+
+    Токен с 429 не выдаётся, пока не истечёт Retry-After (или quarantine_seconds).
+    Если в карантине все токены, выдаётся тот, чей карантин закончится раньше.
+    """
+
+    def __init__(self, tokens: List[str], quarantine_seconds: float):
+        self.quarantine_seconds = quarantine_seconds
+        self._tokens: Dict[str, TokenStats] = {}
+        for token in tokens:
+            if token and token not in self._tokens:
+                self._tokens[token] = TokenStats(token)
+
+    def lease(self, token: Optional[str] = None) -> TokenLease:
+        """Выдаёт токен из пула. Токен не из пула (переданный явно) используется как есть"""
+        if token and token not in self._tokens:
+            return TokenLease(self, None, token)
+        if not self._tokens:
+            return TokenLease(self, None, token or "")
+
+        now = time.monotonic()
+        available = [s for s in self._tokens.values() if s.quarantined_until <= now]
+        if available:
+            stats = min(available, key=lambda s: (s.in_flight, s.requests))
+        else:
+            stats = min(self._tokens.values(), key=lambda s: s.quarantined_until)
+        stats.in_flight += 1
+        stats.requests += 1
+        return TokenLease(self, stats, stats.token)
+
+    def quarantine(self, stats: TokenStats, retry_after: Optional[float] = None) -> None:
+        duration = retry_after if retry_after is not None else self.quarantine_seconds
+        stats.rate_limited += 1
+        stats.quarantined_until = max(stats.quarantined_until, time.monotonic() + duration)
+        logger.warning(f"Токен {self._mask(stats.token)} получил 429, карантин {duration:.0f} сек")
+
+    def get_stats(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        return [
+            {
+                "token": self._mask(s.token),
+                "in_flight": s.in_flight,
+                "requests": s.requests,
+                "errors": s.errors,
+                "rate_limited": s.rate_limited,
+                "quarantine_seconds": max(0, round(s.quarantined_until - now)),
+            }
+            for s in self._tokens.values()
+        ]
+
+    @staticmethod
+    def _mask(token: str) -> str:
+        """Последние символы токена — для логов и /health"""
+        return f"…{token[-4:]}" if len(token) > 4 else "…"
+
+
+# Глобальный пул: основной токен и дополнительные из POLLINATIONS_TOKENS
+token_pool = TokenPool(
+    tokens=[settings.pollinations_token] + [t.strip() for t in settings.pollinations_tokens.split(",")],
+    quarantine_seconds=settings.token_quarantine_seconds,
+)
@@ -0,0 +1,170 @@
+"""
+Конвертация аудио через ffmpeg в памяти (stdin -> stdout, без временных файлов)
+
+Все процессы ffmpeg запускаются через общий ограниченный пул media_pool.
+"""
+import asyncio
+import io
+import logging
+import re
+import wave
+from typing import List, Optional, Tuple
+
+from utils.media_pool import media_pool
+
+
+logger = logging.getLogger(__name__)
+
+# Параметры PCM, которые ожидает модель транскрипции
+SAMPLE_RATE = 16000
+CHANNELS = 1
+
+
+class AudioConversionError(Exception):
+    """ffmpeg завершился с ошибкой"""
+
+
+async def _run_ffmpeg_process(args: List[str], data: bytes, timeout: Optional[float] = None,
+                              priority: float = 0.0) -> Tuple[int, bytes, bytes]:
+    """Запускает ffmpeg с данными на stdin в общем пуле, возвращает (код возврата, stdout, stderr).
+
+    priority — длительность записи: короткие записи обрабатываются раньше.
+    """
+    return await media_pool.run(lambda: _exec_ffmpeg(args, data), priority=priority, timeout=timeout)
+
+
+async def _exec_ffmpeg(args: List[str], data: bytes) -> Tuple[int, bytes, bytes]:
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-hide_banner', '-nostdin', *args,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await process.communicate(input=bytes(data))
+    except asyncio.CancelledError:
+        # Отмена или таймаут пула — не оставляем процесс висеть
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    return process.returncode, stdout, stderr
+
+
+async def run_ffmpeg(data: bytes, output_args: List[str], input_args: Optional[List[str]] = None,
+                     timeout: Optional[float] = None, priority: float = 0.0) -> bytes:
+    """Пропускает данные через ffmpeg: вход — stdin, результат — stdout.
+
+    FileNotFoundError пробрасывается, если ffmpeg не установлен.
+    """
+    returncode, stdout, stderr = await _run_ffmpeg_process(
+        ['-loglevel', 'error', *(input_args or []), '-i', 'pipe:0', *output_args, 'pipe:1'],
+        data,
+        timeout=timeout,
+        priority=priority
+    )
+    if returncode != 0:
+        raise AudioConversionError(stderr.decode(errors="replace").strip() or f"код возврата {returncode}")
+    return stdout
+
+
+def pcm_to_wav(pcm: bytes, sample_rate: int = SAMPLE_RATE, channels: int = CHANNELS) -> bytes:
+    """Оборачивает сырой PCM s16le в WAV-контейнер.
+
+    ffmpeg не может дописать размеры в заголовок WAV при выводе в pipe, поэтому заголовок
+    формируем сами.
+    """
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm)
+    return buffer.getvalue()
+
+
+async def encode_for_transcription(data: bytes, audio_format: str, bitrate_kbps: int = 32,
+                                   timeout: Optional[float] = None, start: Optional[float] = None,
+                                   duration: Optional[float] = None, priority: float = 0.0) -> bytes:
+    """Готовит голосовое сообщение Telegram (OGG/Opus) к загрузке в заданном формате.
+
+    ogg — исходные байты без перекодирования, mp3 — 16 кГц моно с битрейтом bitrate_kbps,
+    wav — несжатый PCM (самый большой, используется в последнюю очередь).
+    start/duration вырезают фрагмент (для ogg в этом случае Opus перекодируется).
+    """
+    segment_args = []
+    if start is not None:
+        segment_args += ['-ss', f'{start:.3f}']
+    if duration is not None:
+        segment_args += ['-t', f'{duration:.3f}']
+
+    if audio_format == "ogg":
+        if not segment_args:
+            return bytes(data)
+        return await run_ffmpeg(
+            data,
+            [*segment_args, '-f', 'ogg', '-acodec', 'libopus', '-ar', str(SAMPLE_RATE), '-ac', str(CHANNELS),
+             '-b:a', f'{bitrate_kbps}k'],
+            timeout=timeout,
+            priority=priority
+        )
+    if audio_format == "mp3":
+        return await run_ffmpeg(
+            data,
+            [*segment_args, '-f', 'mp3', '-acodec', 'libmp3lame', '-ar', str(SAMPLE_RATE), '-ac', str(CHANNELS),
+             '-b:a', f'{bitrate_kbps}k'],
+            timeout=timeout,
+            priority=priority
+        )
+    if audio_format == "wav":
+        pcm = await run_ffmpeg(
+            data,
+            [*segment_args, '-f', 's16le', '-acodec', 'pcm_s16le', '-ar', str(SAMPLE_RATE), '-ac', str(CHANNELS)],
+            timeout=timeout,
+            priority=priority
+        )
+        return pcm_to_wav(pcm)
+    raise ValueError(f"Неподдерживаемый формат загрузки аудио: {audio_format}")
+
+
+_SILENCE_START_RE = re.compile(r"silence_start:\s*(-?[\d.]+)")
+_SILENCE_END_RE = re.compile(r"silence_end:\s*(-?[\d.]+)")
+
+
+async def detect_silences(data: bytes, noise_db: int = -30, min_silence: float = 0.4,
+                          timeout: Optional[float] = None, priority: float = 0.0) -> List[float]:
+    """Возвращает середины пауз (в секундах), найденных фильтром silencedetect"""
+    returncode, _, stderr = await _run_ffmpeg_process(
+        ['-loglevel', 'info', '-i', 'pipe:0',
+         '-af', f'silencedetect=noise={noise_db}dB:d={min_silence}', '-f', 'null', '-'],
+        data,
+        timeout=timeout,
+        priority=priority
+    )
+    if returncode != 0:
+        raise AudioConversionError(stderr.decode(errors="replace").strip()[-500:] or f"код возврата {returncode}")
+
+    output = stderr.decode(errors="replace")
+    starts = [float(m) for m in _SILENCE_START_RE.findall(output)]
+    ends = [float(m) for m in _SILENCE_END_RE.findall(output)]
+    return [max(0.0, (start + end) / 2) for start, end in zip(starts, ends)]
+
+
+def plan_chunks(total_duration: float, silences: List[float], max_chunk: float) -> List[Tuple[float, float]]:
+    """Делит запись на фрагменты не длиннее max_chunk, разрезая по паузам.
+
+    Возвращает список (начало, длительность). Если подходящей паузы нет,
+    фрагмент режется ровно по max_chunk.
+    """
+    chunks = []
+    start = 0.0
+    min_chunk = max_chunk / 3
+    while total_duration - start > max_chunk:
+        limit = start + max_chunk
+        candidates = [t for t in silences if start + min_chunk <= t <= limit]
+        cut = candidates[-1] if candidates else limit
+        chunks.append((start, cut - start))
+        start = cut
+    if total_duration - start > 0:
+        chunks.append((start, total_duration - start))
+    return chunks
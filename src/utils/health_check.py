@@ -5,7 +5,17 @@ import time
 import psutil
 import logging
 from typing import Dict, Any
+from config.settings import settings
 from services.context_manager import context_manager
+from services.context_entry import Role
+from services.image_cache import image_cache
+from services.file_id_cache import file_id_cache
+from services.media_cache import transcription_cache, image_analysis_cache
+from utils.media_pool import media_pool
+from services.resilience import resilience, text_hedger
+from services.model_router import model_router
+from services.token_pool import token_pool
+from services.summarizer import summarizer
 
 logger = logging.getLogger(__name__)
 
@@ -35,8 +45,8 @@ def get_health_status() -> Dict[str, Any]:
         disk_info = psutil.disk_usage('/')
         
         # Получаем информацию о контекстах
-        active_contexts = len(context_manager.contexts)
-        total_messages = sum(len(msgs) for msgs in context_manager.contexts.values())
+        active_contexts = len(context_manager.chats)
+        total_messages = sum(len(state.context) for state in context_manager.chats.values())
         
         # Вычисляем uptime
         uptime_seconds = time.time() - _start_time
@@ -58,6 +68,16 @@ def get_health_status() -> Dict[str, Any]:
             "request_count": _request_count,
             "error_count": _error_count,
             "error_rate_percent": round(error_rate, 2),
+            "image_cache": image_cache.get_stats(),
+            "file_id_cache": file_id_cache.get_stats(),
+            "transcription_cache": transcription_cache.get_stats(),
+            "image_analysis_cache": image_analysis_cache.get_stats(),
+            "media_pool": media_pool.get_stats(),
+            "upstream": resilience.get_stats(),
+            "models": model_router.get_stats(),
+            "tokens": token_pool.get_stats(),
+            "summarizer": summarizer.get_stats() if settings.summarization_enabled else None,
+            "hedging": text_hedger.get_stats() if settings.hedging_enabled else None,
             "timestamp": time.time()
         }
     except Exception as e:
@@ -74,9 +94,10 @@ def get_performance_metrics() -> Dict[str, Any]:
     try:
         # Получаем статистику по чатам
         chat_stats = {}
-        for chat_id, messages in context_manager.contexts.items():
-            user_messages = len([msg for msg in messages if msg.get("role") == "user"])
-            assistant_messages = len([msg for msg in messages if msg.get("role") == "assistant"])
+        for chat_id, state in context_manager.chats.items():
+            messages = state.context
+            user_messages = len([msg for msg in messages if msg.role is Role.USER])
+            assistant_messages = len([msg for msg in messages if msg.role is Role.ASSISTANT])
             
             chat_stats[str(chat_id)] = {
                 "total_messages": len(messages),
@@ -86,9 +107,9 @@ def get_performance_metrics() -> Dict[str, Any]:
             }
         
         return {
-            "total_chats": len(context_manager.contexts),
+            "total_chats": len(context_manager.chats),
             "chat_statistics": chat_stats,
-            "average_context_size": sum(len(msgs) for msgs in context_manager.contexts.values()) / max(len(context_manager.contexts), 1),
+            "average_context_size": sum(len(state.context) for state in context_manager.chats.values()) / max(len(context_manager.chats), 1),
             "timestamp": time.time()
         }
     except Exception as e:
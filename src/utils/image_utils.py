@@ -0,0 +1,86 @@
+"""
+Подготовка изображений перед отправкой в vision-модель
+"""
+import io
+import logging
+from typing import Sequence, Tuple
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow не установлен — изображения отправляются как есть
+    Image = None
+    ImageOps = None
+
+
+logger = logging.getLogger(__name__)
+
+if Image is None:
+    logger.warning("Pillow не установлен: изображения отправляются на анализ без уменьшения")
+
+# Форматы, в которые допускается перекодирование (формат PIL -> формат для data URL)
+_OUTPUT_FORMATS = {"jpeg": "JPEG", "webp": "WEBP"}
+
+
+def select_photo_size(photo_sizes: Sequence, max_edge: int):
+    """Выбирает наименьший PhotoSize, у которого большая сторона не меньше max_edge.
+
+    Telegram присылает несколько копий фото разного размера (по возрастанию).
+    Если ни одна копия не достигает max_edge, возвращается самая большая.
+    """
+    if not photo_sizes:
+        return None
+    for size in sorted(photo_sizes, key=lambda s: max(s.width or 0, s.height or 0)):
+        if max(size.width or 0, size.height or 0) >= max_edge:
+            return size
+    return max(photo_sizes, key=lambda s: max(s.width or 0, s.height or 0))
+
+
+def prepare_image_for_vision(data, image_format: str, max_edge: int, quality: int, output_format: str = "jpeg") -> Tuple[bytes, str]:
+    """Уменьшает изображение до max_edge по большей стороне и перекодирует его.
+
+    Выполняется синхронно — вызывать через asyncio.to_thread.
+    Возвращает (байты, формат). При любой ошибке или без Pillow возвращает исходные данные.
+    """
+    data = bytes(data)
+    if Image is None:
+        return data, image_format
+
+    output_format = output_format.lower()
+    if output_format not in _OUTPUT_FORMATS:
+        output_format = "jpeg"
+
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            # Анимированные изображения не трогаем, чтобы не потерять кадры
+            if getattr(img, "is_animated", False):
+                return data, image_format
+
+            width, height = img.size
+            needs_resize = max(width, height) > max_edge
+            same_format = image_format.lower() in ("jpg", "jpeg") and output_format == "jpeg"
+            if not needs_resize and same_format:
+                return data, image_format
+
+            img = ImageOps.exif_transpose(img)
+            if needs_resize:
+                img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+
+            buffer = io.BytesIO()
+            img.save(buffer, format=_OUTPUT_FORMATS[output_format], quality=quality, optimize=True)
+            result = buffer.getvalue()
+    except Exception as e:
+        logger.warning(f"Не удалось подготовить изображение, отправляем как есть: {e}")
+        return data, image_format
+
+    # Перекодирование без уменьшения иногда даёт больший файл — тогда оставляем исходник
+    if not needs_resize and len(result) >= len(data):
+        return data, image_format
+
+    logger.debug(
+        f"Изображение подготовлено: {width}x{height} -> {img.size[0]}x{img.size[1]}, "
+        f"{len(data) // 1024}KB -> {len(result) // 1024}KB"
+    )
+    return result, output_format
+
@@ -0,0 +1,111 @@
+"""
+Ограниченный пул обработки медиа (ffmpeg): очередь с приоритетом коротких задач
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from config.settings import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class MediaPool:
+    """Ограничивает число одновременно выполняемых тяжёлых задач (процессов ffmpeg).
+
+    Задачи сверх лимита ждут в очереди; первой получает слот задача с наименьшим
+    приоритетом (длительностью записи), при равенстве — пришедшая раньше.
+    Таймаут считается от начала выполнения, время в очереди в него не входит.
+    """
+
+    def __init__(self, max_workers: int, default_timeout: Optional[float] = None):
+        self.max_workers = max_workers
+        self.default_timeout = default_timeout
+        self._active = 0
+        self._waiters: List[Tuple[float, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        # Метрики
+        self.jobs = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.max_queue_depth = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    async def run(self, factory: Callable[[], Awaitable[Any]], priority: float = 0.0,
+                  timeout: Optional[float] = None) -> Any:
+        """Выполняет factory() в пуле; меньший priority — раньше в очереди"""
+        enqueued_at = time.monotonic()
+        await self._acquire(priority)
+        waited = time.monotonic() - enqueued_at
+        self._total_wait += waited
+        self._max_wait = max(self._max_wait, waited)
+        self.jobs += 1
+        if waited > 1:
+            logger.info(f"Задача обработки медиа ждала в очереди {waited:.1f} сек")
+
+        try:
+            return await asyncio.wait_for(factory(), timeout=timeout if timeout is not None else self.default_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            self._release()
+
+    def queue_depth(self) -> int:
+        """Количество задач, ожидающих слот"""
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.max_workers,
+            "active": self._active,
+            "queue_depth": self.queue_depth(),
+            "max_queue_depth": self.max_queue_depth,
+            "jobs": self.jobs,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+            "avg_wait_ms": round(self._total_wait / self.jobs * 1000, 1) if self.jobs else 0.0,
+            "max_wait_ms": round(self._max_wait * 1000, 1),
+        }
+
+    async def _acquire(self, priority: float) -> None:
+        if self._active < self.max_workers and not self.queue_depth():
+            self._active += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth())
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Слот уже был передан этой задаче — отдаём его следующей
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        # Слот передаётся следующему ожидающему напрямую, без уменьшения счётчика
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._active -= 1
+
+
+# Глобальный пул процессов ffmpeg
+media_pool = MediaPool(
+    max_workers=settings.media_workers,
+    default_timeout=settings.voice_processing_timeout,
+)
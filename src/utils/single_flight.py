@@ -0,0 +1,86 @@
+"""
+Объединение одинаковых одновременных запросов (single-flight)
+"""
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    """Выполняющийся запрос и количество ожидающих его вызывающих"""
+
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Гарантирует, что для одного ключа одновременно выполняется только один запрос.
+
+    Все конкурентные вызовы с тем же ключом ожидают общий результат. Если ожидающий
+    вызов отменён, отменяется только он; сам запрос отменяется, когда не остаётся
+    ни одного ожидающего.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(endpoint: str, payload: Dict[str, Any]) -> str:
+        """Строит канонический ключ запроса по эндпоинту и полезной нагрузке"""
+        canonical = json.dumps(
+            {"endpoint": endpoint, "payload": payload},
+            sort_keys=True,
+            ensure_ascii=False,
+            separators=(",", ":"),
+            default=str,
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Выполняет factory() либо присоединяется к уже идущему запросу с тем же ключом"""
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(factory()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _t, k=key, c=call: self._forget(k, c))
+            self.started += 1
+        else:
+            self.coalesced += 1
+            logger.debug(f"single-flight: присоединяемся к запросу {key[:12]} (ожидающих: {call.waiters + 1})")
+
+        call.waiters += 1
+        try:
+            # shield: отмена одного ожидающего не должна отменять общий запрос
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # Никто больше не ждёт результата — отменяем запрос и сразу убираем ключ,
+                # чтобы новые вызовы не присоединились к отменяемой задаче
+                self._forget(key, call)
+                call.task.cancel()
+
+    def _forget(self, key: str, call: _Call):
+        if self._calls.get(key) is call:
+            self._calls.pop(key, None)
+
+    def in_flight(self) -> int:
+        """Количество выполняющихся уникальных запросов"""
+        return len(self._calls)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": self.in_flight(),
+            "started": self.started,
+            "coalesced": self.coalesced,
+        }
@@ -1,15 +1,22 @@
 import asyncio
 import logging
 import re
+import time
+from typing import List, Optional, Tuple
 from telegram.constants import ChatAction, ParseMode
-from telegram import Update
+from telegram import Update, Message
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import CallbackContext
 from config.settings import settings
+from services.file_id_cache import file_id_cache
 
 
 logger = logging.getLogger(__name__)
 
 
+# Предел длины текста одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
 # Паттерны для различных типов рекламы
 ADVERTISEMENT_PATTERNS = [
     # Оригинальный паттерн для pollinations.ai
@@ -182,6 +189,268 @@ async def send_long_message(context: CallbackContext, chat_id: int, text: str, r
 
 
 
+async def send_photo_cached(bot, chat_id: int, content: bytes, generation_key: Optional[str] = None, **kwargs) -> Message:
+    """Отправляет изображение, переиспользуя file_id от предыдущей загрузки того же изображения.
+
+    Если file_id неизвестен или Telegram его отклонил — загружает байты и запоминает новый file_id.
+    """
+    keys = file_id_cache.build_keys(content=content, generation_key=generation_key)
+    file_id = file_id_cache.get(keys)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            logger.warning(f"Telegram отклонил сохранённый file_id, загружаем заново: {e}")
+            file_id_cache.invalidate(file_id)
+
+    sent = await bot.send_photo(chat_id=chat_id, photo=content, **kwargs)
+    if sent and sent.photo:
+        file_id_cache.put(sent.photo[-1].file_id, keys)
+    return sent
+
+
+async def send_photo_by_url(bot, chat_id: int, url: str, generation_key: Optional[str] = None, **kwargs) -> Optional[Message]:
+    """Отправляет изображение по URL: Telegram сам скачивает его, минуя бота.
+
+    Возвращает None, только если Telegram отклонил URL (BadRequest) — тогда нужно отправить байты.
+    Таймауты и сетевые ошибки пробрасываются: фото могло уже дойти, и отправка байтов его задублирует.
+    """
+    keys = file_id_cache.build_keys(generation_key=generation_key)
+    file_id = file_id_cache.get(keys)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            logger.warning(f"Telegram отклонил сохранённый file_id: {e}")
+            file_id_cache.invalidate(file_id)
+
+    try:
+        sent = await bot.send_photo(chat_id=chat_id, photo=url, read_timeout=settings.api_timeout, **kwargs)
+    except BadRequest as e:
+        logger.warning(f"Telegram не смог загрузить изображение по URL: {e}")
+        return None
+
+    if sent and sent.photo:
+        file_id_cache.put(sent.photo[-1].file_id, keys)
+    return sent
+
+
+class StreamingMessage:
+    """Прогрессивно выводит ответ модели в сообщения Telegram по мере генерации.
+
+    Правки выполняются не чаще, чем раз в edit_interval секунд. При превышении
+    max_length текущее сообщение финализируется и вывод продолжается в новом.
+    Во время стриминга текст показывается без разметки, финальная правка — в Markdown;
+    сообщение режется и так, чтобы текст после форматирования не превысил TELEGRAM_MESSAGE_LIMIT.
+    """
+
+    CURSOR = " ▌"
+
+    def __init__(self, bot, chat_id: int, reply_to_message_id: Optional[int] = None,
+                 placeholder: Optional[Message] = None, max_length: int = 4000,
+                 edit_interval: Optional[float] = None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.reply_to_message_id = reply_to_message_id
+        self.max_length = max_length
+        if edit_interval is None:
+            edit_interval = settings.stream_edit_interval_ms / 1000
+        self.edit_interval = edit_interval
+        # Сообщение, в которое сейчас идёт вывод (может быть "💭 Думаю..." заглушкой)
+        self._current: Optional[Message] = placeholder
+        # Уже финализированные сообщения
+        self.sent_messages: List[Message] = []
+        self._text = ""
+        # Позиция в полном тексте, с которой начинается текущее сообщение
+        self._segment_start = 0
+        self._shown = None
+        self._next_edit_at = 0.0
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    async def append(self, chunk: str):
+        """Добавляет часть ответа и при необходимости обновляет сообщение"""
+        if not chunk:
+            return
+        self._text += chunk
+
+        while len(self._text) - self._segment_start > self.max_length:
+            await self._rollover()
+
+        if time.monotonic() >= self._next_edit_at:
+            segment = self._text[self._segment_start:]
+            if segment.strip():
+                await self._render(segment + self.CURSOR, final=False)
+
+    async def finish(self, final_text: Optional[str] = None):
+        """Выполняет финальную правку с Markdown. final_text — очищенная версия полного текста"""
+        if final_text is not None and final_text != self._text:
+            await self._rewrite(final_text)
+            return
+
+        while not self._fits(self._text[self._segment_start:]):
+            await self._rollover()
+
+        segment = self._text[self._segment_start:].strip()
+        if segment:
+            await self._render(segment, final=True)
+        elif self._current is not None:
+            # Нечего показывать (например, реклама в хвосте) — убираем пустое сообщение
+            try:
+                await self.bot.delete_message(chat_id=self.chat_id, message_id=self._current.message_id)
+            except Exception as e:
+                logger.debug(f"StreamingMessage: не удалось удалить пустое сообщение: {e}")
+            self._current = None
+
+    async def _rewrite(self, final_text: str):
+        """Заменяет весь показанный текст: заново делит его на сообщения и правит только изменившиеся"""
+        old_segments = [segment for _, segment in self._split(self._text)]
+        new_segments = self._split(final_text)
+        messages = self.sent_messages + ([self._current] if self._current is not None else [])
+
+        self._text = final_text
+        self.sent_messages = []
+        self._current = None
+        self._segment_start = len(final_text)
+        for index, (start, segment) in enumerate(new_segments):
+            is_last = index == len(new_segments) - 1
+            self._current = messages[index] if index < len(messages) else None
+            self._shown = None
+            unchanged = index < len(messages) - 1 and index < len(old_segments) and old_segments[index] == segment
+            if is_last or not unchanged:
+                await self._render(segment, final=True)
+            if is_last:
+                self._segment_start = start
+            elif self._current is not None:
+                self.sent_messages.append(self._current)
+
+        # Лишние сообщения (текст стал короче) удаляем
+        for message in messages[len(new_segments):]:
+            try:
+                await self.bot.delete_message(chat_id=self.chat_id, message_id=message.message_id)
+            except Exception as e:
+                logger.debug(f"StreamingMessage: не удалось удалить лишнее сообщение: {e}")
+        if not new_segments:
+            self._current = None
+
+    def _split(self, text: str) -> List[Tuple[int, str]]:
+        """Делит текст на сообщения так же, как при стриминге: [(начало в тексте, текст сообщения)]"""
+        segments = []
+        start = 0
+        while not self._fits(text[start:]):
+            cut = self._segment_cut(text, start)
+            segment = text[start:start + cut].strip()
+            if segment:
+                segments.append((start, segment))
+            start += cut
+            while start < len(text) and text[start] in " \n":
+                start += 1
+        tail = text[start:].strip()
+        if tail:
+            segments.append((start, tail))
+        return segments
+
+    def _fits(self, segment: str) -> bool:
+        """Помещается ли текст в одно сообщение — и как есть, и после форматирования для Markdown"""
+        if len(segment) > self.max_length:
+            return False
+        return len(safe_format_for_telegram(segment.strip())) <= TELEGRAM_MESSAGE_LIMIT
+
+    def _segment_cut(self, text: str, start: int) -> int:
+        """Длина очередного сообщения, начиная с позиции start: не больше max_length и предела после форматирования"""
+        window = text[start:start + self.max_length]
+        cut = self._cut(window)
+        # Экранирование и разметка могут удлинить текст — укорачиваем, пока не поместится
+        while cut > 1 and len(safe_format_for_telegram(window[:cut].strip())) > TELEGRAM_MESSAGE_LIMIT:
+            cut = self._cut(window[:cut - 1])
+        return cut
+
+    @staticmethod
+    def _cut(window: str) -> int:
+        """Позиция разреза окна: по последнему переводу строки, пробелу или по длине"""
+        cut = window.rfind('\n')
+        if cut <= 0:
+            cut = window.rfind(' ')
+        if cut <= 0:
+            cut = len(window)
+        return cut
+
+    async def _rollover(self):
+        """Финализирует текущее сообщение и переносит вывод в новое"""
+        cut = self._segment_cut(self._text, self._segment_start)
+
+        segment = self._text[self._segment_start:self._segment_start + cut].strip()
+        if segment:
+            await self._render(segment, final=True)
+            if self._current is not None:
+                self.sent_messages.append(self._current)
+            self._current = None
+            self._shown = None
+
+        self._segment_start += cut
+        while self._segment_start < len(self._text) and self._text[self._segment_start] in " \n":
+            self._segment_start += 1
+
+    async def _render(self, text: str, final: bool):
+        """Отправляет или редактирует текущее сообщение"""
+        if not final and text == self._shown:
+            return
+
+        attempts = 2 if final else 1
+        for attempt in range(attempts):
+            try:
+                if final:
+                    await self._send_or_edit(safe_format_for_telegram(text), ParseMode.MARKDOWN)
+                else:
+                    await self._send_or_edit(text, None)
+                break
+            except RetryAfter as e:
+                retry_after = float(getattr(e, "retry_after", 1) or 1)
+                logger.debug(f"StreamingMessage: Telegram просит подождать {retry_after}s")
+                self._next_edit_at = time.monotonic() + retry_after
+                if not final or attempt == attempts - 1:
+                    return
+                await asyncio.sleep(retry_after)
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    break
+                if final:
+                    # Markdown не принят — отправляем обычным текстом
+                    logger.debug(f"StreamingMessage: Markdown edit failed: {e}")
+                    try:
+                        await self._send_or_edit(text, None)
+                    except Exception as e2:
+                        logger.error(f"StreamingMessage: ошибка финальной правки: {e2}")
+                    break
+                logger.debug(f"StreamingMessage: edit failed: {e}")
+                return
+            except Exception as e:
+                logger.debug(f"StreamingMessage: edit failed: {e}")
+                return
+
+        self._shown = text
+        self._next_edit_at = time.monotonic() + self.edit_interval
+
+    async def _send_or_edit(self, text: str, parse_mode: Optional[str]):
+        if self._current is None:
+            reply_to = self.reply_to_message_id if not self.sent_messages else None
+            self._current = await self.bot.send_message(
+                chat_id=self.chat_id,
+                text=text,
+                parse_mode=parse_mode,
+                reply_to_message_id=reply_to
+            )
+        else:
+            await self.bot.edit_message_text(
+                chat_id=self.chat_id,
+                message_id=self._current.message_id,
+                text=text,
+                parse_mode=parse_mode
+            )
+
+
 def strip_advertisement(text: str) -> str:
     """Удаляет рекламные блоки из текста, оставляя остальной текст без изменений."""
     try:
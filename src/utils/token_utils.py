@@ -0,0 +1,40 @@
+"""
+Приблизительная оценка числа токенов текста (без токенизатора модели)
+"""
+from typing import Dict, Optional
+
+# Служебные токены на каждое сообщение (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+TRUNCATION_MARK = "\n… [сообщение сокращено]"
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Оценивает число токенов: около 4 байт UTF-8 на токен.
+
+    Для латиницы это ~4 символа на токен, для кириллицы ~2 — близко к BPE-токенизаторам
+    моделей OpenAI, при этом оценка не требует зависимостей и считается за один проход.
+    """
+    if not text:
+        return MESSAGE_OVERHEAD_TOKENS
+    return MESSAGE_OVERHEAD_TOKENS + (len(text.encode("utf-8")) + 3) // 4
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Обрезает текст так, чтобы его оценка не превышала max_tokens (с пометкой о сокращении)"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    budget_bytes = max(0, (max_tokens - MESSAGE_OVERHEAD_TOKENS) * 4 - len(TRUNCATION_MARK.encode("utf-8")))
+    head = text.encode("utf-8")[:budget_bytes].decode("utf-8", errors="ignore")
+    return head.rstrip() + TRUNCATION_MARK
+
+
+def parse_token_budgets(value: str) -> Dict[str, int]:
+    """Разбирает строку вида "openai:8000,mistral:6000" в словарь модель -> бюджет"""
+    budgets = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        model, _, budget = item.rpartition(":")
+        budgets[model.strip()] = int(budget)
+    return budgets
@@ -0,0 +1,12 @@
+"""
+Общая настройка тестов: путь к исходникам и обязательные переменные окружения
+"""
+import os
+import sys
+
+# Добавляем src в путь для импортов (как в run.py)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# config.settings требует токены при импорте — тестам хватает фиктивных
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "test-telegram-token")
+os.environ.setdefault("POLLINATIONS_TOKEN", "test-pollinations-token")
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+from utils import audio_utils
+from utils.audio_utils import AudioConversionError, detect_silences, plan_chunks
+
+
+def test_short_recording_is_one_chunk():
+    assert plan_chunks(30.0, [10.0, 20.0], max_chunk=60.0) == [(0.0, 30.0)]
+
+
+def test_cuts_at_last_silence_before_limit():
+    chunks = plan_chunks(150.0, [20.0, 50.0, 70.0, 110.0], max_chunk=60.0)
+    assert chunks == [(0.0, 50.0), (50.0, 60.0), (110.0, 40.0)]
+
+
+def test_cuts_at_limit_without_suitable_silence():
+    # Пауза на 5-й секунде даёт слишком короткий фрагмент (меньше max_chunk / 3)
+    chunks = plan_chunks(130.0, [5.0], max_chunk=60.0)
+    assert chunks == [(0.0, 60.0), (60.0, 60.0), (120.0, 10.0)]
+
+
+@pytest.mark.parametrize("total, silences", [
+    (600.0, []),
+    (601.5, [12.0, 44.0, 59.9, 61.0, 150.0, 290.0, 400.0, 599.0]),
+    (61.0, [60.5]),
+])
+def test_chunks_cover_recording_without_gaps(total, silences):
+    chunks = plan_chunks(total, silences, max_chunk=60.0)
+    position = 0.0
+    for start, duration in chunks:
+        assert start == pytest.approx(position)
+        assert 0 < duration <= 60.0 + 1e-9
+        position = start + duration
+    assert position == pytest.approx(total)
+
+
+def _fake_ffmpeg(returncode, stderr):
+    async def run(args, data, timeout=None, priority=0.0):
+        return returncode, b"", stderr.encode()
+    return run
+
+
+def test_detect_silences_returns_midpoints(monkeypatch):
+    stderr = (
+        "[silencedetect @ 0x1] silence_start: -0.01\n"
+        "[silencedetect @ 0x1] silence_end: 0.81 | silence_duration: 0.82\n"
+        "[silencedetect @ 0x1] silence_start: 12.5\n"
+        "[silencedetect @ 0x1] silence_end: 13.5 | silence_duration: 1\n"
+        # Пауза до конца записи без silence_end не учитывается
+        "[silencedetect @ 0x1] silence_start: 40\n"
+    )
+    monkeypatch.setattr(audio_utils, "_run_ffmpeg_process", _fake_ffmpeg(0, stderr))
+    silences = asyncio.run(detect_silences(b"audio"))
+    assert silences == pytest.approx([0.4, 13.0])
+
+
+def test_detect_silences_raises_on_ffmpeg_error(monkeypatch):
+    monkeypatch.setattr(audio_utils, "_run_ffmpeg_process", _fake_ffmpeg(1, "Invalid data found"))
+    with pytest.raises(AudioConversionError, match="Invalid data"):
+        asyncio.run(detect_silences(b"audio"))
@@ -0,0 +1,160 @@
+import pytest
+
+from config.settings import settings
+from services.context_manager import ContextManager
+from utils.token_utils import TRUNCATION_MARK, estimate_tokens
+
+CHAT_ID = 1
+AUTHOR = {"id": 7, "name": "Аня", "username": "anya"}
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    monkeypatch.setattr(settings, "context_limit", 50)
+    monkeypatch.setattr(settings, "context_token_budget", 400)
+    monkeypatch.setattr(settings, "model_token_budgets", "")
+    monkeypatch.setattr(settings, "text_models", "openai")
+    monkeypatch.setattr(settings, "context_min_truncated_tokens", 30)
+    monkeypatch.setattr(settings, "summarization_enabled", False)
+    cm = ContextManager()
+    cm.set_system_prompt(CHAT_ID, "Ты тестовый ассистент.")
+    return cm
+
+
+def _rebuilt(cm, chat_id=CHAT_ID):
+    """Сообщения, собранные с нуля (без инкрементального состояния)"""
+    cm.chats[chat_id].packed = None
+    return cm.build_api_messages(chat_id)
+
+
+def _total_tokens(messages):
+    return sum(estimate_tokens(m["content"]) for m in messages)
+
+
+def _add_dialog(cm, turns, size=5):
+    for i in range(turns):
+        cm.add_message(CHAT_ID, "user", f"вопрос {i} " + "слово " * size, AUTHOR)
+        cm.add_message(CHAT_ID, "assistant", f"ответ {i} " + "слово " * size)
+
+
+def test_messages_keep_order_and_author(manager):
+    _add_dialog(manager, 2)
+    messages = manager.build_api_messages(CHAT_ID)
+    assert messages[0] == {"role": "system", "content": "Ты тестовый ассистент."}
+    assert [m["role"] for m in messages[1:]] == ["user", "assistant", "user", "assistant"]
+    assert messages[1]["content"].startswith("Аня (@anya): вопрос 0")
+
+
+def test_incremental_packing_matches_full_rebuild(manager):
+    for step in range(40):
+        _add_dialog(manager, 1, size=step % 7 * 3)
+        incremental = manager.build_api_messages(CHAT_ID)
+        assert incremental == _rebuilt(manager)
+        assert _total_tokens(incremental) <= settings.context_token_budget
+
+
+def test_context_limit_eviction_leaves_window(manager):
+    manager.set_context_limit(CHAT_ID, 4)
+    _add_dialog(manager, 2)
+    manager.build_api_messages(CHAT_ID)
+    _add_dialog(manager, 1)
+    messages = manager.build_api_messages(CHAT_ID)
+    assert len(messages) == 5
+    # Первая пара вытеснена: окно начинается со второго вопроса
+    assert messages[1]["content"].startswith("Аня (@anya): вопрос 1")
+    assert messages == _rebuilt(manager)
+
+
+def test_oldest_entries_are_dropped_to_fit_budget(manager):
+    _add_dialog(manager, 30, size=10)
+    messages = manager.build_api_messages(CHAT_ID)
+    assert _total_tokens(messages) <= settings.context_token_budget
+    assert messages[-1]["content"].startswith("ответ 29")
+    assert "вопрос 0 " not in " ".join(m["content"] for m in messages)
+
+
+def test_boundary_entry_is_truncated(manager):
+    manager.add_message(CHAT_ID, "user", "старое " * 400, AUTHOR)
+    manager.add_message(CHAT_ID, "assistant", "короткий ответ")
+    messages = manager.build_api_messages(CHAT_ID)
+    assert len(messages) == 3
+    assert messages[1]["content"].endswith(TRUNCATION_MARK)
+    assert messages[2]["content"] == "короткий ответ"
+    assert _total_tokens(messages) <= settings.context_token_budget
+
+
+def test_last_message_is_kept_even_if_over_budget(manager):
+    manager.add_message(CHAT_ID, "user", "длинный " * 1000, AUTHOR)
+    messages = manager.build_api_messages(CHAT_ID)
+    assert len(messages) == 2
+    assert messages[1]["content"].endswith(TRUNCATION_MARK)
+    assert _total_tokens(messages) <= settings.context_token_budget
+
+
+def test_prompt_change_rebuilds_prefix(manager):
+    _add_dialog(manager, 1)
+    manager.build_api_messages(CHAT_ID)
+    manager.set_system_prompt(CHAT_ID, "Новый промпт.")
+    messages = manager.build_api_messages(CHAT_ID)
+    assert messages[0]["content"] == "Новый промпт."
+    assert len(messages) == 3
+
+
+def test_memory_follows_system_prompt(manager):
+    _add_dialog(manager, 3)
+    block = manager.get_context(CHAT_ID)[:2]
+    assert manager.apply_summary(CHAT_ID, block, "Аня спрашивала про погоду.")
+    messages = manager.build_api_messages(CHAT_ID)
+    assert messages[1]["role"] == "system"
+    assert messages[1]["content"].endswith("Аня спрашивала про погоду.")
+    assert len(messages) == 2 + 4
+    assert messages == _rebuilt(manager)
+
+
+def test_model_budget_override(manager, monkeypatch):
+    monkeypatch.setattr(settings, "model_token_budgets", "openai:200,mistral:900")
+    monkeypatch.setattr(settings, "text_models", "openai,mistral")
+    assert manager.get_token_budget("mistral") == 900
+    assert manager.get_token_budget("unknown") == settings.context_token_budget
+    # Без модели — наименьший бюджет среди TEXT_MODELS
+    assert manager.get_token_budget() == 200
+    _add_dialog(manager, 30, size=10)
+    assert _total_tokens(manager.build_api_messages(CHAT_ID, model="openai")) <= 200
+    assert _total_tokens(manager.build_api_messages(CHAT_ID, model="mistral")) > 200
+
+
+def test_trim_and_budget_shift_keep_incremental_state_consistent(manager):
+    _add_dialog(manager, 12, size=10)
+    manager.build_api_messages(CHAT_ID)
+    manager.set_context_limit(CHAT_ID, 3)
+    assert manager.trim_context(CHAT_ID) == 21
+    messages = manager.build_api_messages(CHAT_ID)
+    assert messages == _rebuilt(manager)
+    assert len(messages) == 4
+    _add_dialog(manager, 1, size=300)
+    assert manager.build_api_messages(CHAT_ID) == _rebuilt(manager)
+
+
+def test_idle_eviction_keeps_chat_configuration(manager):
+    _add_dialog(manager, 3)
+    manager.build_api_messages(CHAT_ID)
+    manager.update_settings(CHAT_ID, lang="en")
+    manager.add_message(2, "user", "без настроек", AUTHOR)
+    manager.set_generating(3, True)
+
+    assert manager.evict_idle_chats(0) == 2
+    assert 2 not in manager.chats
+    assert 3 in manager.chats
+    assert manager.get_context(CHAT_ID) == []
+    assert manager.get_system_prompt(CHAT_ID) == "Ты тестовый ассистент."
+    assert manager.get_settings(CHAT_ID)["lang"] == "en"
+    # История уже освобождена — повторное вытеснение ничего не делает
+    assert manager.evict_idle_chats(0) == 0
+
+
+def test_summary_is_not_applied_after_eviction(manager):
+    _add_dialog(manager, 3)
+    block = manager.get_context(CHAT_ID)[:2]
+    manager.evict_idle_chats(0)
+    assert not manager.apply_summary(CHAT_ID, block, "сводка")
+    assert manager.get_memory(CHAT_ID) is None
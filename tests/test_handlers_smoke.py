@@ -0,0 +1,53 @@
+"""
+Дымовые тесты обработчиков: ошибка внутри обработчика не должна выходить наружу
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("telegram")
+
+from bot.handlers import messages  # noqa: E402
+
+
+class _Message:
+    """Сообщение без полей: любое обращение обработчика к ним — исключение"""
+
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return SimpleNamespace(message_id=len(self.replies))
+
+
+@pytest.mark.parametrize("handler", [messages.handle_message, messages.handle_voice, messages.handle_image])
+def test_handler_errors_are_reported_to_user(handler):
+    message = _Message()
+    update = SimpleNamespace(effective_message=message, effective_chat=SimpleNamespace(id=-1), effective_user=None)
+    assert asyncio.run(handler(update, SimpleNamespace())) is None
+    assert len(message.replies) == 1
+
+
+def test_health_escapes_markdown_in_names(monkeypatch):
+    pytest.importorskip("psutil")
+    from bot.handlers import commands
+
+    health = {
+        "status": "healthy", "uptime_hours": 1.0, "memory_usage_percent": 10.0, "disk_usage_percent": 20.0,
+        "active_contexts": 1, "total_messages": 2, "request_count": 3, "error_count": 0, "error_rate_percent": 0.0,
+        "models": {
+            "text": {"gpt_4*mini": {"latency_ms": 120, "error_rate_percent": 0.0, "healthy": True}},
+            "fallbacks": 0,
+        },
+        "tokens": [{"token": "sk_a...b_c", "requests": 1, "in_flight": 0, "errors": 0, "rate_limited": 0,
+                    "quarantine_seconds": 0}],
+    }
+    monkeypatch.setattr(commands, "get_health_status", lambda: health)
+    message = _Message()
+    update = SimpleNamespace(message=message, effective_message=message, effective_chat=SimpleNamespace(id=1),
+                             effective_user=None)
+    asyncio.run(commands.health_command(update, SimpleNamespace()))
+    assert "text/gpt\\_4\\*mini" in message.replies[0]
+    assert "sk\\_a...b\\_c" in message.replies[0]
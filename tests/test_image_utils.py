@@ -0,0 +1,55 @@
+import io
+from types import SimpleNamespace
+
+import pytest
+
+from utils import image_utils
+from utils.image_utils import prepare_image_for_vision, select_photo_size
+
+
+def _size(width, height):
+    return SimpleNamespace(width=width, height=height)
+
+
+def test_select_smallest_size_covering_max_edge():
+    sizes = [_size(90, 60), _size(320, 213), _size(800, 533), _size(1280, 853)]
+    assert select_photo_size(sizes, 768) is sizes[2]
+    assert select_photo_size(list(reversed(sizes)), 300) is sizes[1]
+
+
+def test_select_largest_size_when_all_are_small():
+    sizes = [_size(90, 60), _size(320, 213)]
+    assert select_photo_size(sizes, 1024) is sizes[1]
+    assert select_photo_size([], 1024) is None
+
+
+def test_without_pillow_image_is_sent_as_is(monkeypatch):
+    monkeypatch.setattr(image_utils, "Image", None)
+    assert prepare_image_for_vision(bytearray(b"raw"), "png", 512, 85) == (b"raw", "png")
+
+
+def _image(size, image_format, mode="RGB"):
+    Image = pytest.importorskip("PIL.Image")
+    buffer = io.BytesIO()
+    Image.new(mode, size, "red").save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def test_large_image_is_downscaled_and_reencoded():
+    Image = pytest.importorskip("PIL.Image")
+    data = _image((2000, 1000), "PNG", mode="RGBA")
+    result, result_format = prepare_image_for_vision(data, "png", 512, 85)
+    assert result_format == "jpeg"
+    with Image.open(io.BytesIO(result)) as img:
+        assert img.size == (512, 256)
+        assert img.format == "JPEG"
+
+
+def test_small_jpeg_is_kept():
+    data = _image((200, 100), "JPEG")
+    assert prepare_image_for_vision(data, "jpg", 512, 85) == (data, "jpg")
+
+
+def test_broken_image_is_sent_as_is():
+    pytest.importorskip("PIL")
+    assert prepare_image_for_vision(b"not an image", "png", 512, 85) == (b"not an image", "png")
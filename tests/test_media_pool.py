@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+from utils.media_pool import MediaPool
+
+
+async def _occupy(pool, release, timeout=None):
+    """Занимает единственный слот пула до release"""
+    started = asyncio.Event()
+
+    async def job():
+        started.set()
+        await release.wait()
+
+    task = asyncio.create_task(pool.run(job, timeout=timeout))
+    await started.wait()
+    return task
+
+
+def test_queued_jobs_run_shortest_first():
+    async def scenario():
+        pool = MediaPool(max_workers=1)
+        release = asyncio.Event()
+        blocker = await _occupy(pool, release)
+        order = []
+
+        async def job(name):
+            order.append(name)
+
+        tasks = [
+            asyncio.create_task(pool.run(lambda n=name: job(n), priority=priority))
+            for name, priority in (("long", 50.0), ("short", 3.0), ("medium", 20.0), ("short-later", 3.0))
+        ]
+        await asyncio.sleep(0)
+        depth = pool.queue_depth()
+        release.set()
+        await asyncio.gather(blocker, *tasks)
+        return pool, order, depth
+
+    pool, order, depth = asyncio.run(scenario())
+    assert depth == 4
+    assert order == ["short", "short-later", "medium", "long"]
+    stats = pool.get_stats()
+    assert stats["active"] == 0
+    assert stats["max_queue_depth"] == 4
+    assert stats["jobs"] == 5
+
+
+def test_cancelled_waiter_is_skipped():
+    async def scenario():
+        pool = MediaPool(max_workers=1)
+        release = asyncio.Event()
+        blocker = await _occupy(pool, release)
+        ran = []
+
+        async def job(name):
+            ran.append(name)
+
+        cancelled = asyncio.create_task(pool.run(lambda: job("cancelled"), priority=1.0))
+        waiting = asyncio.create_task(pool.run(lambda: job("waiting"), priority=2.0))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        depth = pool.queue_depth()
+        release.set()
+        await asyncio.gather(blocker, waiting)
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        return pool, ran, depth
+
+    pool, ran, depth = asyncio.run(scenario())
+    assert depth == 1
+    assert ran == ["waiting"]
+    assert pool.get_stats()["active"] == 0
+
+
+def test_running_job_cancellation_frees_slot():
+    async def scenario():
+        pool = MediaPool(max_workers=1)
+        running = await _occupy(pool, asyncio.Event())
+        follower = asyncio.create_task(pool.run(lambda: asyncio.sleep(0, result="done")))
+        await asyncio.sleep(0)
+        running.cancel()
+        return pool, await follower
+
+    pool, result = asyncio.run(scenario())
+    assert result == "done"
+    assert pool.get_stats()["active"] == 0
+
+
+def test_timeout_counts_only_execution_time():
+    async def scenario():
+        pool = MediaPool(max_workers=1, default_timeout=0.05)
+        release = asyncio.Event()
+        blocker = await _occupy(pool, release, timeout=60)
+        # Задача ждёт в очереди дольше таймаута, но выполняется быстро
+        queued = asyncio.create_task(pool.run(lambda: asyncio.sleep(0, result="ok")))
+        await asyncio.sleep(0.1)
+        release.set()
+        await blocker
+        result = await queued
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.run(lambda: asyncio.sleep(1))
+        return pool, result
+
+    pool, result = asyncio.run(scenario())
+    assert result == "ok"
+    stats = pool.get_stats()
+    assert stats["timeouts"] == 1
+    assert stats["active"] == 0
+
+
+def test_failures_are_counted_and_propagated():
+    async def failing():
+        raise RuntimeError("ffmpeg упал")
+
+    pool = MediaPool(max_workers=2)
+    with pytest.raises(RuntimeError):
+        asyncio.run(pool.run(failing))
+    assert pool.get_stats()["failures"] == 1
+    assert pool.get_stats()["active"] == 0
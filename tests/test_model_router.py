@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from services.model_router import ModelRouter, parse_models
+from services.resilience import CircuitOpenError, UpstreamError
+
+
+def _router(models=("openai", "mistral", "llama"), **kwargs):
+    params = dict(error_threshold=0.3, recovery_seconds=60, alpha=0.5)
+    params.update(kwargs)
+    return ModelRouter({"text": list(models)}, **params)
+
+
+def _factory(responses, calls):
+    """factory(model): исключение из responses бросается, остальное возвращается"""
+    async def call(model):
+        calls.append(model)
+        response = responses[model]
+        if isinstance(response, BaseException):
+            raise response
+        return response
+    return call
+
+
+def test_parse_models():
+    assert parse_models(" openai, mistral ,,") == ["openai", "mistral"]
+
+
+def test_unmeasured_models_keep_configured_order():
+    assert _router().candidates("text") == ["openai", "mistral", "llama"]
+
+
+def test_falls_back_to_next_model_on_upstream_failure():
+    router = _router()
+    calls = []
+    responses = {"openai": UpstreamError("недоступна", status=503), "mistral": "ответ", "llama": "не нужен"}
+    result = asyncio.run(router.call("text", _factory(responses, calls)))
+    assert result == "ответ"
+    assert calls == ["openai", "mistral"]
+    assert router.fallbacks == 1
+    # Упавшая модель уходит в конец списка до истечения recovery_seconds
+    assert not router.is_healthy("text", "openai")
+    assert router.candidates("text") == ["mistral", "llama", "openai"]
+
+
+def test_open_circuit_skips_model_without_counting_failure():
+    router = _router()
+    calls = []
+    responses = {"openai": CircuitOpenError("открыт"), "mistral": "ответ", "llama": "не нужен"}
+    assert asyncio.run(router.call("text", _factory(responses, calls))) == "ответ"
+    assert router.is_healthy("text", "openai")
+    assert "openai" not in router.get_stats()["text"]
+
+
+def test_request_error_is_not_retried_on_other_models():
+    router = _router()
+    calls = []
+    responses = {"openai": UpstreamError("плохой запрос", status=400), "mistral": "ответ", "llama": "ответ"}
+    with pytest.raises(UpstreamError):
+        asyncio.run(router.call("text", _factory(responses, calls)))
+    assert calls == ["openai"]
+    assert router.is_healthy("text", "openai")
+
+
+def test_last_model_failure_is_raised():
+    router = _router(models=("openai", "mistral"))
+    calls = []
+    responses = {"openai": asyncio.TimeoutError(), "mistral": UpstreamError("недоступна", status=502)}
+    with pytest.raises(UpstreamError):
+        asyncio.run(router.call("text", _factory(responses, calls)))
+    assert calls == ["openai", "mistral"]
+
+
+def test_preferred_model_is_tried_first():
+    router = _router()
+    router.record_success("text", "openai", 0.1)
+    assert router.candidates("text", preferred="llama") == ["llama", "openai", "mistral"]
+
+
+def test_faster_model_ranks_first():
+    router = _router()
+    router.record_success("text", "openai", 2.0)
+    router.record_success("text", "mistral", 0.5)
+    assert router.candidates("text") == ["mistral", "openai", "llama"]
+
+
+def test_unhealthy_model_recovers_after_timeout():
+    router = _router(recovery_seconds=0)
+    router.record_failure("text", "openai")
+    assert router.is_healthy("text", "openai")
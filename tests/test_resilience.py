@@ -0,0 +1,283 @@
+import asyncio
+from collections import deque
+
+import pytest
+
+from services.resilience import (
+    AdaptiveLimiter,
+    CircuitBreaker,
+    CircuitOpenError,
+    Hedger,
+    OverloadedError,
+    UpstreamError,
+    classify_error,
+    parse_retry_after,
+)
+
+
+def test_classify_error():
+    assert classify_error(UpstreamError("x", status=503, retry_after=2.0)) == (True, 2.0)
+    assert classify_error(UpstreamError("x", status=429)) == (True, None)
+    assert classify_error(UpstreamError("x", status=400)) == (False, None)
+    assert classify_error(asyncio.TimeoutError()) == (True, None)
+    assert classify_error(CircuitOpenError("x")) == (False, None)
+    assert classify_error(ValueError("x")) == (False, None)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("5") == 5.0
+    assert parse_retry_after("-3") == 0.0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert parse_retry_after("не дата") is None
+    assert parse_retry_after(None) is None
+
+
+# ----- CircuitBreaker -----
+
+def _failures(breaker, count):
+    for _ in range(count):
+        breaker.before_call()
+        breaker.record_failure()
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker("text", failure_threshold=3, recovery_timeout=60)
+    _failures(breaker, 2)
+    assert breaker.state == CircuitBreaker.CLOSED
+    _failures(breaker, 1)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    stats = breaker.get_stats()
+    assert stats["times_opened"] == 1
+    assert stats["rejected"] == 1
+
+
+def test_success_resets_failure_streak():
+    breaker = CircuitBreaker("text", failure_threshold=3, recovery_timeout=60)
+    _failures(breaker, 2)
+    breaker.before_call()
+    breaker.record_success()
+    _failures(breaker, 2)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_allows_single_probe():
+    breaker = CircuitBreaker("text", failure_threshold=1, recovery_timeout=0)
+    _failures(breaker, 1)
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.before_call()
+
+
+def test_failed_probe_reopens():
+    breaker = CircuitBreaker("text", failure_threshold=5, recovery_timeout=0)
+    _failures(breaker, 5)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.times_opened == 2
+
+
+def test_released_probe_can_be_retried():
+    breaker = CircuitBreaker("text", failure_threshold=1, recovery_timeout=0)
+    _failures(breaker, 1)
+    breaker.before_call()
+    breaker.release_probe()
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+# ----- AdaptiveLimiter -----
+
+def _limiter(**kwargs):
+    params = dict(initial_limit=2, min_limit=1, max_limit=10, max_queue=2)
+    params.update(kwargs)
+    return AdaptiveLimiter("text", **params)
+
+
+def test_limiter_queues_over_limit_and_wakes_fifo():
+    async def scenario():
+        limiter = _limiter()
+        await limiter.acquire()
+        await limiter.acquire()
+        order = []
+
+        async def waiter(name):
+            await limiter.acquire()
+            order.append(name)
+
+        tasks = [asyncio.create_task(waiter(name)) for name in ("first", "second")]
+        await asyncio.sleep(0)
+        queued = limiter.queue_length()
+        limiter.release()
+        await asyncio.sleep(0)
+        limiter.release()
+        await asyncio.gather(*tasks)
+        return limiter, order, queued
+
+    limiter, order, queued = asyncio.run(scenario())
+    assert queued == 2
+    assert order == ["first", "second"]
+    assert limiter.in_flight == 2
+
+
+def test_limiter_rejects_when_queue_is_full():
+    async def scenario():
+        limiter = _limiter(initial_limit=1, max_queue=1)
+        await limiter.acquire()
+        queued = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(OverloadedError):
+            await limiter.acquire()
+        queued.cancel()
+        return limiter
+
+    limiter = asyncio.run(scenario())
+    assert limiter.rejected == 1
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def scenario():
+        limiter = _limiter(initial_limit=1)
+        await limiter.acquire()
+        queued = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        queued.cancel()
+        await asyncio.sleep(0)
+        return limiter
+
+    limiter = asyncio.run(scenario())
+    assert limiter.queue_length() == 0
+    assert limiter.in_flight == 1
+
+
+def test_overload_decreases_limit_once_per_burst():
+    limiter = _limiter(initial_limit=10)
+    for _ in range(3):
+        limiter.in_flight += 1
+        limiter.release(exc=UpstreamError("перегрузка", status=503))
+    assert int(limiter.limit) == 7
+    assert limiter.decreases == 1
+    assert limiter.in_flight == 0
+
+
+def test_request_errors_do_not_decrease_limit():
+    limiter = _limiter(initial_limit=10)
+    limiter.in_flight += 1
+    limiter.release(exc=UpstreamError("плохой запрос", status=400))
+    assert limiter.limit == 10
+
+
+def test_limit_never_drops_below_minimum():
+    limiter = _limiter(initial_limit=2, min_limit=2)
+    limiter.in_flight += 1
+    limiter.release(exc=asyncio.TimeoutError())
+    assert limiter.limit == 2
+
+
+def test_limit_grows_while_used():
+    limiter = _limiter(initial_limit=2)
+    for _ in range(20):
+        limiter.in_flight = int(limiter.limit)
+        limiter.release(latency=0.5)
+    assert limiter.limit > 2
+    assert limiter.decreases == 0
+
+
+def test_latency_spike_decreases_limit():
+    limiter = _limiter(initial_limit=8)
+    for _ in range(10):
+        limiter.in_flight += 1
+        limiter.release(latency=0.1)
+    for _ in range(5):
+        limiter.in_flight += 1
+        limiter.release(latency=5.0)
+    assert limiter.decreases >= 1
+    assert limiter.limit < 8
+
+
+# ----- Hedger -----
+
+def _hedger(latencies=None, **kwargs):
+    params = dict(percentile=90, budget_ratio=1.0, min_samples=5)
+    params.update(kwargs)
+    hedger = Hedger("text", **params)
+    for key, values in (latencies or {}).items():
+        hedger._latencies[key] = deque(values, maxlen=hedger.window)
+    return hedger
+
+
+def _calls(*behaviours):
+    """factory, которая при каждом вызове спит и возвращает (или бросает) следующее значение"""
+    started = []
+
+    async def factory_call(delay, result):
+        started.append(delay)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            started.append("cancelled")
+            raise
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    queue = list(behaviours)
+    return (lambda: factory_call(*queue.pop(0))), started
+
+
+def test_hedge_delay_is_percentile_per_key():
+    hedger = _hedger({"fast": [0.01 * i for i in range(1, 11)], "cold": [1.0] * 4})
+    assert hedger.hedge_delay("fast") == pytest.approx(0.1)
+    assert hedger.hedge_delay("cold") is None
+    assert hedger.hedge_delay("unknown") is None
+    assert hedger.get_stats()["hedge_delay_ms"] == {"fast": 100, "cold": None}
+
+
+def test_slow_request_is_hedged_and_loser_cancelled():
+    hedger = _hedger({"model": [0.01] * 10})
+    factory, started = _calls((1.0, "медленный"), (0.01, "дубль"))
+    assert asyncio.run(hedger.call("model", factory)) == "дубль"
+    assert started == [1.0, 0.01, "cancelled"]
+    assert (hedger.hedged, hedger.hedge_wins) == (1, 1)
+    # Задержка победителя считается от начала первого запроса
+    assert hedger._latencies["model"][-1] >= 0.02
+
+
+def test_fast_request_is_not_hedged():
+    hedger = _hedger({"model": [0.5] * 10})
+    factory, started = _calls((0.0, "ответ"))
+    assert asyncio.run(hedger.call("model", factory)) == "ответ"
+    assert started == [0.0]
+    assert hedger.hedged == 0
+
+
+def test_budget_limits_hedging():
+    hedger = _hedger({"model": [0.01] * 10}, budget_ratio=0.0)
+    factory, started = _calls((0.05, "ответ"))
+    assert asyncio.run(hedger.call("model", factory)) == "ответ"
+    assert started == [0.05]
+    assert (hedger.hedged, hedger.budget_skipped) == (0, 1)
+
+
+def test_hedge_covers_failed_primary_and_first_error_is_raised():
+    hedger = _hedger({"model": [0.01] * 10})
+    factory, _ = _calls((0.05, UpstreamError("сбой", status=503)), (0.1, "дубль"))
+    assert asyncio.run(hedger.call("model", factory)) == "дубль"
+
+    factory, _ = _calls((0.05, UpstreamError("первая", status=503)), (0.1, UpstreamError("вторая", status=503)))
+    with pytest.raises(UpstreamError, match="первая"):
+        asyncio.run(hedger.call("model", factory))
+
+
+def test_latencies_are_kept_per_key():
+    hedger = _hedger(min_samples=1)
+    for key, delay in (("fast", 0.0), ("slow", 0.05)):
+        factory, _ = _calls((delay, "ответ"))
+        asyncio.run(hedger.call(key, factory))
+    assert hedger.hedge_delay("fast") < 0.05 <= hedger.hedge_delay("slow")
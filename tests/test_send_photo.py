@@ -0,0 +1,96 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("telegram")
+
+from telegram.error import BadRequest, TimedOut  # noqa: E402
+
+from services.file_id_cache import FileIdCache  # noqa: E402
+from utils import telegram_utils  # noqa: E402
+from utils.telegram_utils import send_photo_by_url, send_photo_cached  # noqa: E402
+
+
+class _Bot:
+    """Поддельный бот: ошибки по типу фото ("url", "file_id", "bytes") и список отправок"""
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.sent = []
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        kind = "bytes" if isinstance(photo, bytes) else "url" if photo.startswith("http") else "file_id"
+        self.sent.append((kind, photo))
+        if kind in self.errors:
+            raise self.errors[kind]
+        file_id = f"id-{len(self.sent)}"
+        return SimpleNamespace(photo=[SimpleNamespace(file_id="thumb"), SimpleNamespace(file_id=file_id)])
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = FileIdCache(max_items=10)
+    monkeypatch.setattr(telegram_utils, "file_id_cache", cache)
+    return cache
+
+
+URL = "https://image.example/prompt"
+IMAGE = b"png-bytes"
+
+
+def test_file_id_cache_lookup_and_lru():
+    cache = FileIdCache(max_items=2)
+    keys = cache.build_keys(content=IMAGE, generation_key="gen")
+    assert keys == ["gen:gen", cache.content_key(IMAGE)]
+    cache.put("id-1", keys)
+    # Тот же файл находится и по ключу генерации, и по содержимому
+    assert cache.get(["gen:other", cache.content_key(IMAGE)]) == "id-1"
+    cache.put("id-2", ["gen:new"])
+    assert cache.get(["gen:gen"]) is None
+    assert cache.get_stats() == {"items": 2, "hits": 1, "misses": 1}
+
+
+def test_invalidate_removes_every_key_of_file_id():
+    cache = FileIdCache(max_items=10)
+    cache.put("id-1", cache.build_keys(content=IMAGE, generation_key="gen"))
+    cache.put("id-2", ["gen:other"])
+    cache.invalidate("id-1")
+    assert cache.get_stats()["items"] == 1
+    assert cache.get(["gen:other"]) == "id-2"
+
+
+def test_repeat_upload_is_sent_by_file_id(cache):
+    bot = _Bot()
+    asyncio.run(send_photo_cached(bot, 1, IMAGE))
+    # Те же байты без ключа генерации находятся по хешу содержимого
+    asyncio.run(send_photo_cached(bot, 2, IMAGE, generation_key="gen"))
+    assert bot.sent == [("bytes", IMAGE), ("file_id", "id-1")]
+
+
+def test_rejected_file_id_is_reuploaded(cache):
+    cache.put("stale", cache.build_keys(content=IMAGE))
+    bot = _Bot({"file_id": BadRequest("wrong file identifier")})
+    asyncio.run(send_photo_cached(bot, 1, IMAGE))
+    assert bot.sent == [("file_id", "stale"), ("bytes", IMAGE)]
+    assert cache.get(cache.build_keys(content=IMAGE)) == "id-2"
+
+
+def test_url_delivery_remembers_file_id(cache):
+    bot = _Bot()
+    asyncio.run(send_photo_by_url(bot, 1, URL, generation_key="gen"))
+    asyncio.run(send_photo_by_url(bot, 2, URL, generation_key="gen"))
+    assert bot.sent == [("url", URL), ("file_id", "id-1")]
+
+
+def test_rejected_url_asks_for_bytes(cache):
+    bot = _Bot({"url": BadRequest("failed to get HTTP URL content")})
+    assert asyncio.run(send_photo_by_url(bot, 1, URL, generation_key="gen")) is None
+
+
+def test_timeout_is_not_treated_as_rejected_url(cache):
+    # Фото могло уже дойти: отправка байтов задублировала бы его
+    bot = _Bot({"url": TimedOut("timed out")})
+    with pytest.raises(TimedOut):
+        asyncio.run(send_photo_by_url(bot, 1, URL, generation_key="gen"))
+    assert cache.get_stats()["items"] == 0
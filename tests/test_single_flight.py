@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+from utils.single_flight import SingleFlight
+
+
+def test_make_key_ignores_payload_order():
+    a = SingleFlight.make_key("text", {"model": "openai", "messages": [1, 2]})
+    b = SingleFlight.make_key("text", {"messages": [1, 2], "model": "openai"})
+    assert a == b
+    assert a != SingleFlight.make_key("vision", {"model": "openai", "messages": [1, 2]})
+
+
+def test_concurrent_calls_share_one_request():
+    async def scenario():
+        flight = SingleFlight()
+        calls = 0
+        release = asyncio.Event()
+
+        async def factory():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return "ответ"
+
+        waiters = [asyncio.create_task(flight.do("key", factory)) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert flight.in_flight() == 1
+        release.set()
+        results = await asyncio.gather(*waiters)
+        return flight, calls, results
+
+    flight, calls, results = asyncio.run(scenario())
+    assert calls == 1
+    assert results == ["ответ"] * 3
+    assert flight.get_stats() == {"in_flight": 0, "started": 1, "coalesced": 2}
+
+
+def test_different_keys_run_separately():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def factory(value):
+            await asyncio.sleep(0)
+            return value
+
+        return await asyncio.gather(
+            flight.do("a", lambda: factory("a")),
+            flight.do("b", lambda: factory("b")),
+        ), flight
+
+    results, flight = asyncio.run(scenario())
+    assert results == ["a", "b"]
+    assert flight.started == 2
+    assert flight.coalesced == 0
+
+
+def test_error_reaches_every_waiter_and_key_is_freed():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def factory():
+            await asyncio.sleep(0)
+            raise ValueError("сбой")
+
+        results = await asyncio.gather(
+            flight.do("key", factory), flight.do("key", factory), return_exceptions=True
+        )
+        return flight, results
+
+    flight, results = asyncio.run(scenario())
+    assert all(isinstance(r, ValueError) for r in results)
+    assert flight.in_flight() == 0
+
+
+def test_cancelled_waiter_does_not_cancel_shared_request():
+    async def scenario():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def factory():
+            await release.wait()
+            return 42
+
+        first = asyncio.create_task(flight.do("key", factory))
+        second = asyncio.create_task(flight.do("key", factory))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return first, await second
+
+    first, result = asyncio.run(scenario())
+    assert first.cancelled()
+    assert result == 42
+
+
+def test_request_is_cancelled_when_last_waiter_leaves():
+    async def scenario():
+        flight = SingleFlight()
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def factory():
+            started.set()
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiter = asyncio.create_task(flight.do("key", factory))
+        await started.wait()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        # Ключ освобождён сразу — новый вызов запускает новый запрос
+        in_flight = flight.in_flight()
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
+        return in_flight
+
+    assert asyncio.run(scenario()) == 0
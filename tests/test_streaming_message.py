@@ -0,0 +1,131 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("telegram")
+
+from utils.telegram_utils import TELEGRAM_MESSAGE_LIMIT, StreamingMessage  # noqa: E402
+
+
+class _Bot:
+    """Чат в памяти: текст каждого сообщения и счётчики правок"""
+
+    def __init__(self):
+        self.texts = {}
+        self.edits = {}
+        self.deleted = []
+
+    async def send_message(self, chat_id, text, parse_mode=None, reply_to_message_id=None):
+        message_id = len(self.texts) + len(self.deleted) + 1
+        self.texts[message_id] = text
+        self.edits[message_id] = 0
+        return SimpleNamespace(message_id=message_id)
+
+    async def edit_message_text(self, chat_id, message_id, text, parse_mode=None):
+        self.texts[message_id] = text
+        self.edits[message_id] += 1
+
+    async def delete_message(self, chat_id, message_id):
+        del self.texts[message_id]
+        self.deleted.append(message_id)
+
+
+def _stream(bot, chunks, final_text=None, **kwargs):
+    async def run():
+        writer = StreamingMessage(bot, chat_id=1, edit_interval=0, **kwargs)
+        for chunk in chunks:
+            await writer.append(chunk)
+        await writer.finish(final_text)
+        return writer
+    return asyncio.run(run())
+
+
+def _words(count):
+    return [f"слово{i} " for i in range(count)]
+
+
+def test_short_answer_is_one_message_without_cursor():
+    bot = _Bot()
+    _stream(bot, ["Привет", ", мир"])
+    assert list(bot.texts.values()) == ["Привет, мир"]
+
+
+def test_rollover_splits_on_word_boundaries():
+    bot = _Bot()
+    chunks = _words(40)
+    writer = _stream(bot, chunks, max_length=50)
+    texts = list(bot.texts.values())
+    assert len(texts) > 1
+    assert all(len(text) <= 50 for text in texts)
+    assert " ".join(texts).split() == "".join(chunks).split()
+    assert len(writer.sent_messages) == len(texts) - 1
+
+
+def test_segments_fit_limit_after_formatting():
+    # Незакрытые *, _ и [ заставляют форматирование дописать символы в конец
+    text = "*_[ " + "x " * ((TELEGRAM_MESSAGE_LIMIT - 4) // 2)
+    assert len(text.strip()) <= TELEGRAM_MESSAGE_LIMIT
+    bot = _Bot()
+    _stream(bot, [text], max_length=TELEGRAM_MESSAGE_LIMIT)
+    assert len(bot.texts) == 2
+    assert all(len(t) <= TELEGRAM_MESSAGE_LIMIT for t in bot.texts.values())
+
+
+def test_rewrite_edits_only_changed_messages_and_drops_extra():
+    bot = _Bot()
+    chunks = _words(40)
+    text = "".join(chunks)
+    # Финальный текст короче: хвост (например, реклама) удалён
+    final_text = text[:70]
+    writer = _stream(bot, chunks, final_text=final_text, max_length=50)
+    texts = list(bot.texts.values())
+    assert " ".join(texts).split() == final_text.split()
+    assert bot.deleted
+    first_id = min(bot.texts)
+    edits_before = bot.edits[first_id]
+    asyncio.run(writer.finish(final_text))
+    assert bot.edits[first_id] == edits_before
+
+
+def test_rewrite_appends_note_to_last_message():
+    bot = _Bot()
+    chunks = _words(20)
+    note = "⚠️ Ответ прерван"
+    _stream(bot, chunks, final_text="".join(chunks).strip() + "\n\n" + note, max_length=50)
+    last = bot.texts[max(bot.texts)]
+    assert last.endswith(note)
+    assert all(len(text) <= 50 for text in bot.texts.values())
+
+
+def test_empty_answer_removes_placeholder():
+    bot = _Bot()
+
+    async def run():
+        placeholder = await bot.send_message(chat_id=1, text="💭 Думаю...")
+        writer = StreamingMessage(bot, chat_id=1, placeholder=placeholder, edit_interval=0)
+        await writer.finish("")
+
+    asyncio.run(run())
+    assert bot.texts == {}
+
+
+def test_interrupted_stream_is_marked_and_not_complete(monkeypatch):
+    from bot.handlers import messages
+    from services.pollinations_service import StreamInterruptedError
+
+    async def broken_stream(**kwargs):
+        yield "Начало ответа"
+        raise StreamInterruptedError("обрыв соединения")
+
+    monkeypatch.setattr(messages, "stream_from_pollinations_async", broken_stream)
+    bot = _Bot()
+
+    async def run():
+        status = await bot.send_message(chat_id=1, text="💭 Думаю...")
+        return await messages._stream_ai_response(SimpleNamespace(bot=bot), 1, [], "token", status, None)
+
+    text, complete = asyncio.run(run())
+    assert text == "Начало ответа"
+    assert complete is False
+    assert list(bot.texts.values()) == [f"Начало ответа\n\n{messages._INTERRUPTED_NOTE}"]
@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+
+from config.settings import settings
+from services import summarizer as summarizer_module
+from services.context_manager import ContextManager
+from services.summarizer import ConversationSummarizer
+
+CHAT_ID = 1
+AUTHOR = {"id": 7, "name": "Аня", "username": "anya"}
+
+
+class _Model:
+    """Поддельная модель: отвечает по очереди из replies (строка или исключение)"""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.requests = []
+        self.gate = None
+
+    async def __call__(self, messages, token):
+        self.requests.append(messages)
+        if self.gate is not None:
+            await self.gate.wait()
+        reply = self.replies.pop(0)
+        if isinstance(reply, BaseException):
+            raise reply
+        return reply
+
+
+@pytest.fixture
+def setup(monkeypatch):
+    monkeypatch.setattr(settings, "summarization_enabled", True)
+    monkeypatch.setattr(settings, "summary_trigger_tokens", 100)
+    monkeypatch.setattr(settings, "summary_block_tokens", 100)
+    monkeypatch.setattr(settings, "summary_keep_recent", 2)
+    monkeypatch.setattr(settings, "summary_memory_max_tokens", 100)
+    monkeypatch.setattr(settings, "summary_retry_seconds", 60)
+    monkeypatch.setattr(settings, "context_limit", 100)
+    manager = ContextManager()
+    monkeypatch.setattr(summarizer_module, "context_manager", manager)
+
+    def install(replies):
+        model = _Model(replies)
+        monkeypatch.setattr(summarizer_module, "send_to_pollinations_async", model)
+        return manager, ConversationSummarizer(), model
+    return install
+
+
+def _add_dialog(manager, turns, chat_id=CHAT_ID):
+    for i in range(turns):
+        manager.add_message(chat_id, "user", f"вопрос {i} " + "слово " * 30, AUTHOR)
+        manager.add_message(chat_id, "assistant", f"ответ {i} " + "слово " * 30)
+
+
+def _memory(manager):
+    return [segment["content"] for segment in manager.get_memory_segments(CHAT_ID)]
+
+
+def _run(summarizer, chat_id=CHAT_ID, during=None):
+    async def scenario():
+        summarizer.maybe_summarize(chat_id)
+        if during is not None:
+            await asyncio.sleep(0)
+            during()
+        pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        await asyncio.gather(*pending)
+    asyncio.run(scenario())
+
+
+def test_summary_replaces_oldest_entries(setup):
+    manager, summarizer, model = setup(["Аня спрашивала про погоду."])
+    _add_dialog(manager, 4)
+    before = len(manager.get_context(CHAT_ID))
+    _run(summarizer)
+    assert _memory(manager) == ["Аня спрашивала про погоду."]
+    assert len(manager.get_context(CHAT_ID)) < before
+    assert "вопрос 0" in model.requests[0][1]["content"]
+    assert summarizer.summaries == 1
+
+
+def test_large_memory_is_condensed(setup):
+    manager, summarizer, model = setup(["сводка " * 60, "сводка " * 60, "общая сводка"])
+    _add_dialog(manager, 8)
+    _run(summarizer)
+    _run(summarizer)
+    assert _memory(manager) == ["общая сводка"]
+    assert summarizer.condensed == 1
+    assert len(model.requests) == 3
+
+
+def test_failure_backs_off_exponentially(setup, monkeypatch):
+    manager, summarizer, model = setup(["❌ Ошибка сервиса", RuntimeError("обрыв"), "сводка"])
+    now = [1000.0]
+    monkeypatch.setattr(summarizer_module.time, "monotonic", lambda: now[0])
+    _add_dialog(manager, 4)
+
+    _run(summarizer)
+    assert summarizer.failures == 1
+    _run(summarizer)
+    assert len(model.requests) == 1
+
+    now[0] += 60
+    _run(summarizer)
+    assert summarizer.failures == 2
+    # Вторая ошибка подряд — пауза вдвое длиннее
+    now[0] += 60
+    _run(summarizer)
+    assert len(model.requests) == 2
+
+    now[0] += 60
+    _run(summarizer)
+    assert _memory(manager) == ["сводка"]
+    assert summarizer._backoff == {}
+
+
+def test_late_summary_does_not_restore_evicted_chat(setup):
+    manager, summarizer, model = setup(["сводка"])
+    model.gate = asyncio.Event()
+    _add_dialog(manager, 4)
+
+    def evict():
+        manager.evict_idle_chats(0)
+        model.gate.set()
+
+    _run(summarizer, during=evict)
+    assert CHAT_ID not in manager.chats
+    assert summarizer.summaries == 0
@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+import os
+
+from services.tiered_cache import TieredCache
+
+
+class _TextCache(TieredCache):
+    def _encode(self, value):
+        return value.encode("utf-8")
+
+    def _decode(self, data):
+        return data.decode("utf-8")
+
+
+def _fill(cache, count, size=60):
+    async def fill():
+        for i in range(count):
+            value = chr(ord("a") + i) * size
+            await cache.put(f"key{i}", value)
+            if cache.cache_dir:
+                # Явное время доступа: порядок вытеснения не зависит от разрешения часов ФС
+                path = cache._object_path(hashlib.sha256(value.encode("utf-8")).hexdigest())
+                if os.path.exists(path):
+                    os.utime(path, (1000 + i, 1000 + i))
+    asyncio.run(fill())
+
+
+def _get(cache, key):
+    return asyncio.run(cache.get(key))
+
+
+def test_memory_lru_by_bytes():
+    cache = _TextCache("test", memory_limit_bytes=150)
+    _fill(cache, 3)
+    assert _get(cache, "key0") is None
+    assert _get(cache, "key2") == "c" * 60
+    stats = cache.get_stats()
+    assert stats["memory_items"] == 2
+    assert (stats["memory_hits"], stats["misses"]) == (1, 1)
+
+
+def test_memory_lru_by_items_keeps_recently_used():
+    cache = _TextCache("test", max_items=2)
+    _fill(cache, 2)
+    assert _get(cache, "key0") is not None
+    asyncio.run(cache.put("key2", "новое"))
+    assert _get(cache, "key1") is None
+    assert _get(cache, "key0") is not None
+
+
+def test_ttl_expires_entries(tmp_path):
+    cache = _TextCache("test", max_items=10, ttl_seconds=0, cache_dir=str(tmp_path))
+    _fill(cache, 1)
+    assert _get(cache, "key0") is None
+    assert not os.listdir(tmp_path / "keys")
+
+
+def test_disk_survives_restart_and_deduplicates(tmp_path):
+    cache = _TextCache("test", max_items=10, cache_dir=str(tmp_path), disk_max_items=10)
+
+    async def put_same():
+        await cache.put("a", "одинаковое")
+        await cache.put("b", "одинаковое")
+    asyncio.run(put_same())
+    assert cache.get_stats()["disk_items"] == 1
+
+    restarted = _TextCache("test", max_items=10, cache_dir=str(tmp_path))
+    assert _get(restarted, "a") == "одинаковое"
+    assert _get(restarted, "b") == "одинаковое"
+    assert restarted.get_stats()["disk_hits"] == 2
+
+
+def test_disk_eviction_by_size_and_count(tmp_path):
+    by_size = _TextCache("size", max_items=1, cache_dir=str(tmp_path / "size"), disk_limit_bytes=250)
+    _fill(by_size, 5)
+    assert by_size.get_stats()["disk_items"] == 3
+    by_count = _TextCache("count", max_items=1, cache_dir=str(tmp_path / "count"), disk_max_items=3)
+    _fill(by_count, 5)
+    assert by_count.get_stats()["disk_items"] == 3
+
+    # Ссылки на вытесненные объекты удалены, последние записи доступны
+    restarted = _TextCache("count", max_items=1, cache_dir=str(tmp_path / "count"))
+    assert _get(restarted, "key0") is None
+    assert _get(restarted, "key4") == "e" * 60
+    assert len(os.listdir(tmp_path / "count" / "keys")) == 3
+
+
+def test_legacy_key_file_without_timestamp(tmp_path):
+    cache = _TextCache("test", max_items=10, cache_dir=str(tmp_path))
+    _fill(cache, 1)
+    key_path = tmp_path / "keys" / "key0"
+    key_path.write_text(key_path.read_text().split()[0])
+    restarted = _TextCache("test", max_items=10, cache_dir=str(tmp_path))
+    assert _get(restarted, "key0") == "a" * 60
@@ -0,0 +1,78 @@
+import pytest
+
+from services.token_pool import TokenPool
+
+
+def _stats(pool):
+    return {s["token"]: s for s in pool.get_stats()}
+
+
+def test_duplicate_and_empty_tokens_are_ignored():
+    pool = TokenPool(["token-aaaa", "", "token-aaaa", "token-bbbb"], quarantine_seconds=60)
+    assert len(pool.get_stats()) == 2
+
+
+def test_least_loaded_token_is_leased():
+    pool = TokenPool(["token-aaaa", "token-bbbb"], quarantine_seconds=60)
+    first = pool.lease()
+    second = pool.lease()
+    assert {first.token, second.token} == {"token-aaaa", "token-bbbb"}
+    first.release()
+    assert pool.lease().token == first.token
+
+
+def test_rate_limited_token_is_quarantined():
+    pool = TokenPool(["token-aaaa", "token-bbbb"], quarantine_seconds=60)
+    with pool.lease() as lease:
+        limited = lease.token
+        lease.observe(429)
+    other = "token-bbbb" if limited == "token-aaaa" else "token-aaaa"
+    for _ in range(3):
+        with pool.lease() as lease:
+            assert lease.token == other
+    stats = _stats(pool)[pool._mask(limited)]
+    assert stats["rate_limited"] == 1
+    assert stats["errors"] == 1
+    assert stats["quarantine_seconds"] == 60
+
+
+def test_retry_after_overrides_quarantine_duration():
+    pool = TokenPool(["token-aaaa"], quarantine_seconds=60)
+    with pool.lease() as lease:
+        lease.observe(429, retry_after="5")
+    assert pool.get_stats()[0]["quarantine_seconds"] == 5
+
+
+def test_all_quarantined_leases_soonest_available():
+    pool = TokenPool(["token-aaaa", "token-bbbb"], quarantine_seconds=60)
+    stats = {s.token: s for s in pool._tokens.values()}
+    pool.quarantine(stats["token-aaaa"], retry_after=100)
+    pool.quarantine(stats["token-bbbb"], retry_after=30)
+    assert pool.lease().token == "token-bbbb"
+
+
+def test_failed_request_is_counted_as_error():
+    pool = TokenPool(["token-aaaa"], quarantine_seconds=60)
+    with pytest.raises(RuntimeError):
+        with pool.lease():
+            raise RuntimeError("сеть")
+    stats = pool.get_stats()[0]
+    assert stats["errors"] == 1
+    assert stats["in_flight"] == 0
+    assert stats["rate_limited"] == 0
+
+
+def test_release_is_idempotent():
+    pool = TokenPool(["token-aaaa"], quarantine_seconds=60)
+    lease = pool.lease()
+    lease.release()
+    lease.release()
+    assert pool.get_stats()[0]["in_flight"] == 0
+
+
+def test_foreign_token_is_used_as_is():
+    pool = TokenPool(["token-aaaa"], quarantine_seconds=60)
+    with pool.lease("personal-token") as lease:
+        assert lease.token == "personal-token"
+        lease.observe(429)
+    assert _stats(pool)[pool._mask("token-aaaa")]["requests"] == 0
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+from config.settings import settings
+from services import pollinations_service
+from services.model_router import ModelRouter
+from services.pollinations_service import UnsupportedAudioFormatError, _transcribe_segment_async
+from services.resilience import UpstreamError
+from utils.audio_utils import AudioConversionError
+
+
+class _Upstream:
+    """Поддельные модели: behaviour[model][format] — текст ответа или исключение"""
+
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+        self.requests = []
+        self.encoded = []
+
+    async def encode(self, voice_data, audio_format, **kwargs):
+        self.encoded.append(audio_format)
+        return f"{audio_format}-data".encode()
+
+    async def request(self, base64_audio, audio_format, token, model):
+        self.requests.append((model, audio_format))
+        response = self.behaviour[model].get(audio_format, UnsupportedAudioFormatError("HTTP 400"))
+        if isinstance(response, BaseException):
+            raise response
+        return response
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    def install(behaviour, encode=None):
+        fake = _Upstream(behaviour)
+        monkeypatch.setattr(settings, "voice_upload_formats", "ogg,mp3,wav")
+        monkeypatch.setattr(pollinations_service, "_audio_format_by_model", {})
+        monkeypatch.setattr(pollinations_service, "model_router", ModelRouter(
+            {"audio": list(behaviour)}, error_threshold=0.3, recovery_seconds=60
+        ))
+        monkeypatch.setattr(pollinations_service, "encode_for_transcription", encode or fake.encode)
+        monkeypatch.setattr(pollinations_service, "_request_transcription_async", fake.request)
+        return fake
+    return install
+
+
+def _transcribe():
+    return asyncio.run(_transcribe_segment_async(b"voice", "token"))
+
+
+def test_accepted_format_is_remembered_per_model(upstream):
+    fake = upstream({"whisper": {"mp3": "привет"}})
+    assert _transcribe() == "привет"
+    assert fake.requests == [("whisper", "ogg"), ("whisper", "mp3")]
+    assert pollinations_service._audio_format_by_model == {"whisper": "mp3"}
+
+    fake.requests.clear()
+    assert _transcribe() == "привет"
+    assert fake.requests == [("whisper", "mp3")]
+
+
+def test_empty_result_does_not_confirm_format(upstream):
+    upstream({"whisper": {"ogg": None}})
+    assert _transcribe() is None
+    assert pollinations_service._audio_format_by_model == {}
+
+
+def test_fallback_model_reuses_encoding(upstream):
+    fake = upstream({
+        "primary": {"ogg": UpstreamError("недоступна", status=503)},
+        "backup": {"ogg": UnsupportedAudioFormatError("HTTP 415"), "wav": "текст"},
+    })
+    assert _transcribe() == "текст"
+    assert fake.requests == [("primary", "ogg"), ("backup", "ogg"), ("backup", "mp3"), ("backup", "wav")]
+    assert fake.encoded == ["ogg", "mp3", "wav"]
+    assert pollinations_service._audio_format_by_model == {"backup": "wav"}
+
+
+@pytest.mark.parametrize("error", [AudioConversionError("битый файл"), FileNotFoundError("ffmpeg"),
+                                   asyncio.TimeoutError()])
+def test_conversion_errors_propagate_without_blaming_model(upstream, error):
+    async def failing_encode(voice_data, audio_format, **kwargs):
+        raise error
+
+    fake = upstream({"primary": {"ogg": "текст"}, "backup": {"ogg": "текст"}}, encode=failing_encode)
+    with pytest.raises(type(error)):
+        _transcribe()
+    assert fake.requests == []
+    router = pollinations_service.model_router
+    assert router.fallbacks == 0
+    assert router.is_healthy("audio", "primary")